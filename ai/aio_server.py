@@ -0,0 +1,1185 @@
+"""Asyncio serving mode for the AI server.
+
+Exposes the same routes as ``main.py`` (``/generate-image``,
+``/generate-with-preview``, ``/edit-image``, ``/inpaint-image``) but drives
+ComfyUI through aiohttp, so a single process can hold hundreds of in-flight
+jobs without a thread per job. Pillow work runs in a thread pool executor so it
+never blocks the event loop.
+
+Run with ``python aio_server.py``.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+from termcolor import colored
+
+from comfy_outputs import (STREAM_CHUNK, AsyncOutputImage, first_output, image_outputs, outputs_complete,
+                           read_image_async, read_images_async)
+from comfy_pool import Backend, BackendPool, server_addresses
+from comfy_ws import PromptRouter
+from http_client import (
+    CONNECT_TIMEOUT, HTTP_RETRIES, POOL_SIZE, READ_TIMEOUT, RETRY_BACKOFF, RETRY_STATUSES,
+)
+from ingest import debug_sink, is_raw_image
+from jobs import FINISHED, RUNNING, SUCCEEDED, JobError, JobTable, current_job, report_progress
+from masks import prepare_mask
+from metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, PromptTimer, job_failures, jobs_in_flight, observe_stage, preview_queue_depth,
+    render_metrics, request_errors, share_stats, timed, worker_stats,
+)
+from micro_batch import AsyncMicroBatcher
+from preview_relay import PreviewRelay, output_preview
+from result_cache import cache_key, content_digest, result_cache, result_key
+from single_flight import AsyncSingleFlight
+from upload_store import upload_name, upload_store
+from tracing import TRACE_HEADER, begin_trace, end_trace, in_context, span, start_span, trace_store, use_span
+from url_fetch import FetchError, fetch_async, url_cache
+from image_utils import (
+    batch_filenames, decode_base64_image, image_size, multipart_images, prescale_image, preview_frame_data_url,
+    thumbnail_data_url,
+)
+from workflows import (
+    REFINE_SINGLE_GRAPH, WorkflowError, build_batch_graph, build_refinement_graph, input_scale, optimize_resolution,
+    parse_count, parse_seed, parse_steps, prompt_request_body, random_seed, refinement_seeds, registry, snap_to_bucket,
+    websocket_outputs,
+)
+
+load_dotenv()
+
+WS_EVENT_TIMEOUT = float(os.getenv('COMFYUI_WS_EVENT_TIMEOUT', 30))
+
+# Pillow and file work is pushed off the event loop onto this pool
+image_executor = ThreadPoolExecutor(max_workers=int(os.getenv('AIO_IMAGE_WORKERS', 4)), thread_name_prefix="aio-image")
+
+
+# Previews are relayed from background threads; the WS consumer only enqueues
+preview_relay = PreviewRelay()
+preview_queue_depth.set_function(preview_relay.depth)
+# Reported per worker by the *-stats endpoints when several workers share METRICS_DIR
+share_stats("cache", result_cache.stats)
+share_stats("uploads", upload_store.stats)
+share_stats("fetch", url_cache.stats)
+# Identical seeded jobs running at the same time are executed once; cancelled when all their requests are
+in_flight = AsyncSingleFlight()
+# Requests submitted with ?async=1 run as background tasks, polled or streamed via /jobs/<id>
+jobs = JobTable()
+job_tasks = set()
+
+
+async def run_blocking(func, *args):
+    # In a copy of the caller's context, so work done on the pool is traced with its request
+    return await asyncio.get_running_loop().run_in_executor(image_executor, in_context(func, *args))
+
+
+class AsyncPromptWaiter:
+    """asyncio counterpart of :class:`comfy_ws.PromptWaiter`."""
+
+    def __init__(self, prompt_id, previews=False, outputs=()):
+        self.prompt_id = prompt_id
+        self.previews = previews
+        self.outputs = outputs
+        self.events = asyncio.Queue()
+
+    def put(self, event):
+        self.events.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.events.get(), timeout)
+
+
+class AsyncComfyClient:
+    """aiohttp client for ComfyUI with one shared, auto-reconnecting WebSocket."""
+
+    def __init__(self, server_address, client_id, connect_timeout=CONNECT_TIMEOUT, max_backoff=10):
+        self.server_address = server_address
+        self.client_id = client_id
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.router = PromptRouter(AsyncPromptWaiter)
+        self.session = None
+        self._reader = None
+        self._connected = asyncio.Event()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address}"
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    async def start(self):
+        # Pooled keep-alive connections; the WebSocket gets its own slot outside this limit
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE + 1, limit_per_host=POOL_SIZE + 1, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+        )
+        self._reader = asyncio.create_task(self._run())
+
+    async def _get(self, url, read, **kwargs):
+        """GET with bounded retries; ``read`` consumes the response (e.g. resp.read)."""
+        for attempt in range(HTTP_RETRIES + 1):
+            try:
+                async with self.session.get(url, **kwargs) as resp:
+                    if resp.status in RETRY_STATUSES and attempt < HTTP_RETRIES:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                    resp.raise_for_status()
+                    return await read(resp)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+                if attempt >= HTTP_RETRIES or (isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES):
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+        if self.session is not None:
+            await self.session.close()
+
+    async def wait_connected(self):
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.connect_timeout)
+            return True
+        except asyncio.TimeoutError:
+            print(colored(f"Failed to connect to WebSocket: ws://{self.server_address}/ws", "red"))
+            return False
+
+    async def _run(self):
+        url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        backoff = 1
+        connected_before = False
+        while True:
+            try:
+                async with self.session.ws_connect(url, max_msg_size=0, heartbeat=30) as ws:
+                    self._connected.set()
+                    backoff = 1
+                    print(colored(f"WebSocket connected to {url}", "green"))
+                    if connected_before:
+                        self.router.broadcast(("reconnected", None))
+                    connected_before = True
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.router.dispatch_text(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            self.router.dispatch_binary(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSED):
+                            break
+                print(colored("WebSocket connection closed. Reconnecting.", "yellow"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(colored(f"WebSocket error on {url}: {e}. Retrying in {backoff}s.", "red"))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                self._connected.clear()
+
+    async def queue_prompt(self, prompt, prompt_id=None):
+        data = prompt_request_body(prompt, self.client_id, prompt_id)
+        try:
+            with timed("queue_prompt"):
+                async with self.session.post(f"{self.base_url}/prompt", data=data,
+                                             headers={"Content-Type": "application/json"}) as resp:
+                    resp.raise_for_status()
+                    return await resp.json(content_type=None)
+        except Exception as e:
+            print(colored(f"Error executing prompt: {e}", "red"))
+            return None
+
+    async def get_history(self, prompt_id):
+        with timed("history"):
+            return await self._get(f"{self.base_url}/history/{prompt_id}", lambda resp: resp.json(content_type=None))
+
+    async def get_image(self, filename, subfolder, folder_type):
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        with timed("download", filename=filename):
+            return await self._get(f"{self.base_url}/view", lambda resp: resp.read(), params=params)
+
+    async def upload_image(self, image_data, filename):
+        print(colored(f"Uploading image: {filename} to {self.server_address}", "cyan"))
+        form = aiohttp.FormData()
+        form.add_field("image", image_data, filename=filename)
+        try:
+            with timed("upload"):
+                async with self.session.post(f"{self.base_url}/upload/image", data=form) as resp:
+                    if resp.status == 200:
+                        return await resp.json(content_type=None)
+                    print(colored(f"Failed to upload image: {resp.status} - {await resp.text()}", "red"))
+                    return None
+        except Exception as e:
+            print(colored(f"Error uploading image: {e}", "red"))
+            return None
+
+    async def finished_history(self, prompt_id):
+        # The prompt's history entry, or None while it is still running
+        try:
+            return (await self.get_history(prompt_id)).get(prompt_id)
+        except Exception as e:
+            print(colored(f"Error checking history for {prompt_id}: {e}", "red"))
+            return None
+
+    async def cancel_prompt(self, prompt_id):
+        """Drops a prompt from the queue, or interrupts it if it is already running."""
+        try:
+            async with self.session.post(f"{self.base_url}/queue", json={"delete": [prompt_id]}) as resp:
+                resp.raise_for_status()
+            queue_state = await self._get(f"{self.base_url}/queue", lambda resp: resp.json(content_type=None))
+            # Older ComfyUI builds interrupt whatever is running, so only ask while it is this prompt
+            if any(item[1] == prompt_id for item in queue_state.get('queue_running', [])):
+                async with self.session.post(f"{self.base_url}/interrupt", json={"prompt_id": prompt_id}) as resp:
+                    resp.raise_for_status()
+            print(colored(f"Cancelled prompt {prompt_id}.", "yellow"))
+        except Exception as e:
+            print(colored(f"Error cancelling prompt {prompt_id}: {e}", "red"))
+
+    async def get_images(self, prompt, socket_id=None, output_nodes=None, preview_outputs=()):
+        prompt_id = str(uuid.uuid4())
+        stream_nodes = websocket_outputs(prompt)
+        waiter = self.router.register(prompt_id, previews=bool(socket_id), outputs=stream_nodes)
+        try:
+            prompt_response = await self.queue_prompt(prompt, prompt_id)
+            if not prompt_response:
+                return None
+            if prompt_response['prompt_id'] != prompt_id:
+                self.router.unregister(prompt_id)
+                prompt_id = prompt_response['prompt_id']
+                waiter = self.router.register(prompt_id, previews=bool(socket_id), outputs=stream_nodes)
+            executed, streamed = {}, {}
+            history = await self._wait_for_completion(waiter, prompt_id, socket_id, preview_outputs, executed, streamed)
+            if history is False:
+                return None
+        except asyncio.CancelledError:
+            # Everyone waiting on this job has gone away
+            await asyncio.shield(self.cancel_prompt(prompt_id))
+            raise
+        finally:
+            self.router.unregister(prompt_id)
+
+        # /history is only asked when the end of the run wasn't seen on the WebSocket
+        # or the `executed` messages didn't name every output
+        outputs = image_outputs(executed, output_nodes)
+        # PNG bytes sent by SaveImageWebsocket nodes, which never appear in /history
+        streamed = {node_id: images for node_id, images in streamed.items()
+                    if output_nodes is None or node_id in output_nodes}
+        if history is None and not outputs_complete({**outputs, **streamed}, output_nodes):
+            history = (await self.get_history(prompt_id))[prompt_id]
+        if history is not None:
+            outputs = image_outputs(history['outputs'], output_nodes)
+        if stream_nodes and not streamed:
+            print(colored(f"⚠️ [AI Server] No WebSocket images received for {prompt_id}", "yellow"))
+        # Fetched only when used, so outputs the caller never returns are never downloaded
+        images = {
+            node_id: [AsyncOutputImage(self, image['filename'], image['subfolder'], image['type']) for image in images]
+            for node_id, images in outputs.items()
+        }
+        images.update(streamed)
+        return images
+
+    async def _wait_for_completion(self, waiter, prompt_id, socket_id, preview_outputs=(), executed=None,
+                                   streamed=None):
+        """Follows the prompt's events until it ends, recording `executed` outputs in ``executed``
+        and the images of WebSocket output nodes in ``streamed``.
+
+        Returns False if it failed, its history entry if the end was detected
+        through /history, and None if it was seen on the WebSocket.
+        """
+        timer = PromptTimer()
+        try:
+            with span("ws_wait", prompt_id=prompt_id):
+                while True:
+                    try:
+                        kind, out = await waiter.get(timeout=WS_EVENT_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        history = await self.finished_history(prompt_id)
+                        if history is not None:
+                            return history
+                        continue
+
+                    if kind == "reconnected":
+                        history = await self.finished_history(prompt_id)
+                        if history is not None:
+                            return history
+                        continue
+
+                    if kind == "json":
+                        timer.event(out)
+                        data = out.get('data') or {}
+                        if out['type'] == 'progress':
+                            percentage = int((data['value'] / data['max']) * 100)
+                            print(colored(f"Progress: {percentage}% in node {data['node']}", "yellow"))
+                            report_progress(data['value'], data['max'], data['node'])
+                        elif out['type'] == 'executing':
+                            if data['node'] is None and data['prompt_id'] == prompt_id:
+                                print(colored("Execution complete.", "green"))
+                                return None
+                            if data['node'] is not None:
+                                report_progress(node=data['node'])
+                        elif out['type'] == 'executed':
+                            images = (data.get('output') or {}).get('images')
+                            if images and executed is not None:
+                                executed[data['node']] = data['output']
+                            if socket_id and images and data['node'] in preview_outputs:
+                                # Downloaded on a relay thread only if it isn't superseded first
+                                preview_relay.submit(socket_id, partial(output_preview, self.server_address, images[-1]))
+                        elif out['type'] in ('execution_error', 'execution_interrupted'):
+                            print(colored(f"Execution failed: {out['type']}", "red"))
+                            return False
+                    elif kind == "output" and streamed is not None:
+                        node_id, frame = out
+                        streamed.setdefault(node_id, []).append(bytes(frame.image))
+                    elif kind == "preview" and socket_id:
+                        # Encoding and the relay POST happen on the relay's threads
+                        preview_relay.submit(socket_id, partial(preview_frame_data_url, out))
+        finally:
+            timer.finished()
+
+
+async def first_image(images):
+    # Bytes of the first image, downloading it if needed
+    node_id, outputs = first_output(images)
+    return await read_image_async(outputs[0]) if outputs else None
+
+
+def output_images(images):
+    # Images of the first output node (several for a batch); JobError when the job produced nothing
+    node_id, outputs = first_output(images)
+    if not outputs:
+        raise JobError("Failed to generate images")
+    return outputs
+
+
+def image_response(image_data, download_name):
+    return web.Response(
+        body=image_data,
+        content_type='image/png',
+        headers={'Content-Disposition': f'inline; filename="{download_name}"'},
+    )
+
+
+async def images_response(request, images, download_name):
+    # A batch goes out as multipart/mixed, one PNG part per image
+    if len(images) == 1:
+        if isinstance(images[0], AsyncOutputImage) and not images[0].downloaded:
+            return await stream_image(request, images[0], download_name)
+        return image_response(await read_image_async(images[0]), download_name)
+    images = await read_images_async(images)
+    body, content_type = multipart_images(images, batch_filenames(download_name, len(images)))
+    return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+async def stream_image(request, image, download_name):
+    # Pipe a ComfyUI output to the client in chunks instead of buffering the whole file
+    with timed("response"):
+        return await _stream_image(request, image, download_name)
+
+
+async def _stream_image(request, image, download_name):
+    with timed("download", filename=image.params["filename"]):
+        async with image.open() as upstream:
+            upstream.raise_for_status()
+            response = web.StreamResponse(headers={
+                'Content-Type': 'image/png',
+                'Content-Disposition': f'inline; filename="{download_name}"',
+                # Headers are sent on prepare(), before the CORS middleware sees the response
+                'Access-Control-Allow-Origin': '*',
+            })
+            if upstream.content_length is not None:
+                response.content_length = upstream.content_length
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(STREAM_CHUNK):
+                await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+def error_response(message, status):
+    return web.json_response({"error": message}, status=status)
+
+
+def get_template(name):
+    # Cached in memory; at most one stat() per second, and a re-parse only when the file changed
+    try:
+        return registry.get(name)
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load workflow '{name}': {e}", "red"))
+        return None
+
+
+def lookup_result(workflow_name, seed, inputs=None, **params):
+    # Returns (key, images); key is None when the request isn't deterministic (no caller-supplied seed)
+    if seed is None:
+        return None, None
+    template = get_template(workflow_name)
+    if template is None:
+        return None, None
+    key = result_key(template, inputs, seed=seed, **params)
+    images = result_cache.get(key)
+    if images is not None:
+        print(colored(f"♻️ [AI Server] Result cache hit for '{workflow_name}' (seed: {seed})", "green"))
+    return key, images
+
+
+async def cached_result(workflow_name, seed, inputs=None, **params):
+    # Hashing inputs and the disk tier are blocking, so the lookup runs on the executor
+    return await run_blocking(partial(lookup_result, workflow_name, seed, inputs, **params))
+
+
+async def store_result(key, images):
+    # Only the images a response can return (the first output node's) are downloaded and cached
+    node_id, outputs = first_output(images)
+    if key is not None and outputs:
+        data = await read_images_async(outputs)
+        await run_blocking(result_cache.put, key, {node_id: data})
+
+
+async def run_deduplicated(key, job, *args):
+    # Run job(*args) -> (images, seed) once for all concurrent requests with the same key
+    if key is None:
+        return await job(*args)
+
+    async def run():
+        images, seed = await job(*args)
+        await store_result(key, images)
+        return images, seed
+
+    return await in_flight.run(key, run)
+
+
+async def generate_images(client, positive_prompt, steps, resolution, socket_id=None, seed=None, count=1):
+    if not await client.wait_connected():
+        return None, None
+    template = get_template("generate")
+    if template is None:
+        return None, None
+    if seed is None:
+        seed = random_seed()
+    # count > 1 batches the latent, so every variation comes out of the same sampler pass
+    workflow = template.render(prompt=positive_prompt, steps=steps, seed=seed,
+                               width=int(resolution[0]), height=int(resolution[1]), batch_size=count)
+    return await client.get_images(workflow, socket_id, template.returned_outputs), seed
+
+
+async def run_generate_batch(key, items):
+    # Single-image txt2img jobs with the same pool, resolution bucket and step count, run as one
+    # ComfyUI prompt: model loaders run once, each job gets its own prompt/seed branch and output
+    pool, resolution, steps = key
+    if len(items) == 1:
+        positive_prompt, seed, socket_id = items[0]
+        with pool.lease() as backend:
+            return [await generate_images(backend.client, positive_prompt, steps, resolution, socket_id, seed)]
+
+    failed = [(None, seed) for _, seed, _ in items]
+    template = get_template("generate")
+    if template is None:
+        return failed
+    width, height = int(resolution[0]), int(resolution[1])
+    graph, outputs = build_batch_graph(template, [
+        dict(prompt=positive_prompt, steps=steps, seed=seed, width=width, height=height)
+        for positive_prompt, seed, _ in items
+    ])
+    print(colored(f"📦 [AI Server] Running {len(items)} generate jobs at {width}x{height} as one prompt", "magenta"))
+
+    with pool.lease() as backend:
+        if not await backend.client.wait_connected():
+            return failed
+        # Sampler previews of a merged graph can't be told apart, so batched jobs don't relay them
+        images = await backend.client.get_images(graph, output_nodes=set(outputs)) or {}
+    return [({node_id: images[node_id]} if images.get(node_id) else None, seed)
+            for node_id, (_, seed, _) in zip(outputs, items)]
+
+
+# Compatible txt2img jobs arriving within MICRO_BATCH_WINDOW seconds are merged (off by default)
+generate_batcher = AsyncMicroBatcher(run_generate_batch)
+
+
+async def generate_images_batched(pool, positive_prompt, steps, resolution, socket_id=None, seed=None):
+    if seed is None:
+        seed = random_seed()
+    return await generate_batcher.submit((pool, tuple(resolution), steps), (positive_prompt, seed, socket_id))
+
+
+async def generate_images_iterative(client, positive_prompt, total_steps, resolution, socket_id=None, seed=None):
+    if not await client.wait_connected():
+        return None, None
+    if REFINE_SINGLE_GRAPH and total_steps > 1:
+        return await generate_refinement_chain(client, positive_prompt, total_steps, resolution, socket_id, seed)
+    template = get_template("generate")
+    if template is None:
+        return None, None
+
+    # Step 1: Txt2Img (1 step)
+    if seed is None:
+        seed = random_seed()
+    workflow = template.render(prompt=positive_prompt, steps=1, seed=seed,
+                               width=int(resolution[0]), height=int(resolution[1]))
+    images_output = await client.get_images(workflow, socket_id, template.returned_outputs)
+    if not images_output:
+        print(colored("Txt2Img failed.", "red"))
+        return None, None
+    current_image_data = await first_image(images_output)
+
+    def send_preview(image_data):
+        if socket_id:
+            preview_relay.submit(socket_id, partial(thumbnail_data_url, image_data, "PNG"))
+
+    send_preview(current_image_data)
+    if total_steps <= 1:
+        return images_output, seed
+
+    edit_template = get_template("edit")
+    if edit_template is None:
+        return images_output, seed
+
+    remaining_steps = total_steps - 1
+    step_seeds = refinement_seeds(seed, remaining_steps)
+    for i in range(remaining_steps):
+        print(colored(f">>> Starting Refinement Step {i+1}/{remaining_steps}", "blue"))
+        # Released for eviction once the step is done
+        async with uploaded(client, current_image_data, "refine") as image_name:
+            if not image_name:
+                print(colored("Failed to upload intermediate image.", "red"))
+                break
+
+            workflow = edit_template.render(prompt=positive_prompt, image=image_name, seed=step_seeds[i], steps=1)
+            step_output = await client.get_images(workflow, socket_id, edit_template.returned_outputs)
+        if not step_output:
+            print(colored("Img2Img failed.", "red"))
+            break
+        images_output = step_output
+        current_image_data = await first_image(images_output)
+        send_preview(current_image_data)
+
+    return images_output, seed
+
+
+async def generate_refinement_chain(client, positive_prompt, total_steps, resolution, socket_id=None, seed=None):
+    # One graph for txt2img and every refinement pass; only the final output is downloaded
+    template = get_template("generate")
+    edit_template = get_template("edit")
+    if template is None or edit_template is None:
+        return None, None
+
+    # Only caller-supplied seeds are cached and deduplicated; a random seed never repeats
+    deterministic = seed is not None
+    if seed is None:
+        seed = random_seed()
+    try:
+        workflow, final_node, preview_nodes = build_refinement_graph(
+            template, edit_template, positive_prompt, resolution, seed, refinement_seeds(seed, total_steps - 1))
+    except (KeyError, WorkflowError) as e:
+        print(colored(f"Failed to build refinement graph: {e}", "red"))
+        return None, None
+
+    key = cache_key(workflow) if deterministic else None
+    if key is not None:
+        images_output = await run_blocking(result_cache.get, key)
+        if images_output is not None:
+            print(colored(f"♻️ [AI Server] Result cache hit for refinement chain (seed: {seed})", "green"))
+            return images_output, seed
+
+    async def run_chain():
+        print(colored(f">>> Starting Txt2Img + {total_steps - 1} refinement steps as a single graph", "blue"))
+        return await client.get_images(workflow, socket_id, output_nodes={final_node},
+                                       preview_outputs=set(preview_nodes)), seed
+
+    images_output, seed = await run_deduplicated(key, run_chain)
+    if not images_output:
+        print(colored("Refinement chain failed.", "red"))
+        return None, None
+    return images_output, seed
+
+
+@asynccontextmanager
+async def uploaded(client, image_data, prefix):
+    """Uploads bytes to the client's ComfyUI server under a content-hash name, unless it already holds them.
+
+    Yields the ComfyUI file name (None if the upload failed); the file isn't evicted while in use.
+    """
+    digest = await run_blocking(content_digest, image_data)
+    address = client.server_address
+    name = upload_store.acquire(address, digest)
+    if name is None:
+        upload_resp = await client.upload_image(image_data, upload_name(prefix, digest))
+        if not upload_resp:
+            yield None
+            return
+        name = upload_resp.get("name")
+        upload_store.add(address, digest, name, len(image_data))
+    else:
+        print(colored(f"♻️ [AI Server] {address} already has {name}; skipping upload", "green"))
+    try:
+        yield name
+    finally:
+        upload_store.release(address, digest)
+
+
+async def generate_inpaint_images(client, prompt, image_filename, mask_filename, steps, seed=None):
+    if not await client.wait_connected():
+        return None, None
+    template = get_template("inpaint")
+    if template is None:
+        return None, None
+    if seed is None:
+        seed = random_seed()
+    workflow = template.render(prompt=prompt, image=image_filename, mask=mask_filename, seed=seed, steps=steps)
+    return await client.get_images(workflow, output_nodes=template.returned_outputs), seed
+
+
+async def edit_image_logic(client, prompt, image_filename, steps=None, seed=None):
+    if not await client.wait_connected():
+        return None, None
+    template = get_template("edit")
+    if template is None:
+        return None, None
+    if seed is None:
+        seed = random_seed()
+    workflow = template.render(prompt=prompt, image=image_filename, seed=seed, steps=steps)
+    return await client.get_images(workflow, output_nodes=template.returned_outputs), seed
+
+
+async def read_image_input(client, image_input):
+    """Returns bytes for a URL or base64/data-URL image input; raises FetchError if a URL can't be downloaded."""
+    if image_input.startswith("http"):
+        print(colored(f"⬇️ [AI Server] Downloading image from URL: {image_input}", "cyan"))
+        return await fetch_async(client.session, image_input)
+    return decode_base64_image(image_input)
+
+
+async def read_multipart(request):
+    """Reads a multipart form part by part: file parts as bytes, other fields as str.
+
+    Unlike ``request.post()``, file parts are not spooled to temporary files first.
+    """
+    fields, files = {}, {}
+    async for part in await request.multipart():
+        if part.filename is not None:
+            files[part.name] = bytes(await part.read())
+        else:
+            fields[part.name] = await part.text()
+    return fields, files
+
+
+async def generate_image_route(request):
+    pool = request.app['comfy']
+    data = await request.json()
+    if not data or 'prompt' not in data:
+        return error_response("No prompt provided", 400)
+
+    width, height = optimize_resolution(data.get('width', 512), data.get('height', 512))
+    steps = data.get('steps', 25)
+    try:
+        seed = parse_seed(data.get('seed'))
+    except (TypeError, ValueError):
+        return error_response("Invalid seed", 400)
+    try:
+        count = parse_count(data.get('count'))
+    except (TypeError, ValueError):
+        return error_response("Invalid count", 400)
+    if generate_batcher.enabled and count == 1:
+        # Snapped to a few buckets so concurrent requests can share one prompt
+        width, height = snap_to_bucket(width, height)
+    print(colored(f"🎨 [AI Server] Generating image: prompt='{data['prompt']}', steps={steps}, res={width}x{height}, count={count}", "blue"))
+
+    return await run_or_submit(request, "generate-image", generate_job, pool, data['prompt'], steps, (width, height),
+                               data.get('socketId'), seed, count)
+
+
+async def generate_job(pool, prompt, steps, resolution, socket_id, seed, count=1):
+    width, height = resolution
+    key, images = await cached_result("generate", seed, prompt=prompt, steps=steps, width=width, height=height,
+                                      batch_size=count)
+    if images is None and count == 1 and generate_batcher.enabled:
+        images, seed = await run_deduplicated(key, generate_images_batched, pool, prompt, steps, resolution,
+                                              socket_id, seed)
+    elif images is None:
+        images, seed = await run_deduplicated(key, run_generate, pool, prompt, steps, resolution, socket_id, seed,
+                                              count)
+    return output_images(images), f"generated-{seed}.png"
+
+
+async def run_generate(pool, prompt, steps, resolution, socket_id, seed, count):
+    # Leased in the shared task: requests waiting on a duplicate prompt don't hold a backend
+    with pool.lease() as backend:
+        return await generate_images(backend.client, prompt, steps, resolution, socket_id, seed, count)
+
+
+async def generate_with_preview_route(request):
+    pool = request.app['comfy']
+    data = await request.json()
+    if not data or 'prompt' not in data:
+        return error_response("No prompt provided", 400)
+
+    width, height = optimize_resolution(data.get('width', 512), data.get('height', 512))
+    steps = data.get('steps', 25)
+    socket_id = data.get('socketId')
+    try:
+        seed = parse_seed(data.get('seed'))
+    except (TypeError, ValueError):
+        return error_response("Invalid seed", 400)
+    print(colored(f"🎨 [AI Server] Generating image: prompt='{data['prompt']}', steps={steps}, res={width}x{height}, socket={socket_id}", "blue"))
+
+    return await run_or_submit(request, "generate-with-preview", preview_job, pool, data['prompt'], steps,
+                               (width, height), socket_id, seed)
+
+
+async def preview_job(pool, prompt, steps, resolution, socket_id, seed):
+    # The stepwise fallback uploads intermediate images, so the whole job stays on one server
+    with pool.lease() as backend:
+        images, seed = await generate_images_iterative(backend.client, prompt, steps, resolution, socket_id, seed)
+    return output_images(images), f"generated-{seed}.png"
+
+
+async def edit_image_route(request):
+    pool = request.app['comfy']
+    if is_raw_image(request.content_type):
+        # Bare image body: no base64 or multipart decoding; parameters are in the query string
+        prompt = request.query.get('prompt')
+        try:
+            steps = parse_steps(request.query.get('steps'))
+        except ValueError:
+            return error_response("Invalid steps", 400)
+        seed = request.query.get('seed')
+        image_data = await request.read()
+        if not image_data:
+            return error_response("Image is required", 400)
+    elif request.content_type == 'application/json':
+        data = await request.json()
+        prompt = data.get('prompt')
+        try:
+            steps = parse_steps(data.get('steps'))
+        except (TypeError, ValueError):
+            return error_response("Invalid steps", 400)
+        seed = data.get('seed')
+        image_input = data.get('image')
+        if not image_input:
+            return error_response("Image is required", 400)
+        try:
+            image_data = await read_image_input(pool.backends[0].client, image_input)
+        except FetchError as e:
+            return error_response(str(e), 400)
+        except Exception as e:
+            print(colored(f"❌ [AI Server] Error processing image: {e}", "red"))
+            return error_response("Invalid image input", 400)
+    else:
+        form, files = await read_multipart(request)
+        image_data = files.get('image')
+        if image_data is None:
+            return error_response("Image file is required", 400)
+        prompt = form.get('prompt')
+        try:
+            steps = parse_steps(form.get('steps'))
+        except ValueError:
+            return error_response("Invalid steps", 400)
+        seed = form.get('seed')
+
+    if prompt is None:
+        return error_response("No prompt provided", 400)
+    try:
+        seed = parse_seed(seed)
+    except (TypeError, ValueError):
+        return error_response("Invalid seed", 400)
+    # Downscale an oversized image to the workflow's pixel budget before upload
+    image_data, _ = await run_blocking(prescale_image, image_data, input_scale("edit"))
+    # Debug: a sample of inputs is saved in the background (DEBUG_CAPTURE_RATE)
+    debug_sink.capture({"debug_img2img_input.png": image_data})
+
+    return await run_or_submit(request, "edit-image", edit_job, pool, prompt, steps, seed, image_data)
+
+
+async def edit_job(pool, prompt, steps, seed, image_data):
+    # A cache hit skips the upload and ComfyUI entirely; concurrent duplicates attach to the running job
+    key, images = await cached_result("edit", seed, {"image": image_data}, prompt=prompt, steps=steps)
+    if images is None:
+        images, seed = await run_deduplicated(key, run_edit, pool, prompt, steps, seed, image_data)
+    return output_images(images), f"img2img-{seed}.png"
+
+
+async def run_edit(pool, prompt, steps, seed, image_data):
+    # Runs in the shared task, so the lease and the upload last exactly as long as the ComfyUI job.
+    # The upload goes to the same ComfyUI server that will run the job (skipped if it already has the bytes)
+    with pool.lease() as backend:
+        client = backend.client
+        async with uploaded(client, image_data, "image") as image_name:
+            if not image_name:
+                raise JobError("Failed to upload image to ComfyUI")
+
+            print(colored(f"🎨 [AI Server] Edit Image: prompt='{prompt}', steps={steps}", "blue"))
+            return await edit_image_logic(client, prompt, image_name, steps, seed)
+
+
+async def inpaint_image_route(request):
+    pool = request.app['comfy']
+    if request.content_type == 'application/json':
+        data = await request.json()
+        prompt = data.get('prompt')
+        try:
+            steps = parse_steps(data.get('steps'), 25)
+        except (TypeError, ValueError):
+            return error_response("Invalid steps", 400)
+        seed = data.get('seed')
+        image_input = data.get('image')
+        mask_input = data.get('mask')
+        if not image_input or not mask_input:
+            return error_response("Image and mask are required", 400)
+        try:
+            image_data = await read_image_input(pool.backends[0].client, image_input)
+            image_size(image_data)
+        except FetchError as e:
+            return error_response(str(e), 400)
+        except Exception as e:
+            print(colored(f"❌ [AI Server] Error processing image: {e}", "red"))
+            return error_response("Invalid image input", 400)
+        try:
+            mask_data_raw = decode_base64_image(mask_input)
+        except Exception as e:
+            print(colored(f"❌ [AI Server] Error decoding mask: {e}", "red"))
+            return error_response("Invalid mask base64", 400)
+    else:
+        form, files = await read_multipart(request)
+        image_data = files.get('image')
+        mask_data_raw = files.get('mask')
+        if image_data is None or mask_data_raw is None:
+            return error_response("Image and mask files are required", 400)
+        prompt = form.get('prompt')
+        try:
+            steps = parse_steps(form.get('steps'), 25)
+        except ValueError:
+            return error_response("Invalid steps", 400)
+        seed = form.get('seed')
+
+    if prompt is None:
+        return error_response("No prompt provided", 400)
+    try:
+        seed = parse_seed(seed)
+    except (TypeError, ValueError):
+        return error_response("Invalid seed", 400)
+    # Downscale an oversized image to the workflow's pixel budget before upload; the mask follows it
+    image_data, size = await run_blocking(prescale_image, image_data, input_scale("inpaint"))
+    mask_data = await run_blocking(prepare_mask, mask_data_raw, size)
+    # Debug: a sample of inputs is saved in the background (DEBUG_CAPTURE_RATE)
+    debug_sink.capture({"debug_image.png": image_data, "debug_mask.png": mask_data})
+
+    return await run_or_submit(request, "inpaint-image", inpaint_job, pool, prompt, steps, seed, image_data, mask_data)
+
+
+async def inpaint_job(pool, prompt, steps, seed, image_data, mask_data):
+    # A cache hit skips the uploads and ComfyUI entirely; concurrent duplicates attach to the running job
+    key, images = await cached_result("inpaint", seed, {"image": image_data, "mask": mask_data},
+                                      prompt=prompt, steps=steps)
+    if images is None:
+        images, seed = await run_deduplicated(key, run_inpaint, pool, prompt, steps, seed, image_data, mask_data)
+    return output_images(images), f"inpainted-{seed}.png"
+
+
+async def run_inpaint(pool, prompt, steps, seed, image_data, mask_data):
+    # Like run_edit: the lease and the uploads belong to the shared task.
+    # Uploads go to the same ComfyUI server that will run the job (skipped if it already has the bytes)
+    with pool.lease() as backend:
+        client = backend.client
+        async with AsyncExitStack() as uploads:
+            image_name, mask_name = await asyncio.gather(
+                uploads.enter_async_context(uploaded(client, image_data, "image")),
+                uploads.enter_async_context(uploaded(client, mask_data, "mask")),
+            )
+            if not image_name or not mask_name:
+                raise JobError("Failed to upload images to ComfyUI")
+
+            print(colored(f"🎨 [AI Server] Inpainting: prompt='{prompt}', steps={steps}", "blue"))
+            return await generate_inpaint_images(client, prompt, image_name, mask_name, steps, seed)
+
+
+def wants_async(request):
+    # ?async=1 or an RFC 7240 "Prefer: respond-async" header
+    return (request.query.get('async', '').lower() in ('1', 'true')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+
+def job_links(job):
+    state = job.to_dict()
+    state.update(statusUrl=f"/jobs/{job.id}", eventsUrl=f"/jobs/{job.id}/events", resultUrl=f"/jobs/{job.id}/result")
+    if job.status == SUCCEEDED:
+        state["resultUrls"] = [f"/jobs/{job.id}/result/{i}" for i in range(len(job.result))]
+    return state
+
+
+async def run_or_submit(request, kind, job_fn, *args):
+    """Awaits job_fn(*args) -> (png images, download name) and sends the images, or with
+    ``?async=1`` starts it as a background job and answers 202 with the job id."""
+    # Everything the route did before this point: parsing, decoding and preparing the inputs
+    observe_stage("ingest", time.monotonic() - request['started'])
+    if wants_async(request):
+        job = jobs.create(kind)
+        if job is None:
+            return error_response("Too many jobs in progress", 503)
+        # Runs in its own task, so it outlives the submitting request; its span keeps the trace open
+        job_span = start_span("job", kind=kind, job_id=job.id)
+        task = asyncio.ensure_future(run_job(job, job_span, job_fn, *args))
+        job_tasks.add(task)
+        task.add_done_callback(job_tasks.discard)
+        print(colored(f"📥 [AI Server] Queued {kind} job {job.id}", "cyan"))
+        return web.json_response(job_links(job), status=202, headers={"Location": f"/jobs/{job.id}"})
+
+    try:
+        with jobs_in_flight.track():
+            images, download_name = await job_fn(*args)
+    except JobError as e:
+        return error_response(str(e), 500)
+    return await images_response(request, images, download_name)
+
+
+async def run_job(job, job_span, job_fn, *args):
+    current_job.set(job)
+    job.update(status=RUNNING)
+    try:
+        with use_span(job_span), jobs_in_flight.track():
+            images, download_name = await job_fn(*args)
+            job.succeed(await read_images_async(images), download_name)
+        print(colored(f"✅ [AI Server] Job {job.id} finished", "green"))
+    except JobError as e:
+        job_failures.inc(kind=job.kind)
+        job.fail(str(e))
+    except asyncio.CancelledError:
+        job.fail("Cancelled")
+        raise
+    except Exception as e:
+        job_failures.inc(kind=job.kind)
+        print(colored(f"🔥 [AI Server] Job {job.id} crashed: {str(e)}", "red", attrs=["bold"]))
+        import traceback
+        traceback.print_exc()
+        job.fail(f"Internal server error: {str(e)}")
+
+
+def get_job(request):
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        raise web.HTTPNotFound(text='{"error": "Unknown job"}', content_type='application/json')
+    return job
+
+
+async def job_status_route(request):
+    return web.json_response(job_links(get_job(request)))
+
+
+async def job_events_route(request):
+    # Server-sent events: one event (named after the job status) per change until the job finishes
+    job = get_job(request)
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Access-Control-Allow-Origin': '*',
+    })
+    await response.prepare(request)
+
+    changed = asyncio.Event()
+    # Job updates may come from other threads (e.g. the result cache executor)
+    listener = partial(asyncio.get_running_loop().call_soon_threadsafe, changed.set)
+    job.add_listener(listener)
+    try:
+        while True:
+            changed.clear()
+            state = job.to_dict()
+            await response.write(f"event: {state['status']}\ndata: {json.dumps(state)}\n\n".encode())
+            if state['status'] in FINISHED:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+    except (ConnectionResetError, asyncio.CancelledError):
+        # The client closed the stream; the job itself carries on
+        print(colored(f"👋 [AI Server] Events client for job {job.id} disconnected", "yellow"))
+    finally:
+        job.remove_listener(listener)
+    return response
+
+
+async def job_result_route(request):
+    # The finished image(s), or one image of a batch by index; 202 with the job status while it is still running
+    job = get_job(request)
+    if job.status == SUCCEEDED:
+        if 'index' not in request.match_info:
+            return await images_response(request, job.result, job.download_name)
+        index = int(request.match_info['index'])
+        if index >= len(job.result):
+            return error_response("No such image", 404)
+        return image_response(job.result[index], batch_filenames(job.download_name, len(job.result))[index])
+    if job.status in FINISHED:
+        return error_response(job.error, 500)
+    return web.json_response(job_links(job), status=202)
+
+
+async def cache_stats_route(request):
+    return web.json_response(await run_blocking(worker_stats, "cache"))
+
+
+async def upload_stats_route(request):
+    return web.json_response(await run_blocking(worker_stats, "uploads"))
+
+
+async def fetch_stats_route(request):
+    return web.json_response(await run_blocking(worker_stats, "fetch"))
+
+
+async def metrics_route(request):
+    # Prometheus scrape endpoint: per-stage latency histograms, error counters, in-flight gauges.
+    # Reads the other workers' files under gunicorn, so it runs on the executor
+    return web.Response(body=(await run_blocking(render_metrics)).encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+async def traces_route(request):
+    # Newest finished traces; ?min_ms= keeps only the slow ones
+    try:
+        limit = int(request.query.get('limit', 50))
+        min_ms = float(request.query.get('min_ms', 0))
+    except ValueError:
+        return error_response("Invalid limit or min_ms", 400)
+    # Read from the shared trace directory under gunicorn, so it runs on the executor
+    return web.json_response(await run_blocking(trace_store.recent, limit, min_ms))
+
+
+async def trace_route(request):
+    # The span timeline of one request; ?format=otlp returns it as OTLP/JSON
+    trace = await run_blocking(trace_store.get, request.match_info['trace_id'])
+    if trace is None:
+        return error_response("Trace not found", 404)
+    return web.json_response(trace.to_otlp() if request.query.get('format') == 'otlp' else trace.to_dict())
+
+
+async def backends_route(request):
+    return web.json_response(request.app['comfy'].stats())
+
+
+@web.middleware
+async def request_tracing(request, handler):
+    # Every request is traced, continuing the caller's trace id; its stages become child spans
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    trace_span, token = begin_trace(f"{request.method} {route}", request.headers,
+                                    **{"http.method": request.method, "http.target": request.path})
+    request['trace_span'] = trace_span
+    try:
+        response = await handler(request)
+        trace_span.set(**{"http.status_code": response.status})
+        return response
+    except web.HTTPException as e:
+        trace_span.set(**{"http.status_code": e.status})
+        raise
+    except BaseException as e:
+        trace_span.fail(e)
+        raise
+    finally:
+        end_trace(token)
+        trace_span.end()
+
+
+async def add_trace_header(request, response):
+    trace_span = request.get('trace_span')
+    if trace_span is not None:
+        response.headers[TRACE_HEADER] = trace_span.trace.trace_id
+
+
+@web.middleware
+async def request_metrics(request, handler):
+    # "ingest" is measured from here; error statuses are counted per route
+    request['started'] = time.monotonic()
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        request_errors.inc(route=route, status=e.status)
+        raise
+    if response.status >= 400:
+        request_errors.inc(route=route, status=response.status)
+    if not response.prepared and (response.content_type == 'image/png' or response.content_type.startswith('multipart/')):
+        # Write the body here rather than after the middleware returns, so it can be timed
+        with timed("response"):
+            await response.prepare(request)
+            await response.write_eof()
+    return response
+
+
+@web.middleware
+async def cors_and_errors(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+    else:
+        print(colored(f"🚀 [AI Server] Received request on {request.path}", "green", attrs=["bold"]))
+        try:
+            response = await handler(request)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            print(colored(f"🔥 [AI Server] UNEXPECTED CRITICAL ERROR: {str(e)}", "red", attrs=["bold"]))
+            import traceback
+            traceback.print_exc()
+            response = error_response(f"Internal server error: {str(e)}", 500)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+async def start_comfy_client(app):
+    client_id = str(uuid.uuid4())
+    addresses = server_addresses()
+    print(colored(f"Server Addresses: {', '.join(addresses)}", "magenta"))
+    print(colored(f"Generated Client ID: {client_id}", "magenta"))
+    # One client (and WebSocket) per ComfyUI server; jobs go to the least-loaded healthy one
+    app['comfy'] = BackendPool([Backend(address, AsyncComfyClient(address, client_id)) for address in addresses])
+    for backend in app['comfy'].backends:
+        await backend.client.start()
+    app['comfy'].start_health_checks()
+    await run_blocking(registry.preload)
+
+
+async def close_comfy_client(app):
+    for backend in app['comfy'].backends:
+        await backend.client.close()
+
+
+def create_app():
+    app = web.Application(client_max_size=int(os.getenv('AIO_MAX_BODY_BYTES', 64 * 1024 * 1024)))
+    app.middlewares.append(request_tracing)
+    app.middlewares.append(request_metrics)
+    app.middlewares.append(cors_and_errors)
+    app.router.add_post('/generate-image', generate_image_route)
+    app.router.add_post('/generate-with-preview', generate_with_preview_route)
+    app.router.add_post('/edit-image', edit_image_route)
+    app.router.add_post('/inpaint-image', inpaint_image_route)
+    app.router.add_get('/jobs/{job_id}', job_status_route)
+    app.router.add_get('/jobs/{job_id}/events', job_events_route)
+    app.router.add_get('/jobs/{job_id}/result', job_result_route)
+    app.router.add_get(r'/jobs/{job_id}/result/{index:\d+}', job_result_route)
+    app.router.add_get('/cache-stats', cache_stats_route)
+    app.router.add_get('/upload-stats', upload_stats_route)
+    app.router.add_get('/fetch-stats', fetch_stats_route)
+    app.router.add_get('/metrics', metrics_route)
+    app.router.add_get('/traces', traces_route)
+    app.router.add_get('/traces/{trace_id}', trace_route)
+    app.router.add_get('/backends', backends_route)
+    app.on_response_prepare.append(add_trace_header)
+    app.on_startup.append(start_comfy_client)
+    app.on_cleanup.append(close_comfy_client)
+    return app
+
+
+if __name__ == "__main__":
+    port = int(os.getenv('PORT', 3000))
+    print(colored(f"Starting asyncio server on port {port}...", "green"))
+    # Cancel handlers when the client disconnects, so abandoned jobs can be interrupted
+    web.run_app(create_app(), host='0.0.0.0', port=port, handler_cancellation=True)
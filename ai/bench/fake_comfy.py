@@ -0,0 +1,293 @@
+"""A stand-in for a ComfyUI server, for benchmarking the AI server without a GPU.
+
+Speaks the parts of the ComfyUI API the AI server uses: ``/prompt``, ``/ws``
+(status, execution_start, executing, progress, executed, binary preview
+frames), ``/history``, ``/view``, ``/upload/image``, ``/queue``,
+``/interrupt`` and ``/system_stats``. Sampling takes ``--step-seconds`` per
+step, so a prompt's run time follows its ``steps`` input the way a real
+sampler's does. It also serves ``/relay`` in place of the Node backend's
+preview relay, and ``/stats`` with request counters.
+
+    python bench/fake_comfy.py --port 8188 --step-seconds 0.05 --image-size 1024x1024
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import struct
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+from PIL import Image
+
+SAMPLERS = ("KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced", "LanPaint_KSampler")
+OUTPUTS = ("SaveImage", "PreviewImage")
+
+# ComfyUI binary WebSocket frames: event type, then the image format, then the image
+PREVIEW_IMAGE = 1
+FORMAT_JPEG = 1
+FORMAT_PNG = 2
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+class FakeComfy:
+    def __init__(self, args):
+        self.args = args
+        self.queue = asyncio.Queue()
+        self.sockets = {}
+        self.history = {}
+        self.outputs = {}
+        self.uploads = {}
+        self.running = set()
+        self.pending = []
+        self.interrupted = set()
+        self.deleted = set()
+        self.stats = Counter()
+        self._images = {}
+
+    def image(self, size, fmt):
+        # Noise, so PNG sizes are realistic; encoded once per size and reused
+        key = (size, fmt)
+        if key not in self._images:
+            width, height = size
+            img = Image.frombytes("RGB", size, os.urandom(width * height * 3))
+            if fmt == "JPEG":
+                img = img.resize((max(1, width // 8), max(1, height // 8))).resize(size)
+            buffered = io.BytesIO()
+            img.save(buffered, format=fmt, **({"quality": 80} if fmt == "JPEG" else {"compress_level": 1}))
+            self._images[key] = buffered.getvalue()
+        return self._images[key]
+
+    async def send(self, client_id, message):
+        ws = self.sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            if isinstance(message, bytes):
+                await ws.send_bytes(message)
+            else:
+                await ws.send_str(json.dumps(message))
+        except ConnectionError:
+            pass
+
+    async def broadcast_status(self):
+        status = {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}}
+        for client_id in list(self.sockets):
+            await self.send(client_id, status)
+
+    def queue_remaining(self):
+        return len(self.running) + len(self.pending)
+
+    def output_size(self, prompt):
+        if self.args.image_size:
+            return parse_size(self.args.image_size)
+        for node in prompt.values():
+            inputs = node.get("inputs", {})
+            if isinstance(inputs.get("width"), int) and isinstance(inputs.get("height"), int):
+                return inputs["width"], inputs["height"]
+        for node in prompt.values():
+            if node["class_type"] == "LoadImage" and node["inputs"].get("image") in self.uploads:
+                return self.uploads[node["inputs"]["image"]]
+        return 512, 512
+
+    async def worker(self):
+        while True:
+            prompt_id, prompt, client_id = await self.queue.get()
+            self.pending.remove(prompt_id)
+            if prompt_id in self.deleted:
+                continue
+            self.running.add(prompt_id)
+            try:
+                await self.execute(prompt_id, prompt, client_id)
+            finally:
+                self.running.discard(prompt_id)
+                await self.broadcast_status()
+
+    async def execute(self, prompt_id, prompt, client_id):
+        await self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id, "timestamp": time.time()}})
+        missing = [node["inputs"]["image"] for node in prompt.values()
+                   if node["class_type"] in ("LoadImage", "LoadImageMask") and node["inputs"].get("image") not in self.uploads]
+        if missing:
+            self.stats["execution_errors"] += 1
+            await self.send(client_id, {"type": "execution_error", "data": {
+                "prompt_id": prompt_id, "exception_message": f"Invalid image file: {missing[0]}"}})
+            return
+
+        steps = next((n["inputs"]["steps"] for n in prompt.values() if isinstance(n.get("inputs", {}).get("steps"), int)), 20)
+        batch = next((n["inputs"]["batch_size"] for n in prompt.values()
+                      if isinstance(n.get("inputs", {}).get("batch_size"), int)), 1)
+        size = self.output_size(prompt)
+        preview = self.image((self.args.preview_size,) * 2, "JPEG") if self.args.preview_size else None
+        if self.args.load_seconds:
+            await asyncio.sleep(self.args.load_seconds)
+
+        outputs = {}
+        for node_id, node in prompt.items():
+            if prompt_id in self.interrupted:
+                break
+            class_type = node["class_type"]
+            await self.send(client_id, {"type": "executing", "data": {"node": node_id, "display_node": node_id,
+                                                                      "prompt_id": prompt_id}})
+            if class_type in SAMPLERS:
+                for step in range(steps):
+                    await asyncio.sleep(self.args.step_seconds)
+                    if prompt_id in self.interrupted:
+                        break
+                    await self.send(client_id, {"type": "progress", "data": {
+                        "value": step + 1, "max": steps, "prompt_id": prompt_id, "node": node_id}})
+                    if preview is not None:
+                        await self.send(client_id, struct.pack(">II", PREVIEW_IMAGE, FORMAT_JPEG) + preview)
+            elif class_type in OUTPUTS:
+                images = []
+                for i in range(batch):
+                    filename = f"ComfyUI_{prompt_id[:8]}_{node_id}_{i:05}_.png"
+                    self.outputs[filename] = self.image(size, "PNG")
+                    images.append({"filename": filename, "subfolder": "",
+                                   "type": "output" if class_type == "SaveImage" else "temp"})
+                outputs[node_id] = {"images": images}
+                await self.send(client_id, {"type": "executed", "data": {
+                    "node": node_id, "display_node": node_id, "output": {"images": images}, "prompt_id": prompt_id}})
+            elif class_type == "SaveImageWebsocket":
+                for _ in range(batch):
+                    await self.send(client_id, struct.pack(">II", PREVIEW_IMAGE, FORMAT_PNG) + self.image(size, "PNG"))
+
+        if prompt_id in self.interrupted:
+            await self.send(client_id, {"type": "execution_interrupted", "data": {"prompt_id": prompt_id}})
+            return
+        self.history[prompt_id] = {"prompt": [0, prompt_id, prompt, {}, list(outputs)], "outputs": outputs,
+                                   "status": {"status_str": "success", "completed": True, "messages": []}}
+        await self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+        await self.send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+
+    # HTTP API
+
+    async def prompt(self, request):
+        self.stats["prompt"] += 1
+        body = await request.json()
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        self.pending.append(prompt_id)
+        await self.queue.put((prompt_id, body["prompt"], body.get("client_id")))
+        await self.broadcast_status()
+        return web.json_response({"prompt_id": prompt_id, "number": self.stats["prompt"], "node_errors": {}})
+
+    async def ws(self, request):
+        self.stats["ws"] += 1
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or str(uuid.uuid4())
+        self.sockets[client_id] = ws
+        await ws.send_str(json.dumps({"type": "status", "data": {
+            "status": {"exec_info": {"queue_remaining": self.queue_remaining()}}, "sid": client_id}}))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            if self.sockets.get(client_id) is ws:
+                del self.sockets[client_id]
+        return ws
+
+    async def get_history(self, request):
+        self.stats["history"] += 1
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id is None:
+            return web.json_response(self.history)
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+
+    async def view(self, request):
+        self.stats["view"] += 1
+        data = self.outputs.get(request.query.get("filename"))
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/png")
+
+    async def upload_image(self, request):
+        self.stats["upload"] += 1
+        form = await request.post()
+        image = form["image"]
+        data = image.file.read()
+        name = image.filename
+        if name in self.uploads and form.get("overwrite") != "true":
+            stem, dot, ext = name.rpartition(".")
+            name = f"{stem} ({uuid.uuid4().hex[:4]}){dot}{ext}"
+        try:
+            self.uploads[name] = Image.open(io.BytesIO(data)).size
+        except Exception:
+            self.uploads[name] = (512, 512)
+        return web.json_response({"name": name, "subfolder": form.get("subfolder", ""), "type": "input"})
+
+    async def get_queue(self, request):
+        return web.json_response({"queue_running": [[0, prompt_id] for prompt_id in self.running],
+                                  "queue_pending": [[0, prompt_id] for prompt_id in self.pending]})
+
+    async def post_queue(self, request):
+        body = await request.json()
+        self.stats["queue_delete"] += len(body.get("delete", []))
+        self.deleted.update(body.get("delete", []))
+        return web.json_response({})
+
+    async def interrupt(self, request):
+        self.stats["interrupt"] += 1
+        body = await request.json() if request.can_read_body else {}
+        self.interrupted.update([body["prompt_id"]] if body.get("prompt_id") else self.running)
+        return web.json_response({})
+
+    async def system_stats(self, request):
+        return web.json_response({"system": {"os": "fake", "comfyui_version": "fake"}, "devices": []})
+
+    async def relay(self, request):
+        self.stats["relay"] += 1
+        await request.read()
+        if self.args.relay_seconds:
+            await asyncio.sleep(self.args.relay_seconds)
+        return web.json_response({"success": True})
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats, queue_remaining=self.queue_remaining()))
+
+
+def create_app(args):
+    fake = FakeComfy(args)
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post("/prompt", fake.prompt)
+    app.router.add_get("/ws", fake.ws)
+    app.router.add_get("/history", fake.get_history)
+    app.router.add_get("/history/{prompt_id}", fake.get_history)
+    app.router.add_get("/view", fake.view)
+    app.router.add_post("/upload/image", fake.upload_image)
+    app.router.add_get("/queue", fake.get_queue)
+    app.router.add_post("/queue", fake.post_queue)
+    app.router.add_post("/interrupt", fake.interrupt)
+    app.router.add_get("/system_stats", fake.system_stats)
+    app.router.add_post("/relay", fake.relay)
+    app.router.add_get("/stats", fake.get_stats)
+
+    async def start_workers(app):
+        app["workers"] = [asyncio.create_task(fake.worker()) for _ in range(args.workers)]
+
+    app.on_startup.append(start_workers)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--step-seconds", type=float, default=0.05, help="sampling time per step")
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="fixed time per prompt before sampling")
+    parser.add_argument("--image-size", help="WxH of every output (default: the workflow's latent or input size)")
+    parser.add_argument("--preview-size", type=int, default=256, help="edge of JPEG preview frames, 0 for none")
+    parser.add_argument("--workers", type=int, default=1, help="prompts executed at the same time (GPUs)")
+    parser.add_argument("--relay-seconds", type=float, default=0.0, help="latency of the /relay endpoint")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"Fake ComfyUI on port {args.port} ({args.step_seconds}s/step, {args.workers} worker(s))", flush=True)
+    web.run_app(create_app(args), port=args.port, print=None)
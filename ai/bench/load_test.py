@@ -0,0 +1,302 @@
+"""Load generator for the AI server: throughput and latency percentiles per route.
+
+Drives each route in turn with ``--concurrency`` requests in flight until
+``--requests`` have completed, and samples the CPU time and RSS of the AI
+server process (and its children) while it does. With ``--spawn`` it starts
+a fake ComfyUI (``fake_comfy.py``) and the given server itself, so a run
+needs nothing but this directory:
+
+    python bench/load_test.py --spawn main.py --concurrency 8 --requests 100
+    python bench/load_test.py --spawn aio_server.py --routes generate-image --steps 20
+    python bench/load_test.py --url http://localhost:3000 --pid 12345   # an already running server
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+from PIL import Image
+
+ROUTES = ("generate-image", "generate-with-preview", "edit-image", "inpaint-image")
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AI_DIR = os.path.dirname(BENCH_DIR)
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def noise_png(width, height):
+    buffered = io.BytesIO()
+    Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(buffered, format="PNG", compress_level=1)
+    return buffered.getvalue()
+
+
+def mask_png(width, height):
+    # Transparent except for an opaque rectangle in the middle, like the editor's brush masks
+    mask = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    mask.paste((255, 255, 255, 255), (width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+    buffered = io.BytesIO()
+    mask.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def data_url(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
+
+def payloads(args):
+    """JSON body per route, built once so the generator itself stays cheap."""
+    width, height = args.input_size
+    image = data_url(noise_png(width, height))
+    mask = data_url(mask_png(width, height))
+    common = {"prompt": "a lighthouse on a cliff at dusk", "steps": args.steps}
+    return {
+        "generate-image": dict(common, width=args.size, height=args.size),
+        "generate-with-preview": dict(common, socketId="bench"),
+        "edit-image": dict(common, image=image),
+        "inpaint-image": dict(common, image=image, mask=mask),
+    }
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class ProcessSampler:
+    """Samples CPU seconds and RSS of a process and its children from /proc (Linux only)."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.available = pid is not None and os.path.exists(f"/proc/{pid}/stat")
+        self._ticks = os.sysconf("SC_CLK_TCK") if self.available else 100
+        self._page = os.sysconf("SC_PAGE_SIZE") if self.available else 4096
+
+    def _tree(self):
+        pids, parents = [self.pid], {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        parents[int(entry)] = int(f.read().rpartition(")")[2].split()[1])
+                except (OSError, ValueError, IndexError):
+                    pass
+        for pid in pids:
+            pids.extend(child for child, parent in parents.items() if parent == pid)
+        return pids
+
+    def read(self):
+        """(CPU seconds, RSS bytes) summed over the process tree."""
+        cpu = rss = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rpartition(")")[2].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self._ticks
+                rss += int(fields[21]) * self._page
+            except (OSError, ValueError, IndexError):
+                pass
+        return cpu, rss
+
+    async def sample(self, stop):
+        """Runs until ``stop`` is set; returns (CPU seconds used, peak RSS bytes)."""
+        start_cpu, peak = self.read()
+        cpu = start_cpu
+        while not stop.is_set():
+            cpu, rss = self.read()
+            peak = max(peak, rss)
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        cpu, rss = self.read()
+        return cpu - start_cpu, max(peak, rss)
+
+
+async def one_request(session, url, body):
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=body) as response:
+            data = await response.read()
+            return time.perf_counter() - start, response.status, len(data)
+    except Exception as e:
+        return time.perf_counter() - start, type(e).__name__, 0
+
+
+async def run_route(session, args, route, body, sampler):
+    url = f"{args.url}/{route}"
+    for _ in range(args.warmup):
+        await one_request(session, url, body)
+
+    results = []
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            results.append(await one_request(session, url, body))
+
+    stop = asyncio.Event()
+    sampling = asyncio.create_task(sampler.sample(stop)) if sampler.available else None
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    cpu, rss = await sampling if sampling else (None, None)
+
+    latencies = sorted(latency for latency, status, _ in results if status == 200)
+    errors = {}
+    for _, status, _ in results:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    return {
+        "route": route,
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "bytes": sum(size for _, status, size in results if status == 200),
+        "cpu_percent": 100 * cpu / elapsed if cpu is not None and elapsed else None,
+        "rss_peak_mb": rss / 2 ** 20 if rss is not None else None,
+    }
+
+
+def print_report(results):
+    def ms(value):
+        return f"{value * 1000:9.1f}" if value is not None else f"{'-':>9}"
+
+    print(f"\n{'route':<24}{'ok/total':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mean ms':>9}"
+          f"{'cpu %':>8}{'rss MB':>8}")
+    for r in results:
+        cpu = f"{r['cpu_percent']:8.1f}" if r['cpu_percent'] is not None else f"{'-':>8}"
+        rss = f"{r['rss_peak_mb']:8.1f}" if r['rss_peak_mb'] is not None else f"{'-':>8}"
+        print(f"{r['route']:<24}{r['ok']:>5}/{r['requests']:<4}{r['throughput']:9.2f}{ms(r['p50'])}{ms(r['p95'])}"
+              f"{ms(r['p99'])}{ms(r['mean'])}{cpu}{rss}")
+        if r['errors']:
+            print(f"{'':<24}errors: {', '.join(f'{k} x{v}' for k, v in sorted(r['errors'].items()))}")
+
+
+async def run(args, pid):
+    bodies = payloads(args)
+    sampler = ProcessSampler(pid)
+    if not sampler.available:
+        print("CPU/RSS not sampled (pass --pid of the AI server, Linux only)")
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        results = []
+        for route in args.routes:
+            print(f"{route}: {args.requests} requests, {args.concurrency} concurrent ...", flush=True)
+            results.append(await run_route(session, args, route, bodies[route], sampler))
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"{process.args} did not listen on port {port} within {timeout}s")
+
+
+def spawn(args):
+    """Starts fake_comfy.py and the AI server; returns (processes, AI server pid)."""
+    comfy_port, ai_port = free_port(), free_port()
+    log = open(args.server_log, "wb") if args.server_log else subprocess.DEVNULL
+    comfy = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_comfy.py"), "--port", str(comfy_port),
+                              "--step-seconds", str(args.step_seconds), "--workers", str(args.comfy_workers)]
+                             + (["--image-size", args.image_size] if args.image_size else []),
+                             stdout=log, stderr=subprocess.STDOUT)
+    wait_for_port(comfy_port, comfy)
+    env = dict(os.environ, PORT=str(ai_port), COMFYUI_SERVER_ADDRESS=f"127.0.0.1:{comfy_port}",
+               PREVIEW_RELAY_URL=f"http://127.0.0.1:{comfy_port}/relay", PYTHONUNBUFFERED="1")
+    env.pop("COMFYUI_SERVER_ADDRESSES", None)
+    server = subprocess.Popen([sys.executable, args.spawn], cwd=AI_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(ai_port, server)
+    except RuntimeError:
+        for process in (server, comfy):
+            process.kill()
+        raise
+    args.url = f"http://127.0.0.1:{ai_port}"
+    return [server, comfy], server.pid
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:3000", help="AI server (ignored with --spawn)")
+    parser.add_argument("--spawn", metavar="SERVER", help="start fake ComfyUI and this server (main.py, aio_server.py)")
+    parser.add_argument("--pid", type=int, help="AI server process to sample CPU/RSS of (set by --spawn)")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma-separated routes to drive")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per route first")
+    parser.add_argument("--steps", type=int, default=4, help="sampler steps per request")
+    parser.add_argument("--size", type=int, default=512, help="generate-image width and height")
+    parser.add_argument("--input-size", type=parse_size, default=(1024, 1024), help="WxH of edit/inpaint inputs")
+    parser.add_argument("--timeout", type=float, default=300, help="per-request timeout in seconds")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to this file")
+    spawned = parser.add_argument_group("with --spawn")
+    spawned.add_argument("--step-seconds", type=float, default=0.05, help="fake sampling time per step")
+    spawned.add_argument("--comfy-workers", type=int, default=1, help="prompts the fake ComfyUI runs at once")
+    spawned.add_argument("--image-size", help="WxH of every fake output")
+    spawned.add_argument("--server-log", help="file for the output of both servers (default: discarded)")
+    args = parser.parse_args(argv)
+    args.routes = [route.strip().strip("/") for route in args.routes.split(",") if route.strip()]
+    unknown = set(args.routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    processes, pid = spawn(args) if args.spawn else ([], args.pid)
+    try:
+        results = asyncio.run(run(args, pid))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": args.url, "server": args.spawn, "concurrency": args.concurrency, "steps": args.steps,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from termcolor import colored
+
+from http_client import TIMEOUT, session as http
+from metrics import timed
+from tracing import in_context
+
+# Chunk size when piping a ComfyUI /view response to the client
+STREAM_CHUNK = int(os.getenv('STREAM_CHUNK_BYTES', 64 * 1024))
+# /view downloads run at once when a response needs several images (a batch)
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 8))
+
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+
+class OutputImage:
+    """An image in a ComfyUI server's output, fetched from /view only when it is used.
+
+    ``read()`` downloads it once and keeps the bytes (for the result cache,
+    uploads, multipart responses), also when several threads read it at the
+    same time. ``open()`` starts a streamed download so a route can pipe it to
+    the client without holding the whole file.
+    """
+
+    def __init__(self, address, filename, subfolder, folder_type):
+        self.address = address
+        self.params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.address}/view"
+
+    @property
+    def downloaded(self):
+        return self._data is not None
+
+    def read(self):
+        with self._lock:
+            if self._data is None:
+                print(colored(f"Downloading image: {self.params['filename']} from {self.address}.", "yellow"))
+                with timed("download", filename=self.params['filename']):
+                    response = http.get(self.url, params=self.params, timeout=TIMEOUT)
+                    response.raise_for_status()
+                    self._data = response.content
+        return self._data
+
+    def open(self):
+        """Returns a streaming ``requests.Response``; the caller iterates and closes it."""
+        response = http.get(self.url, params=self.params, timeout=TIMEOUT, stream=True)
+        response.raise_for_status()
+        return response
+
+
+class AsyncOutputImage:
+    """asyncio counterpart of OutputImage, downloading through an AsyncComfyClient."""
+
+    def __init__(self, client, filename, subfolder, folder_type):
+        self.client = client
+        self.params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        self._data = None
+        self._download = None
+
+    @property
+    def downloaded(self):
+        return self._data is not None
+
+    async def read(self):
+        if self._data is None:
+            # Concurrent readers share one download; a reader that is cancelled doesn't stop it
+            if self._download is None:
+                self._download = asyncio.ensure_future(
+                    self.client.get_image(self.params["filename"], self.params["subfolder"], self.params["type"]))
+            download = self._download
+            try:
+                self._data = await asyncio.shield(download)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if self._download is download:
+                    self._download = None
+                raise
+        return self._data
+
+    def open(self):
+        """Returns the aiohttp request context manager for a streamed /view download."""
+        return self.client.session.get(f"{self.client.base_url}/view", params=self.params)
+
+
+# Bytes of a result image, whether it came from the result cache (bytes) or ComfyUI (OutputImage)
+def read_image(image):
+    return image.read() if isinstance(image, OutputImage) else image
+
+
+# Bytes of several result images, downloading the missing ones concurrently
+def read_images(images):
+    pending = [image for image in images if isinstance(image, OutputImage) and not image.downloaded]
+    if len(pending) > 1:
+        for future in [_download_pool.submit(in_context(image.read)) for image in pending]:
+            future.result()
+    return [read_image(image) for image in images]
+
+
+async def read_image_async(image):
+    return await image.read() if isinstance(image, AsyncOutputImage) else image
+
+
+async def read_images_async(images):
+    return list(await asyncio.gather(*(read_image_async(image) for image in images)))
+
+
+# {node_id: [image dict]} of the image outputs in a /history entry or `executed` messages,
+# limited to output_nodes (None for all)
+def image_outputs(node_outputs, output_nodes=None):
+    return {node_id: output['images'] for node_id, output in node_outputs.items()
+            if (output_nodes is None or node_id in output_nodes) and (output or {}).get('images')}
+
+
+# Whether `executed` messages already named every output the caller wants; otherwise /history is asked
+def outputs_complete(outputs, output_nodes=None):
+    return bool(outputs) and (output_nodes is None or set(output_nodes) <= set(outputs))
+
+
+# The images callers actually use: those of the first output node that produced any
+def first_output(images):
+    for node_id in images or {}:
+        if images[node_id]:
+            return node_id, images[node_id]
+    return None, None
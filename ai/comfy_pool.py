@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from termcolor import colored
+
+from http_client import TIMEOUT, session as http
+
+# Seconds between /queue polls of every backend
+HEALTH_CHECK_INTERVAL = float(os.getenv('COMFYUI_HEALTH_INTERVAL', 5))
+
+
+# Comma-separated COMFYUI_SERVER_ADDRESSES, or the single COMFYUI_SERVER_ADDRESS.
+# Read on call rather than import so values loaded from .env are picked up.
+def server_addresses():
+    value = os.getenv('COMFYUI_SERVER_ADDRESSES') or os.getenv('COMFYUI_SERVER_ADDRESS', 'localhost:8188')
+    return [address.strip() for address in value.split(',') if address.strip()]
+
+
+# Number of prompts running or pending on a ComfyUI server, from its /queue response
+def queue_depth(queue_state):
+    return len(queue_state.get('queue_running', [])) + len(queue_state.get('queue_pending', []))
+
+
+def fetch_queue(backend):
+    response = http.get(f"http://{backend.address}/queue", timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+class Backend:
+    """Load and health bookkeeping for one ComfyUI server.
+
+    ``client`` is whatever talks to the server (a ComfyWebSocket for the
+    Flask app, an AsyncComfyClient for the aiohttp one) and must expose a
+    ``connected`` property.
+    """
+
+    def __init__(self, address, client):
+        self.address = address
+        self.client = client
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.external_depth = 0
+        self.healthy = True
+        self.leases = 0
+
+    @property
+    def available(self):
+        return self.healthy and self.client.connected
+
+    @property
+    def load(self):
+        # Our own jobs count immediately; the last /queue poll adds work queued by other clients
+        return self.in_flight + self.external_depth
+
+    def stats(self):
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "connected": self.client.connected,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "external_depth": self.external_depth,
+            "leases": self.leases,
+        }
+
+
+class BackendPool:
+    """Sends each job to the least-loaded healthy backend.
+
+    A lease pins one backend for everything a job does (uploads, queueing,
+    downloads) and counts towards its load until released.
+    """
+
+    def __init__(self, backends):
+        if not backends:
+            raise ValueError("At least one ComfyUI backend is required")
+        self.backends = list(backends)
+        self._lock = threading.Lock()
+
+    def acquire(self, backend=None):
+        with self._lock:
+            if backend is None:
+                candidates = [b for b in self.backends if b.available] or self.backends
+                # Fewest leases breaks ties, so idle backends take turns
+                backend = min(candidates, key=lambda b: (b.load, b.leases))
+            backend.in_flight += 1
+            backend.leases += 1
+            return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.in_flight -= 1
+
+    @contextmanager
+    def lease(self, backend=None):
+        backend = self.acquire(backend)
+        try:
+            yield backend
+        finally:
+            self.release(backend)
+
+    def record_check(self, backend, queue_state=None, error=None):
+        """Stores the outcome of a /queue poll; ``error`` marks the backend unhealthy."""
+        with self._lock:
+            was_healthy = backend.healthy
+            backend.healthy = error is None
+            if queue_state is not None:
+                backend.queue_depth = queue_depth(queue_state)
+                backend.external_depth = max(0, backend.queue_depth - backend.in_flight)
+        if was_healthy and error is not None:
+            print(colored(f"ComfyUI backend {backend.address} is unhealthy: {error}", "red"))
+        elif not was_healthy and error is None:
+            print(colored(f"ComfyUI backend {backend.address} is healthy again.", "green"))
+
+    def start_health_checks(self, interval=HEALTH_CHECK_INTERVAL):
+        """Polls every backend's /queue from a daemon thread."""
+        def run():
+            while True:
+                for backend in self.backends:
+                    try:
+                        self.record_check(backend, fetch_queue(backend))
+                    except Exception as e:
+                        self.record_check(backend, error=e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="comfy-health", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            return [backend.stats() for backend in self.backends]
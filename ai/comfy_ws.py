@@ -0,0 +1,275 @@
+import json
+import queue
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+import websocket  # websocket-client
+from termcolor import colored
+
+# Messages after which ComfyUI will send nothing more for a prompt
+TERMINAL_MESSAGES = ("execution_success", "execution_error", "execution_interrupted")
+
+# Binary frame event types (ComfyUI server.BinaryEventTypes). Every frame starts
+# with the event type as a 4-byte big-endian integer.
+PREVIEW_IMAGE = 1                # + 4-byte image format + image bytes
+UNENCODED_PREVIEW_IMAGE = 2      # converted to PREVIEW_IMAGE by the server before sending
+TEXT = 3                         # + 4-byte node id length + node id + text
+PREVIEW_IMAGE_WITH_METADATA = 4  # + 4-byte metadata length + metadata JSON + image bytes
+PREVIEW_EVENT_TYPES = (PREVIEW_IMAGE, PREVIEW_IMAGE_WITH_METADATA)
+
+# Image format codes used inside PREVIEW_IMAGE frames
+PREVIEW_FORMATS = {1: "image/jpeg", 2: "image/png", 3: "image/webp"}
+
+# ``image`` is a memoryview into the received frame, so parsing copies nothing
+PreviewFrame = namedtuple("PreviewFrame", "mimetype image metadata")
+
+
+def binary_event_type(frame):
+    if len(frame) < 4:
+        return None
+    return struct.unpack_from(">I", frame, 0)[0]
+
+
+def parse_preview_frame(frame, event_type=None):
+    """Parses a binary preview frame into a PreviewFrame, or None if it isn't one."""
+    if event_type is None:
+        event_type = binary_event_type(frame)
+    view = memoryview(frame)
+    try:
+        if event_type == PREVIEW_IMAGE:
+            image_format = struct.unpack_from(">I", frame, 4)[0]
+            return PreviewFrame(PREVIEW_FORMATS.get(image_format, "image/jpeg"), view[8:], None)
+        if event_type == PREVIEW_IMAGE_WITH_METADATA:
+            metadata = _frame_metadata(frame)
+            length = struct.unpack_from(">I", frame, 4)[0]
+            return PreviewFrame(metadata.get("image_type", "image/jpeg"), view[8 + length:], metadata)
+    except (struct.error, ValueError):
+        pass
+    return None
+
+
+def _frame_metadata(frame):
+    length = struct.unpack_from(">I", frame, 4)[0]
+    return json.loads(bytes(frame[8:8 + length]))
+
+
+class PromptWaiter:
+    """Receives the WebSocket events that belong to a single prompt.
+
+    Events are ``(kind, payload)`` tuples where ``kind`` is ``"json"`` (decoded
+    message dict), ``"preview"`` (a :class:`PreviewFrame`, only delivered when
+    ``previews`` is set), ``"output"`` (``(node_id, PreviewFrame)``, an image
+    sent by one of the ``outputs`` nodes, e.g. SaveImageWebsocket) or
+    ``"reconnected"`` (the shared connection dropped and came back, so events
+    may have been missed).
+    """
+
+    def __init__(self, prompt_id, previews=False, outputs=()):
+        self.prompt_id = prompt_id
+        self.previews = previews
+        self.outputs = outputs
+        self.events = queue.Queue()
+
+    def put(self, event):
+        self.events.put(event)
+
+    def get(self, timeout=None):
+        return self.events.get(timeout=timeout)
+
+
+class PromptRouter:
+    """Routes ComfyUI WebSocket frames to the waiter registered for their prompt.
+
+    Plain preview frames carry no prompt id, so they go to the prompt ComfyUI
+    last reported as executing; metadata-wrapped previews name their prompt.
+    Image frames sent while one of a waiter's ``outputs`` nodes is executing
+    are its results and are always delivered. Frames nobody wants (text
+    frames, previews for waiters that didn't ask for them) are dropped after
+    reading the 4-byte event type. Shared by the threaded and asyncio clients;
+    ``waiter_factory`` decides what kind of queue each waiter uses.
+    """
+
+    def __init__(self, waiter_factory=PromptWaiter, unclaimed_limit=64):
+        self.waiter_factory = waiter_factory
+        self.unclaimed_limit = unclaimed_limit
+        self._waiters = {}
+        # Events that arrived before anyone registered for their prompt id
+        self._unclaimed = OrderedDict()
+        self._executing_prompt = None
+        self._executing_node = None
+        self._lock = threading.Lock()
+
+    def register(self, prompt_id, previews=False, outputs=()):
+        waiter = self.waiter_factory(prompt_id, previews, outputs)
+        with self._lock:
+            self._waiters[prompt_id] = waiter
+            for event in self._unclaimed.pop(prompt_id, ()):
+                waiter.put(event)
+        return waiter
+
+    def unregister(self, prompt_id):
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+
+    def dispatch_text(self, out):
+        try:
+            message = json.loads(out)
+        except ValueError:
+            return
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        msg_type = message.get('type')
+
+        with self._lock:
+            if msg_type == 'execution_start' or (msg_type == 'executing' and data.get('node') is not None):
+                self._executing_prompt = prompt_id
+                self._executing_node = data.get('node')
+            elif msg_type in TERMINAL_MESSAGES or (msg_type == 'executing' and data.get('node') is None):
+                if self._executing_prompt == prompt_id:
+                    self._executing_prompt = None
+                    self._executing_node = None
+
+            if prompt_id is None:
+                # e.g. older ComfyUI builds omit prompt_id on progress messages
+                prompt_id = self._executing_prompt
+            if prompt_id is not None:
+                self._deliver(prompt_id, ("json", message))
+
+    def dispatch_binary(self, out):
+        event_type = binary_event_type(out)
+        if event_type not in PREVIEW_EVENT_TYPES:
+            return
+        with self._lock:
+            prompt_id, node_id = self._executing_prompt, self._executing_node
+            if event_type == PREVIEW_IMAGE_WITH_METADATA:
+                try:
+                    metadata = _frame_metadata(out)
+                except (struct.error, ValueError):
+                    return
+                prompt_id = metadata.get("prompt_id", prompt_id)
+                node_id = metadata.get("node_id", node_id)
+            waiter = self._waiters.get(prompt_id)
+        if waiter is None:
+            return
+        if node_id in waiter.outputs:
+            frame = parse_preview_frame(out, event_type)
+            if frame is not None:
+                waiter.put(("output", (node_id, frame)))
+            return
+        if not waiter.previews:
+            return
+        frame = parse_preview_frame(out, event_type)
+        if frame is not None:
+            waiter.put(("preview", frame))
+
+    def broadcast(self, event):
+        with self._lock:
+            for waiter in self._waiters.values():
+                waiter.put(event)
+
+    def _deliver(self, prompt_id, event):
+        # Caller holds self._lock
+        waiter = self._waiters.get(prompt_id)
+        if waiter is not None:
+            waiter.put(event)
+            return
+        self._unclaimed.setdefault(prompt_id, []).append(event)
+        self._unclaimed.move_to_end(prompt_id)
+        while len(self._unclaimed) > self.unclaimed_limit:
+            self._unclaimed.popitem(last=False)
+
+
+class ComfyWebSocket:
+    """One long-lived, auto-reconnecting ComfyUI WebSocket shared by all requests.
+
+    A background reader thread owns the socket and hands every frame to a
+    :class:`PromptRouter`, which forwards it to the waiter for its prompt.
+    """
+
+    def __init__(self, server_address, client_id, connect_timeout=10, max_backoff=10, unclaimed_limit=64):
+        self.server_address = server_address
+        self.client_id = client_id
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.router = PromptRouter(PromptWaiter, unclaimed_limit)
+
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._closing = threading.Event()
+        self._thread = None
+        self._ws = None
+
+    @property
+    def url(self):
+        return f"ws://{self.server_address}/ws?clientId={self.client_id}"
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def start(self, wait=True):
+        """Starts the reader thread if needed. Returns True once connected."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing.clear()
+                self._thread = threading.Thread(target=self._run, name="comfy-ws-reader", daemon=True)
+                self._thread.start()
+        if wait:
+            return self._connected.wait(self.connect_timeout)
+        return self.connected
+
+    def close(self):
+        self._closing.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def register(self, prompt_id, previews=False, outputs=()):
+        return self.router.register(prompt_id, previews, outputs)
+
+    def unregister(self, prompt_id):
+        self.router.unregister(prompt_id)
+
+    def _run(self):
+        backoff = 1
+        while not self._closing.is_set():
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(self.url, timeout=self.connect_timeout)
+                ws.settimeout(None)
+            except Exception as e:
+                print(colored(f"Failed to connect to WebSocket {self.url}: {e}. Retrying in {backoff}s.", "red"))
+                self._closing.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            reconnect = self._ws is not None
+            self._ws = ws
+            self._connected.set()
+            backoff = 1
+            print(colored(f"WebSocket connected to {self.url}", "green"))
+            if reconnect:
+                self.router.broadcast(("reconnected", None))
+
+            try:
+                while not self._closing.is_set():
+                    out = ws.recv()
+                    if isinstance(out, str):
+                        self.router.dispatch_text(out)
+                    elif out:
+                        self.router.dispatch_binary(out)
+            except Exception as e:
+                if not self._closing.is_set():
+                    print(colored(f"WebSocket connection lost: {e}. Reconnecting.", "yellow"))
+            finally:
+                self._connected.clear()
+                try:
+                    ws.close()
+                except Exception:
+                    pass
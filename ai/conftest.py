@@ -0,0 +1,8 @@
+import os
+
+# Never reach a real ComfyUI server from the tests; nothing listens on the discard port
+os.environ["COMFYUI_SERVER_ADDRESS"] = "127.0.0.1:9"
+os.environ.pop("COMFYUI_SERVER_ADDRESSES", None)
+
+# Manual scripts that send requests to a running server as soon as they are imported
+collect_ignore = ["test_new_api.py", "verify_server.py", "bench"]
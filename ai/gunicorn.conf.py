@@ -0,0 +1,62 @@
+# Multi-process production serving for the AI server:
+#
+#     gunicorn -c gunicorn.conf.py main:app
+#     gunicorn -c gunicorn.conf.py 'aio_server:create_app()' --worker-class aiohttp.GunicornWebWorker
+#
+# Every worker imports the app itself (no preload), so each has its own ComfyUI client ID,
+# WebSocket, backend pool and thread pools. The job table, the result cache, finished traces
+# and metric values are shared through directories on local disk, so a job can be polled and a
+# trace looked up through any worker, and /metrics (scraped from any one worker) covers them all.
+import glob
+import multiprocessing
+import os
+import sys
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', 3000)}"
+# Worker processes; ingest, masks and image encoding then use every core
+workers = int(os.getenv('AI_WORKERS', os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count())))
+# Requests mostly wait on ComfyUI, so each (Flask) worker serves many at once from a thread pool
+worker_class = "gthread"
+threads = int(os.getenv('AI_WORKER_THREADS', 32))
+# Seconds a stopping worker gets to finish its requests and background jobs
+graceful_timeout = int(os.getenv('AI_GRACEFUL_TIMEOUT', 300))
+keepalive = 5
+# Never import the app in the master: forked workers would share its client ID and threads
+preload_app = False
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+# Shared by the workers of this host
+SHARED_DIR = os.getenv('AI_SHARED_DIR', os.path.join(tempfile.gettempdir(), f"ai-server-{os.getenv('PORT', 3000)}"))
+
+
+def on_starting(server):
+    # Workers read these when they import the app, after the fork
+    os.environ.setdefault('JOB_DIR', os.path.join(SHARED_DIR, "jobs"))
+    os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(SHARED_DIR, "results"))
+    os.environ.setdefault('TRACE_DIR', os.path.join(SHARED_DIR, "traces"))
+    os.environ.setdefault('METRICS_DIR', os.path.join(SHARED_DIR, "metrics"))
+    # Counters restart with the server; snapshots of a previous run's workers would be added in
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], "*.json")):
+        os.remove(path)
+    if workers > 1 and os.environ.pop('COMFYUI_INPUT_DIR', None):
+        # Upload references are counted per worker, so one worker could delete a file another still uses
+        server.log.warning("COMFYUI_INPUT_DIR ignored with several workers: evicted uploads are forgotten, not deleted")
+    server.log.info(f"Sharing jobs, results, traces and metrics between workers under {SHARED_DIR}")
+
+
+def post_worker_init(worker):
+    # The asyncio app warms up in its own on_startup hook
+    main = sys.modules.get("main")
+    if main is not None:
+        main.warm_up()
+
+
+def worker_exit(server, worker):
+    main = sys.modules.get("main")
+    if main is not None:
+        main.shut_down()
+    # The worker's final counts stay in /metrics after it has gone
+    metrics = sys.modules.get("metrics")
+    if metrics is not None and metrics.METRICS_DIR:
+        metrics.flush()
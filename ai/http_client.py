@@ -0,0 +1,43 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Explicit (connect, read) timeouts for every call to ComfyUI and the relay
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 60))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+RELAY_TIMEOUT = (CONNECT_TIMEOUT, float(os.getenv('RELAY_READ_TIMEOUT', 5)))
+
+# Retries apply to connection failures on any call, and to read errors and
+# 502/503/504 responses only on idempotent methods (GET/HEAD).
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.2))
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+
+# Keep-alive connections kept per host; should cover the number of request threads
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 32))
+
+
+def create_session(pool_size=POOL_SIZE, retries=HTTP_RETRIES):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        allowed_methods=IDEMPOTENT_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=RETRY_BACKOFF,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by every request thread in the process
+session = create_session()
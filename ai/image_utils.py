@@ -0,0 +1,179 @@
+import base64
+import binascii
+import io
+import os
+import struct
+import uuid
+
+from PIL import Image, ImageOps
+from termcolor import colored
+
+PREVIEW_SIZE = (256, 256)
+# Preview frames no larger than this are relayed as-is, without decode/re-encode
+PREVIEW_PASSTHROUGH_SIZE = int(os.getenv('PREVIEW_PASSTHROUGH_SIZE', max(PREVIEW_SIZE)))
+
+# Opt-in: uploads with at least this many times the pixels their workflow scales them to are
+# downscaled before upload (0, the default, always uploads the original). Only the geometry
+# is preserved: Pillow's filters are not ComfyUI's upscale kernels, so pixels differ slightly
+PRESCALE_MIN_FACTOR = float(os.getenv('PRESCALE_MIN_FACTOR', 0))
+
+# ComfyUI upscale_method -> the closest Pillow filter (same size, not the same pixels)
+_RESAMPLE = {
+    "nearest-exact": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "area": Image.Resampling.BOX,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start-of-frame markers (all except DHT/JPG/DAC, which share the 0xC? range)
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+# Decode a base64 string or data URL ("data:image/png;base64,....") into bytes.
+# Only the payload after the data URL header is copied, and decoded in one pass.
+def decode_base64_image(value):
+    start = value.find(",") + 1
+    return binascii.a2b_base64(value[start:] if start else value)
+
+
+def probe_image(image_data):
+    """Reads (format, width, height) from PNG/JPEG/WebP headers without decoding.
+
+    Returns None when the format isn't recognised or the header is truncated.
+    """
+    view = memoryview(image_data)
+    try:
+        if view[:8] == _PNG_SIGNATURE:
+            width, height = struct.unpack_from(">II", view, 16)
+            return "PNG", width, height
+        if view[:2] == b'\xff\xd8':
+            i = 2
+            while i + 9 <= len(view):
+                if view[i] != 0xFF:
+                    return None
+                marker = view[i + 1]
+                if marker == 0xFF:
+                    i += 1
+                    continue
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    i += 2
+                    continue
+                if marker in _JPEG_SOF_MARKERS:
+                    height, width = struct.unpack_from(">HH", view, i + 5)
+                    return "JPEG", width, height
+                i += 2 + struct.unpack_from(">H", view, i + 2)[0]
+            return None
+        if view[:4] == b'RIFF' and view[8:12] == b'WEBP':
+            chunk = view[12:16].tobytes()
+            if chunk == b'VP8X':
+                return "WEBP", 1 + int.from_bytes(view[24:27], "little"), 1 + int.from_bytes(view[27:30], "little")
+            if chunk == b'VP8 ':
+                width, height = struct.unpack_from("<HH", view, 26)
+                return "WEBP", width & 0x3FFF, height & 0x3FFF
+            if chunk == b'VP8L':
+                bits = int.from_bytes(view[21:25], "little")
+                return "WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    except struct.error:
+        pass
+    return None
+
+
+# (width, height) from the header; PIL is only consulted for formats probe_image doesn't know
+def image_size(image_data):
+    info = probe_image(image_data)
+    if info is not None:
+        return info[1], info[2]
+    return Image.open(io.BytesIO(image_data)).size
+
+
+def prescale_image(image_data, scale):
+    """Downscales an oversized upload to what its workflow's scaling node would make of it.
+
+    ``scale`` is the ``workflows.InputScale`` the input goes through (or None).
+    The new size is one the node maps to the same output size, so ComfyUI
+    produces the same geometry from far fewer uploaded and decoded pixels.
+    The pixels are not identical: the downscale is done with the closest
+    Pillow filter, not ComfyUI's kernel. Off unless PRESCALE_MIN_FACTOR is set.
+    Returns ``(image bytes, (width, height))``, unchanged if not worth scaling.
+    """
+    size = image_size(image_data)
+    if scale is None or not PRESCALE_MIN_FACTOR:
+        return image_data, size
+    target = scale.output_size(*size)
+    if size[0] * size[1] < target[0] * target[1] * PRESCALE_MIN_FACTOR:
+        return image_data, size
+    try:
+        # LoadImage applies the EXIF orientation, so the node sees the transposed size
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_data)))
+        new_size = scale.prescale_size(*img.size)
+        if new_size is None or img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            return image_data, size
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        original = img.size
+        img = img.resize(new_size, _RESAMPLE.get(scale.method, Image.Resampling.LANCZOS))
+        buffered = io.BytesIO()
+        img.save(buffered, format="PNG", compress_level=1)
+        print(colored(f"📉 [AI Server] Pre-scaled input from {original[0]}x{original[1]} to {new_size[0]}x{new_size[1]}", "cyan"))
+        return buffered.getvalue(), new_size
+    except Exception as e:
+        print(colored(f"⚠️ [AI Server] Pre-scaling failed, uploading original: {e}", "yellow"))
+        return image_data, size
+
+
+# Downscale an image and return it as a data URL suitable for the preview relay
+def thumbnail_data_url(image_data, format="JPEG"):
+    img = Image.open(io.BytesIO(image_data))
+    img.thumbnail(PREVIEW_SIZE)
+    if format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buffered = io.BytesIO()
+    if format == "JPEG":
+        img.save(buffered, format="JPEG", quality=70)
+    else:
+        img.save(buffered, format=format)
+    b64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return f"data:image/{format.lower()};base64,{b64_image}"
+
+
+def raw_data_url(image_data, mimetype="image/jpeg"):
+    return f"data:{mimetype};base64,{base64.b64encode(image_data).decode('utf-8')}"
+
+
+# Build the relay data URL for a parsed comfy_ws.PreviewFrame. Small JPEGs are
+# forwarded untouched; anything else is downscaled, falling back to the raw bytes.
+def preview_frame_data_url(frame):
+    if frame.mimetype == "image/jpeg":
+        probed = probe_image(frame.image)
+        if probed and max(probed[1], probed[2]) <= PREVIEW_PASSTHROUGH_SIZE:
+            return raw_data_url(frame.image, frame.mimetype)
+    try:
+        # Downscale for efficiency
+        return thumbnail_data_url(frame.image, "JPEG")
+    except Exception as e:
+        print(colored(f"⚠️ PIL downscale failed, falling back to raw: {e}", "yellow"))
+        return raw_data_url(frame.image, frame.mimetype)
+
+
+# Several PNGs as one multipart/mixed body; returns (body, content type)
+def multipart_images(images, filenames):
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for image_data, filename in zip(images, filenames):
+        out.write(f"--{boundary}\r\nContent-Type: image/png\r\n"
+                  f"Content-Disposition: inline; filename=\"{filename}\"\r\n"
+                  f"Content-Length: {len(image_data)}\r\n\r\n".encode())
+        out.write(image_data)
+        out.write(b"\r\n")
+    out.write(f"--{boundary}--\r\n".encode())
+    return out.getvalue(), f"multipart/mixed; boundary={boundary}"
+
+
+# generated-1.png -> generated-1-0.png, generated-1-1.png, ... for the images of a batch
+def batch_filenames(download_name, count):
+    if count == 1:
+        return [download_name]
+    stem, dot, ext = download_name.rpartition(".")
+    return [f"{stem}-{i}{dot}{ext}" for i in range(count)]
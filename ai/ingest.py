@@ -0,0 +1,69 @@
+import os
+import queue
+import random
+import threading
+
+from termcolor import colored
+
+# Fraction of requests whose inputs are written to DEBUG_CAPTURE_DIR (0 = never, 1 = every request)
+DEBUG_CAPTURE_RATE = float(os.getenv('DEBUG_CAPTURE_RATE', 0))
+DEBUG_CAPTURE_DIR = os.getenv('DEBUG_CAPTURE_DIR', '.')
+# Captures waiting to be written; more than this and new ones are dropped
+DEBUG_CAPTURE_QUEUE = int(os.getenv('DEBUG_CAPTURE_QUEUE', 8))
+
+
+# A bare image/* request body; its parameters (prompt, steps, seed) come in the query string
+def is_raw_image(content_type):
+    return (content_type or "").startswith("image/")
+
+
+class DebugSink:
+    """Writes a sample of request inputs to disk from a background thread.
+
+    Requests never wait on the disk: captures are queued and dropped when the
+    writer falls behind. Each name (e.g. ``debug_image.png``) holds the most
+    recent sample.
+    """
+
+    def __init__(self, rate=DEBUG_CAPTURE_RATE, directory=DEBUG_CAPTURE_DIR, max_pending=DEBUG_CAPTURE_QUEUE):
+        self.rate = rate
+        self.directory = directory
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def capture(self, files):
+        """Queues ``{filename: bytes}`` for writing if this request is sampled."""
+        if not self.enabled or random.random() >= self.rate:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(files)
+        except queue.Full:
+            pass
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="debug-sink", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            files = self._queue.get()
+            try:
+                for name, data in files.items():
+                    with open(os.path.join(self.directory, name), "wb") as f:
+                        f.write(data)
+                print(colored(f"💾 [AI Server] Saved debug inputs: {', '.join(files)}", "magenta"))
+            except Exception as e:
+                print(colored(f"⚠️ [AI Server] Failed to save debug inputs: {e}", "yellow"))
+
+
+# Shared by every request in the process
+debug_sink = DebugSink()
@@ -0,0 +1,351 @@
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from process_utils import process_alive
+
+# Finished jobs (and their result bytes) are kept this many seconds for polling/retries
+JOB_TTL = float(os.getenv('JOB_TTL', 600))
+# Upper bound on jobs held in memory, running or finished
+MAX_JOBS = int(os.getenv('MAX_JOBS', 256))
+# Directory shared by the worker processes of one host; with it, a job can be polled, streamed
+# and fetched through any worker, not just the one running it. Unset keeps jobs in memory only.
+JOB_DIR = os.getenv('JOB_DIR', '')
+# How often a job owned by another worker is re-read while someone waits on it, in seconds
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 0.25))
+# Progress-only updates are written to JOB_DIR at most this often, in seconds; status changes always are
+JOB_SAVE_INTERVAL = float(os.getenv('JOB_SAVE_INTERVAL', 0.5))
+# Seconds between sweeps of JOB_DIR for expired jobs, including those of workers that have exited
+JOB_SWEEP_INTERVAL = float(os.getenv('JOB_SWEEP_INTERVAL', 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+# The job whose work is running in the current thread/task, if any
+current_job = contextvars.ContextVar("current_job", default=None)
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class JobError(Exception):
+    """A job failed in an expected way; the message is reported to the caller as-is."""
+
+
+class Job:
+    """State of one asynchronous request. Updates wake status streams via a condition and listeners."""
+
+    def __init__(self, kind, directory=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.progress = None
+        self.node = None
+        self.error = None
+        self.result = None
+        self.download_name = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        # Where the state is mirrored for the other workers (see JOB_DIR)
+        self.directory = directory
+        self._saved_status = None
+        self._saved_at = 0.0
+
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def update(self, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            if self.status in FINISHED and self.finished is None:
+                self.finished = time.time()
+            self.version += 1
+            if self.directory and self._save_due():
+                self._save()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def _save_due(self):
+        # Caller holds self._cond. A sampler reports progress every step; one write per step would be wasted
+        return self.status != self._saved_status or time.monotonic() - self._saved_at >= JOB_SAVE_INTERVAL
+
+    def _save(self):
+        # Caller holds self._cond
+        state = dict(self.to_dict(), downloadName=self.download_name, version=self.version, pid=os.getpid(),
+                     results=len(self.result) if self.result is not None else 0)
+        _write_file(_state_path(self.directory, self.id), json.dumps(state).encode())
+        self._saved_status = self.status
+        self._saved_at = time.monotonic()
+
+    def succeed(self, image_data, download_name):
+        if self.directory:
+            # Written before the state says "succeeded", so other workers never see missing images
+            for index, data in enumerate(image_data):
+                _write_file(_result_path(self.directory, self.id, index), data)
+        self.update(status=SUCCEEDED, result=image_data, download_name=download_name)
+
+    def fail(self, message):
+        self.update(status=FAILED, error=message)
+
+    def wait_for_change(self, version, timeout=None):
+        """Blocks until the job moves past ``version``; returns the current version."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    # Called (from any thread) after every update, e.g. to wake an asyncio stream
+    def add_listener(self, listener):
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def to_dict(self):
+        with self._cond:
+            return {
+                "jobId": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "progress": self.progress,
+                "node": self.node,
+                "error": self.error,
+                "created": self.created,
+                "finished": self.finished,
+            }
+
+
+def _state_path(directory, job_id):
+    return os.path.join(directory, f"{job_id}.json")
+
+
+def _result_path(directory, job_id, index):
+    return os.path.join(directory, f"{job_id}-{index}.png")
+
+
+def _write_file(path, data):
+    # Readers in other processes only ever see a complete file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove_job_files(directory, job_id, results):
+    for path in [_result_path(directory, job_id, i) for i in range(results)] + [_state_path(directory, job_id)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _ResultFiles(Sequence):
+    """The images of a job finished by another worker, read from JOB_DIR when used."""
+
+    def __init__(self, directory, job_id, count):
+        self.directory = directory
+        self.job_id = job_id
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        with open(_result_path(self.directory, self.job_id, index), "rb") as f:
+            return f.read()
+
+
+class SharedJob(Job):
+    """A job owned by another worker process, as last written to its state file in JOB_DIR.
+
+    ``refresh`` picks up the owner's updates; ``wait_for_change`` and
+    listeners poll for them every JOB_POLL_INTERVAL. A job whose owner
+    exited before finishing reads as failed.
+    """
+
+    def __init__(self, directory, job_id):
+        super().__init__(None)
+        self.id = job_id
+        self._shared_directory = directory
+        self._mtime = None
+        self._poller = None
+
+    @classmethod
+    def load(cls, directory, job_id):
+        job = cls(directory, job_id)
+        return job if job.refresh() else None
+
+    def refresh(self):
+        """Re-reads the state file if it changed; False when it is gone (the job expired)."""
+        path = _state_path(self._shared_directory, self.id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self._mtime:
+                self._check_owner()
+                return True
+            with open(path, "rb") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        result = None
+        if state["status"] == SUCCEEDED:
+            result = _ResultFiles(self._shared_directory, self.id, state["results"])
+        self._apply(state["version"], kind=state["kind"], status=state["status"], progress=state["progress"],
+                    node=state["node"], error=state["error"], created=state["created"], finished=state["finished"],
+                    download_name=state["downloadName"], result=result, owner=state["pid"])
+        self._mtime = mtime
+        self._check_owner()
+        return True
+
+    def _check_owner(self):
+        if self.status not in FINISHED and not process_alive(self.owner):
+            self._apply(self.version + 1, status=FAILED, error="The worker running this job exited", finished=time.time())
+
+    def _apply(self, version, **fields):
+        with self._cond:
+            if version == self.version:
+                return
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version = version
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def _expire(self):
+        if self.status not in FINISHED:
+            self._apply(self.version + 1, status=FAILED, error="Job expired", finished=time.time())
+
+    def wait_for_change(self, version, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if not self.refresh():
+                self._expire()
+            if self.version != version:
+                return self.version
+            wait = JOB_POLL_INTERVAL if deadline is None else min(JOB_POLL_INTERVAL, deadline - time.monotonic())
+            if wait <= 0:
+                return self.version
+            time.sleep(wait)
+
+    def add_listener(self, listener):
+        super().add_listener(listener)
+        with self._cond:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name=f"job-poll-{self.id[:8]}", daemon=True)
+                self._poller.start()
+
+    def _poll(self):
+        # Refreshes while anyone listens, so listeners fire as the owner's updates land
+        while True:
+            with self._cond:
+                if not self._listeners or self.status in FINISHED:
+                    self._poller = None
+                    return
+            time.sleep(JOB_POLL_INTERVAL)
+            if not self.refresh():
+                self._expire()
+
+
+class JobTable:
+    """Bounded job table; finished jobs expire ``ttl`` seconds after finishing.
+
+    With a ``directory`` (JOB_DIR), every job's state and images are also
+    written there, so ``get`` finds jobs run by other worker processes too.
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, ttl=JOB_TTL, directory=JOB_DIR):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.directory = directory or None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def create(self, kind):
+        """Returns a new queued job, or None when the table is full of unfinished jobs."""
+        with self._lock:
+            self._evict()
+            if len(self._jobs) >= self.max_jobs:
+                oldest_finished = next((j for j in self._jobs.values() if j.status in FINISHED), None)
+                if oldest_finished is None:
+                    return None
+                self._forget(oldest_finished)
+            job = Job(kind, self.directory)
+            self._jobs[job.id] = job
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+        if job is None and self.directory and _JOB_ID.match(job_id):
+            return SharedJob.load(self.directory, job_id)
+        return job
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+    def _evict(self):
+        # Caller holds self._lock
+        cutoff = time.time() - self.ttl
+        for job in [j for j in self._jobs.values() if j.finished is not None and j.finished < cutoff]:
+            self._forget(job)
+        if self.directory and time.monotonic() - self._last_sweep > JOB_SWEEP_INTERVAL:
+            self._last_sweep = time.monotonic()
+            threading.Thread(target=self._sweep, args=(cutoff,), name="job-sweep", daemon=True).start()
+
+    def _forget(self, job):
+        # Caller holds self._lock
+        del self._jobs[job.id]
+        if self.directory:
+            _remove_job_files(self.directory, job.id, len(job.result) if job.result is not None else 0)
+
+    def _sweep(self, cutoff):
+        # Expired jobs of any worker, and those left behind by workers that exited
+        for entry in os.scandir(self.directory):
+            job_id, _, ext = entry.name.partition(".")
+            if ext != "json" or not _JOB_ID.match(job_id):
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                job = SharedJob.load(self.directory, job_id)
+            except OSError:
+                continue
+            if job is not None and job.status in FINISHED:
+                _remove_job_files(self.directory, job_id, len(job.result) if job.result is not None else 0)
+
+
+# Forward ComfyUI progress to the job running in this context (no-op outside jobs)
+def report_progress(value=None, maximum=None, node=None):
+    job = current_job.get()
+    if job is None:
+        return
+    if value is not None and maximum:
+        job.update(status=RUNNING, progress={"value": value, "max": maximum}, node=node)
+    else:
+        job.update(status=RUNNING, node=node)
@@ -1,418 +1,604 @@
-import websocket  # websocket-client
 import uuid
 import json
-import urllib.request
-import urllib.parse
-import random
-from PIL import Image
 import io
 from termcolor import colored
 from dotenv import load_dotenv
 import os
-from flask import Flask, request, send_file, jsonify
+import time
+from flask import Flask, Response, g, request, send_file, jsonify
 from flask_cors import CORS
-import requests
-import base64
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from comfy_outputs import (STREAM_CHUNK, OutputImage, first_output, image_outputs, outputs_complete, read_image,
+                           read_images)
+from comfy_pool import Backend, BackendPool, server_addresses
+from comfy_ws import ComfyWebSocket
+from http_client import TIMEOUT, session as http
+from ingest import debug_sink, is_raw_image
+from jobs import FINISHED, RUNNING, SUCCEEDED, JobError, JobTable, current_job, report_progress
+from masks import prepare_mask
+from metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, PromptTimer, job_failures, jobs_in_flight, observe_stage, preview_queue_depth,
+    render_metrics, request_errors, share_stats, stage_seconds, timed, worker_stats,
+)
+from micro_batch import MicroBatcher
+from preview_relay import PreviewRelay, output_preview
+from result_cache import cache_key, content_digest, result_cache, result_key
+from single_flight import SingleFlight
+from upload_store import upload_name, upload_store
+from tracing import TRACE_HEADER, begin_trace, end_trace, in_context, span, start_span, trace_store, use_span
+from url_fetch import FetchError, fetch, url_cache
+from image_utils import (
+    batch_filenames, decode_base64_image, image_size, multipart_images, prescale_image, preview_frame_data_url,
+    thumbnail_data_url,
+)
+from workflows import (
+    REFINE_SINGLE_GRAPH, WorkflowError, build_batch_graph, build_refinement_graph, input_scale, optimize_resolution,
+    parse_count, parse_seed, parse_steps, prompt_request_body, random_seed, refinement_seeds, registry, snap_to_bucket,
+    websocket_outputs,
+)
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
+# Every request is traced, continuing the caller's trace id; the root span ends once the body is sent
+@app.before_request
+def start_request_trace():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace_span, g.trace_token = begin_trace(f"{request.method} {route}", request.headers,
+                                              **{"http.method": request.method, "http.target": request.path})
+
+@app.after_request
+def finish_request_trace(response):
+    trace_span = g.get('trace_span')
+    if trace_span is not None:
+        trace_span.set(**{"http.status_code": response.status_code})
+        response.headers[TRACE_HEADER] = trace_span.trace.trace_id
+        response.call_on_close(trace_span.end)
+    return response
+
+@app.teardown_request
+def reset_request_trace(error=None):
+    if g.get('trace_token') is not None:
+        if error is not None:
+            g.trace_span.fail(error)
+        end_trace(g.trace_token)
+
+# Request timing for /metrics: "ingest" is measured from here, "response" until the image body is sent
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_response_metrics(response):
+    if response.status_code >= 400:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_errors.inc(route=route, status=response.status_code)
+    if response.mimetype == 'image/png' or response.mimetype.startswith('multipart/'):
+        response_span = start_span("response")
+        started = time.monotonic()
+
+        def record_response():
+            stage_seconds.observe(time.monotonic() - started, stage="response")
+            if response_span is not None:
+                response_span.end()
+
+        response.call_on_close(record_response)
+    return response
+
 # Step 1: Initialize the connection settings and load environment variables
 print(colored("Step 1: Initialize the connection settings and load environment variables.", "cyan"))
 print(colored("Loading configuration from the .env file.", "yellow"))
 load_dotenv()
 
-# Get server address from environment variable, default to "localhost:8188" if not set
-server_address = os.getenv('COMFYUI_SERVER_ADDRESS', 'localhost:8188')
+# ComfyUI servers from COMFYUI_SERVER_ADDRESSES (or COMFYUI_SERVER_ADDRESS), default "localhost:8188".
+# One client ID (and so one WebSocket per server) per process: gunicorn workers import this module themselves.
 client_id = str(uuid.uuid4())
 
-# Display the server address and client ID for transparency
-print(colored(f"Server Address: {server_address}", "magenta"))
-print(colored(f"Generated Client ID: {client_id}", "magenta"))
+# Display the server addresses and client ID for transparency
+print(colored(f"Server Addresses: {', '.join(server_addresses())}", "magenta"))
+print(colored(f"Generated Client ID: {client_id} (pid {os.getpid()})", "magenta"))
+
+# One shared WebSocket per ComfyUI server; events are dispatched per prompt_id.
+# Jobs go to the least-loaded healthy server.
+comfy_pool = BackendPool([Backend(address, ComfyWebSocket(address, client_id)) for address in server_addresses()])
+
+# Previews are handed to background relay threads so the WS consumer never waits on HTTP
+preview_relay = PreviewRelay()
+preview_queue_depth.set_function(preview_relay.depth)
+# Reported per worker by the *-stats endpoints when several workers share METRICS_DIR
+share_stats("cache", result_cache.stats)
+share_stats("uploads", upload_store.stats)
+share_stats("fetch", url_cache.stats)
+
+# Identical seeded jobs running at the same time are executed once
+in_flight = SingleFlight()
+
+# Requests submitted with ?async=1 run as background jobs, polled or streamed via /jobs/<id>
+jobs = JobTable()
+job_executor = ThreadPoolExecutor(max_workers=int(os.getenv('JOB_WORKERS', 8)), thread_name_prefix="job")
+
+# How long get_images waits for a WS event before checking /history instead
+WS_EVENT_TIMEOUT = float(os.getenv('COMFYUI_WS_EVENT_TIMEOUT', 30))
+
+# Make sure the shared WebSocket is up before queueing work
+def ensure_ws_connected(backend=None):
+    backends = [backend] if backend else comfy_pool.backends
+    for b in backends:
+        b.client.start(wait=False)
+    if any(b.client.connected for b in backends) or any(b.client.start() for b in backends):
+        return True
+    print(colored(f"Failed to connect to WebSocket: {', '.join(b.client.url for b in backends)}", "red"))
+    return False
 
 # Queue prompt function
-def queue_prompt(prompt):
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p, indent=4).encode('utf-8')  # Prettify JSON for print
+def queue_prompt(backend, prompt, prompt_id=None):
+    data = prompt_request_body(prompt, client_id, prompt_id)
     try:
-        req = urllib.request.Request(f"http://{server_address}/prompt", data=data)
-        return json.loads(urllib.request.urlopen(req).read())
+        with timed("queue_prompt"):
+            response = http.post(f"http://{backend.address}/prompt", data=data,
+                                 headers={"Content-Type": "application/json"}, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.json()
     except Exception as e:
         print(colored(f"Error executing prompt: {e}", "red"))
         return None
 
-# Get image function
-def get_image(filename, subfolder, folder_type):
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    
-    print(colored(f"Fetching image from the server: {server_address}/view", "cyan"))
-    with urllib.request.urlopen(f"http://{server_address}/view?{url_values}") as response:
-        return response.read()
-
 # Get history for a prompt ID
-def get_history(prompt_id):
+def get_history(backend, prompt_id):
     print(colored(f"Fetching history for prompt ID: {prompt_id}.", "cyan"))
-    with urllib.request.urlopen(f"http://{server_address}/history/{prompt_id}") as response:
-        return json.loads(response.read())
-
-def optimize_resolution(width, height, target=1024):
-    """
-    Optimizes resolution for Z-Image models:
-    1. Scales up to target while maintaining aspect ratio if smaller.
-    2. Ensures width and height are multiples of 64.
-    """
+    with timed("history"):
+        response = http.get(f"http://{backend.address}/history/{prompt_id}", timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+# Check /history to see whether a prompt finished while we were not listening;
+# returns its history entry, or None while it is still running
+def finished_history(backend, prompt_id):
     try:
-        if not width or not height:
-            return 1024, 1024
-            
-        w = float(width)
-        h = float(height)
-        
-        # 1. Scale up to target if smaller
-        aspect_ratio = w / h
-        
-        if w >= h:
-            if w < target:
-                new_w = target
-                new_h = target / aspect_ratio
-            else:
-                new_w = w
-                new_h = h
-        else:
-            if h < target:
-                new_h = target
-                new_w = target * aspect_ratio
-            else:
-                new_w = w
-                new_h = h
-                
-        # 2. Align to nearest multiple of 64
-        final_w = int(round(new_w / 64) * 64)
-        final_h = int(round(new_h / 64) * 64)
-        
-        # Safety checks
-        if final_w < 64: final_w = 64
-        if final_h < 64: final_h = 64
-        
-        print(colored(f"📏 [Resolution] Optimized {width}x{height} -> {final_w}x{final_h}", "yellow"))
-        return final_w, final_h
+        return get_history(backend, prompt_id).get(prompt_id)
     except Exception as e:
-        print(colored(f"⚠️ [Resolution] Optimization error: {e}. Using defaults.", "red"))
-        return 1024, 1024
+        print(colored(f"Error checking history for {prompt_id}: {e}", "red"))
+        return None
 
 # Get images from the workflow
-def get_images(ws, prompt, socket_id=None):
-    prompt_response = queue_prompt(prompt)
-    if not prompt_response:
-        return None
-    prompt_id = prompt_response['prompt_id']
-    output_images = {}
+# output_nodes limits which outputs are downloaded; preview_outputs are output nodes whose
+# images are relayed to socket_id as soon as they are executed. backend must be given when
+# the workflow references uploaded files; otherwise the least-loaded one is used.
+def get_images(prompt, socket_id=None, output_nodes=None, preview_outputs=(), backend=None):
+    if backend is None:
+        with comfy_pool.lease() as backend:
+            return get_images(prompt, socket_id, output_nodes, preview_outputs, backend)
+
+    # Register before queueing so no event for this prompt can be missed
+    comfy_ws = backend.client
+    prompt_id = str(uuid.uuid4())
+    streamed = websocket_outputs(prompt)
+    waiter = comfy_ws.register(prompt_id, previews=bool(socket_id), outputs=streamed)
+    try:
+        prompt_response = queue_prompt(backend, prompt, prompt_id)
+        if not prompt_response:
+            return None
+        if prompt_response['prompt_id'] != prompt_id:
+            # Older ComfyUI builds ignore the client-supplied prompt_id
+            comfy_ws.unregister(prompt_id)
+            prompt_id = prompt_response['prompt_id']
+            waiter = comfy_ws.register(prompt_id, previews=bool(socket_id), outputs=streamed)
+        return _collect_images(backend, waiter, prompt_id, socket_id, output_nodes, preview_outputs)
+    finally:
+        comfy_ws.unregister(prompt_id)
+
+def _collect_images(backend, waiter, prompt_id, socket_id=None, output_nodes=None, preview_outputs=()):
+    # Outputs as ComfyUI reports them in `executed` messages; /history is only asked when the
+    # end of the run wasn't seen on the WebSocket or the messages didn't name every output
+    executed = {}
+    # PNG bytes sent by SaveImageWebsocket nodes, which never appear in /history
+    streamed = {}
+    history = None
+    timer = PromptTimer()
 
     print(colored("Step 6: Start listening for progress updates via the WebSocket connection.", "cyan"))
 
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'progress':
-                data = message['data']
-                current_progress = data['value']
-                max_progress = data['max']
-                percentage = int((current_progress / max_progress) * 100)
-                print(colored(f"Progress: {percentage}% in node {data['node']}", "yellow"))
-
-            elif message['type'] == 'executing':
-                data = message['data']
-                if data['node'] is None and data['prompt_id'] == prompt_id:
-                    print(colored("Execution complete.", "green"))
-                    break  # Execution is done
-                    break  # Execution is done
-        else:
-            if socket_id:
-               # Handle binary preview
-               try:
-                  if isinstance(out, bytes):
-                        print(colored(f"🔹 [AI Server] Received binary data: {len(out)} bytes", "magenta"))
-                        # The first 8 bytes are the type (PREVIEW_IMAGE)
-                        # We can just assume it's an image for now if we know config
-                        # Actually Comfy returns JPEG preview in bytes
-                        # Let's skip first 8 bytes if they are header (int type + int size?)
-                        # Standard ComfyUI websocket preview format:
-                        # 4 bytes type (1=preview)
-                        # 4 bytes size
-                        # json header... logic is complex.
-                        # BUT default behavior simplifies to just sending the blob.
-                        
-                        # Simplified Check: Just converting bytes to base64 and sending
-                        # ComfyUI sends: Type (4 bytes) + Size (4 bytes) + JSON (Size bytes) + JPEG
-                        
-                        # Let's try to just be simple: if it's binary, it might be the preview image directly or wrapped.
-                        # For now, let's just ignore the complex parsing and try to send "something" if it looks like an image,
-                        # OR, safer: relied on the fact that ComfyUI usually saves previews to temp folder and notifies path?
-                        # No, default is binary stream.
-                        
-                        # Let's use a simpler approach: Just send "generating..." event if we can't parse easily?
-                        # No user wants to see image.
-                        
-                        # Let's try to slice the header.
-                        # If we assume it is the standard binary preview:
-                        offset = 8 # Type + Image Type
-                        # Actually, let's just try to base64 encode the whole thing minus first 8 bytes if it fails.
-                        # A better way is to see existing implementations.
-                        # For now, we will try to just base64 encode the raw bytes.
-                        # If it fails on frontend, we can refine.
-                        
-                        # Correct offset for a standard jpeg preview from ComfyUI WS:
-                        # 4 bytes BE integer = type (1)
-                        image_data = out[8:]
-                        
-                        try:
-                            # Downscale for efficiency
-                            img = Image.open(io.BytesIO(image_data))
-                            img.thumbnail((256, 256))
-                            buffered = io.BytesIO()
-                            img.save(buffered, format="JPEG", quality=70)
-                            b64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                            
-                            print(colored(f"📤 [AI Server] Sending downscaled preview to relay for socket: {socket_id}", "magenta"))
-                            requests.post("http://localhost:5001/relay", json={
-                                "socketId": socket_id,
-                                "event": "preview",
-                                "data": {"image": f"data:image/jpeg;base64,{b64_image}"}
-                            })
-                        except Exception as e:
-                            # Fallback to original if PIL fails
-                            print(colored(f"⚠️ PIL downscale failed, falling back to raw: {e}", "yellow"))
-                            b64_image = base64.b64encode(image_data).decode('utf-8')
-                            requests.post("http://localhost:5001/relay", json={
-                                "socketId": socket_id,
-                                "event": "preview",
-                                "data": {"image": f"data:image/jpeg;base64,{b64_image}"}
-                            })
-                  else:
-                       # pass
-                       pass
-               except Exception as e:
-                   print(colored(f"Error streaming preview: {e}", "red"))
-            continue
-
-    # Fetch history and images after completion
-    print(colored("Step 7: Fetch the history and download the images after execution completes.", "cyan"))
-
-    history = get_history(prompt_id)[prompt_id]
-    for o in history['outputs']:
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    print(colored(f"Downloading image: {image['filename']} from the server.", "yellow"))
-                    image_data = get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                output_images[node_id] = images_output
-
-    return output_images
+    with span("ws_wait", prompt_id=prompt_id):
+        while True:
+            try:
+                kind, out = waiter.get(timeout=WS_EVENT_TIMEOUT)
+            except queue.Empty:
+                history = finished_history(backend, prompt_id)
+                if history is not None:
+                    print(colored("Execution complete (detected via history).", "green"))
+                    break
+                continue
+
+            if kind == "reconnected":
+                history = finished_history(backend, prompt_id)
+                if history is not None:
+                    print(colored("Execution complete (detected via history after reconnect).", "green"))
+                    break
+                continue
+
+            if kind == "json":
+                message = out
+                timer.event(message)
+                if message['type'] == 'progress':
+                    data = message['data']
+                    current_progress = data['value']
+                    max_progress = data['max']
+                    percentage = int((current_progress / max_progress) * 100)
+                    print(colored(f"Progress: {percentage}% in node {data['node']}", "yellow"))
+                    report_progress(current_progress, max_progress, data['node'])
+
+                elif message['type'] == 'executing':
+                    data = message['data']
+                    if data['node'] is None and data['prompt_id'] == prompt_id:
+                        print(colored("Execution complete.", "green"))
+                        break  # Execution is done
+                    if data['node'] is not None:
+                        report_progress(node=data['node'])
+
+                elif message['type'] == 'executed':
+                    data = message['data']
+                    images = (data.get('output') or {}).get('images')
+                    if images:
+                        executed[data['node']] = data['output']
+                    if socket_id and images and data['node'] in preview_outputs:
+                        preview_relay.submit(socket_id, partial(output_preview, backend.address, images[-1]))
+                        print(colored(f"Queued intermediate output {data['node']} as preview.", "magenta"))
+
+                elif message['type'] in ('execution_error', 'execution_interrupted'):
+                    print(colored(f"Execution failed: {message['type']}", "red"))
+                    return None
+            elif kind == "output":
+                node_id, frame = out
+                if output_nodes is None or node_id in output_nodes:
+                    streamed.setdefault(node_id, []).append(bytes(frame.image))
+            elif kind == "preview" and socket_id:
+                # Already parsed by the WS reader; encoding and the relay POST happen on relay threads
+                preview_relay.submit(socket_id, partial(preview_frame_data_url, out))
+
+    timer.finished()
+
+    outputs = image_outputs(executed, output_nodes)
+    if history is None and not outputs_complete({**outputs, **streamed}, output_nodes):
+        print(colored("Step 7: Fetch the history for outputs the WebSocket didn't report.", "cyan"))
+        history = get_history(backend, prompt_id)[prompt_id]
+    if history is not None:
+        outputs = image_outputs(history['outputs'], output_nodes)
+    if waiter.outputs and not streamed:
+        print(colored(f"⚠️ [AI Server] No WebSocket images received for {prompt_id}", "yellow"))
+
+    # Fetched only when used, so outputs the caller never returns are never downloaded
+    images = {
+        node_id: [OutputImage(backend.address, image['filename'], image['subfolder'], image['type']) for image in images]
+        for node_id, images in outputs.items()
+    }
+    images.update(streamed)
+    return images
+
+# Look up a request with a caller-supplied seed in the result cache. Returns (key, images);
+# key is None when the request isn't deterministic, images is None on a miss.
+def cached_result(workflow_name, seed, inputs=None, **params):
+    if seed is None:
+        return None, None
+    try:
+        template = registry.get(workflow_name)
+    except (FileNotFoundError, WorkflowError):
+        return None, None
+    key = result_key(template, inputs, seed=seed, **params)
+    images = result_cache.get(key)
+    if images is not None:
+        print(colored(f"♻️ [AI Server] Result cache hit for '{workflow_name}' (seed: {seed})", "green"))
+    return key, images
+
+# Only the images a response can return (the first output node's) are downloaded and cached
+def store_result(key, images):
+    node_id, outputs = first_output(images)
+    if key is not None and outputs:
+        result_cache.put(key, {node_id: read_images(outputs)})
+
+# Run job(*args) -> (images, seed), sharing one run between concurrent requests with the same key.
+# The run always completes: Flask can't tell when a waiting client disconnects (see SingleFlight).
+def run_deduplicated(key, job, *args):
+    if key is None:
+        return job(*args)
+
+    def run():
+        images, seed = job(*args)
+        store_result(key, images)
+        return images, seed
+
+    return in_flight.run(key, run)
+
+# Images of the first output node of a get_images() result (several for a batch),
+# or JobError when there are none
+def output_images(images, seed):
+    if not images:
+        print(colored("❌ [AI Server] Error: Failed to generate images", "red"))
+        raise JobError("Failed to generate images")
+
+    node_id, outputs = first_output(images)
+    if outputs:
+        print(colored(f"✅ [AI Server] Sending {len(outputs)} generated image(s) back (seed: {seed})", "green"))
+        return outputs
+
+    print(colored("❌ [AI Server] Error: No images found in output", "red"))
+    raise JobError("No images generated")
+
+# Clients opt into the job API with ?async=1 or an RFC 7240 "Prefer: respond-async" header
+def wants_async():
+    return (request.args.get('async', '').lower() in ('1', 'true')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+def job_links(job):
+    state = job.to_dict()
+    state.update(statusUrl=f"/jobs/{job.id}", eventsUrl=f"/jobs/{job.id}/events", resultUrl=f"/jobs/{job.id}/result")
+    if job.status == SUCCEEDED:
+        state["resultUrls"] = [f"/jobs/{job.id}/result/{i}" for i in range(len(job.result))]
+    return state
+
+# One image as a plain PNG response; a batch as multipart/mixed with one PNG part each
+def images_response(images, download_name):
+    if len(images) == 1:
+        if isinstance(images[0], OutputImage) and not images[0].downloaded:
+            return stream_image(images[0], download_name)
+        return send_file(
+            io.BytesIO(read_image(images[0])),
+            mimetype='image/png',
+            as_attachment=False,
+            download_name=download_name
+        )
+    images = read_images(images)
+    body, content_type = multipart_images(images, batch_filenames(download_name, len(images)))
+    return Response(body, content_type=content_type)
+
+# Pipe a ComfyUI output to the client in chunks instead of buffering the whole file
+def stream_image(image, download_name):
+    # The body is piped after the view returns, so the download stage and span end when the response is closed
+    download_span = start_span("download", filename=image.params['filename'])
+    started = time.monotonic()
+    upstream = None
+    failure = []
+
+    def finish():
+        if upstream is not None:
+            upstream.close()
+        stage_seconds.observe(time.monotonic() - started, stage="download")
+        if download_span is not None:
+            if failure:
+                download_span.fail(failure[0])
+            download_span.end()
+
+    def chunks():
+        try:
+            yield from upstream.iter_content(STREAM_CHUNK)
+        except Exception as e:
+            failure.append(e)
+            raise
 
-# Generate images function with customizable input
-def generate_images(positive_prompt, negative_prompt="", steps=25, resolution=(512, 512), socket_id=None):
-    # Step 3: Establish WebSocket connection
-    ws = websocket.WebSocket()
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
-    print(colored(f"Step 3: Establishing WebSocket connection to {ws_url}", "cyan"))
     try:
-        ws.connect(ws_url)
+        upstream = image.open()
     except Exception as e:
-        print(colored(f"Failed to connect to WebSocket: {e}", "red"))
-        return None, None
+        failure.append(e)
+        finish()
+        raise
+
+    headers = {"Content-Disposition": f"inline; filename={download_name}"}
+    if upstream.headers.get("Content-Length"):
+        headers["Content-Length"] = upstream.headers["Content-Length"]
+    response = Response(chunks(), mimetype='image/png', headers=headers)
+    response.call_on_close(finish)
+    return response
+
+# Run job_fn(*args) -> (png images, download name) and send the images, or submit it as a
+# background job and answer 202 with the job id straight away
+def run_or_submit(kind, job_fn, *args):
+    # Everything the route did before this point: parsing, decoding and preparing the inputs
+    observe_stage("ingest", time.monotonic() - g.request_started)
+    if wants_async():
+        job = jobs.create(kind)
+        if job is None:
+            return jsonify({"error": "Too many jobs in progress"}), 503
+        # Started here so the request's trace stays open until the job is done
+        job_span = start_span("job", kind=kind, job_id=job.id)
+        job_executor.submit(in_context(run_job, job, job_span, job_fn, *args))
+        print(colored(f"📥 [AI Server] Queued {kind} job {job.id}", "cyan"))
+        return jsonify(job_links(job)), 202, {"Location": f"/jobs/{job.id}"}
 
-    # Step 4: Load workflow from file
-    print(colored("Step 4: Loading the image generation workflow from 'workflow.json'.", "cyan"))
     try:
-        with open("workflow.json", "r", encoding="utf-8") as f:
-            workflow_data = f.read()
-    except FileNotFoundError:
-        print(colored("workflow.json not found.", "red"))
+        with jobs_in_flight.track():
+            images, download_name = job_fn(*args)
+    except JobError as e:
+        return jsonify({"error": str(e)}), 500
+    return images_response(images, download_name)
+
+def run_job(job, job_span, job_fn, *args):
+    # Executor threads are reused, so the job is set and reset explicitly
+    token = current_job.set(job)
+    job.update(status=RUNNING)
+    try:
+        with use_span(job_span), jobs_in_flight.track():
+            images, download_name = job_fn(*args)
+            job.succeed(read_images(images), download_name)
+        print(colored(f"✅ [AI Server] Job {job.id} finished", "green"))
+    except JobError as e:
+        job_failures.inc(kind=job.kind)
+        job.fail(str(e))
+    except Exception as e:
+        job_failures.inc(kind=job.kind)
+        print(colored(f"🔥 [AI Server] Job {job.id} crashed: {str(e)}", "red", attrs=["bold"]))
+        import traceback
+        traceback.print_exc()
+        job.fail(f"Internal server error: {str(e)}")
+    finally:
+        current_job.reset(token)
+
+# Generate images function with customizable input
+def generate_images(positive_prompt, negative_prompt="", steps=25, resolution=(512, 512), socket_id=None, seed=None,
+                    count=1):
+    # Make sure the shared WebSocket is connected (no-op after the first request)
+    if not ensure_ws_connected():
         return None, None
 
-    workflow = json.loads(workflow_data)
+    # Step 4: Get the (cached) workflow template
+    try:
+        template = registry.get("generate")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load workflow.json: {e}", "red"))
+        return None, None
 
     # Customize workflow based on inputs
     print(colored("Step 5: Customizing the workflow with the provided inputs.", "cyan"))
-    
-    # Update nodes with prompts
-    # NOTE: You might need to adjust these IDs based on your specific workflow.json
-    workflow["42"]["inputs"]["text"] = positive_prompt
-    # workflow["7"]["inputs"]["text"] = negative_prompt
 
-    workflow["41"]["inputs"]["steps"] = steps
-
-    workflow["45"]["inputs"]["width"] = resolution[0]
-    workflow["45"]["inputs"]["height"] = resolution[1]
-
-    # Set a random seed for the KSampler node
-    seed = random.randint(1, 1000000000)
-    print(colored(f"Setting random seed for generation: {seed}", "yellow"))
-    workflow["41"]["inputs"]["seed"] = seed
+    # Use the caller's seed, or a random one for the KSampler node
+    if seed is None:
+        seed = random_seed()
+    print(colored(f"Setting seed for generation: {seed}", "yellow"))
+    # count > 1 batches the latent, so every variation comes out of the same sampler pass
+    workflow = template.render(prompt=positive_prompt, steps=steps, seed=seed,
+                               width=int(resolution[0]), height=int(resolution[1]), batch_size=count)
 
     # Fetch generated images
-    images = get_images(ws, workflow, socket_id)
-
-    # Step 8: Close WebSocket connection after fetching the images
-    print(colored(f"Step 8: Closing WebSocket connection to {ws_url}", "cyan"))
-    ws.close()
+    images = get_images(workflow, socket_id, output_nodes=template.returned_outputs)
 
     return images, seed
 
-# NEW: Iterative Generation Function
-def generate_images_iterative(positive_prompt, negative_prompt="", total_steps=4, resolution=(512, 512), socket_id=None):
-    # Establish WebSocket connection
-    ws = websocket.WebSocket()
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
-    print(colored(f"Establishing WebSocket connection to {ws_url}", "cyan"))
+# Run single-image txt2img jobs that share a resolution bucket and step count as one ComfyUI
+# prompt: model loaders run once, each job gets its own prompt/seed branch and output
+def run_generate_batch(key, items):
+    resolution, steps = key
+    if len(items) == 1:
+        positive_prompt, seed, socket_id = items[0]
+        return [generate_images(positive_prompt, "", steps, resolution, socket_id, seed)]
+
+    failed = [(None, seed) for _, seed, _ in items]
+    if not ensure_ws_connected():
+        return failed
     try:
-        ws.connect(ws_url)
-    except Exception as e:
-        print(colored(f"Failed to connect to WebSocket: {e}", "red"))
+        template = registry.get("generate")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load workflow.json: {e}", "red"))
+        return failed
+
+    width, height = int(resolution[0]), int(resolution[1])
+    graph, outputs = build_batch_graph(template, [
+        dict(prompt=positive_prompt, steps=steps, seed=seed, width=width, height=height)
+        for positive_prompt, seed, _ in items
+    ])
+    print(colored(f"📦 [AI Server] Running {len(items)} generate jobs at {width}x{height} as one prompt", "magenta"))
+
+    # Sampler previews of a merged graph can't be told apart, so batched jobs don't relay them
+    images = get_images(graph, output_nodes=set(outputs)) or {}
+    return [({node_id: images[node_id]} if images.get(node_id) else None, seed)
+            for node_id, (_, seed, _) in zip(outputs, items)]
+
+# Compatible txt2img jobs arriving within MICRO_BATCH_WINDOW seconds are merged (off by default)
+generate_batcher = MicroBatcher(run_generate_batch)
+
+# generate_images, but single-image jobs wait briefly to be micro-batched with compatible ones
+def generate_images_batched(positive_prompt, negative_prompt="", steps=25, resolution=(512, 512), socket_id=None,
+                            seed=None, count=1):
+    if count != 1 or not generate_batcher.enabled:
+        return generate_images(positive_prompt, negative_prompt, steps, resolution, socket_id, seed, count)
+    if seed is None:
+        seed = random_seed()
+    return generate_batcher.submit((tuple(resolution), steps), (positive_prompt, seed, socket_id))
+
+# NEW: Iterative Generation Function
+def generate_images_iterative(positive_prompt, negative_prompt="", total_steps=4, resolution=(512, 512), socket_id=None, seed=None):
+    # Make sure the shared WebSocket is connected (no-op after the first request)
+    if not ensure_ws_connected():
         return None, None
 
+    if REFINE_SINGLE_GRAPH and total_steps > 1:
+        return generate_refinement_chain(positive_prompt, total_steps, resolution, socket_id, seed)
+
+    # Each step's upload has to land on the server that runs the next step
+    with comfy_pool.lease() as backend:
+        return _generate_images_stepwise(positive_prompt, total_steps, resolution, socket_id, seed, backend)
+
+# Txt2Img, then one upload + edit round trip per refinement step (REFINE_SINGLE_GRAPH=0)
+def _generate_images_stepwise(positive_prompt, total_steps, resolution, socket_id, seed, backend):
     # --- Step 1: Txt2Img (1 step) ---
     print(colored(">>> Starting Step 1: Txt2Img (1 step)", "blue"))
     try:
-        with open("workflow.json", "r", encoding="utf-8") as f:
-            workflow = json.load(f)
-    except FileNotFoundError:
-        print(colored("workflow.json not found.", "red"))
+        template = registry.get("generate")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load workflow.json: {e}", "red"))
         return None, None
 
-    # Customizing Txt2Img
-    workflow["42"]["inputs"]["text"] = positive_prompt
-    workflow["41"]["inputs"]["steps"] = 1 # Force 1 step
-    workflow["45"]["inputs"]["width"] = int(resolution[0])
-    workflow["45"]["inputs"]["height"] = int(resolution[1])
-    
-    seed = random.randint(1, 1000000000)
-    workflow["41"]["inputs"]["seed"] = seed
+    # Customizing Txt2Img (force 1 step)
+    if seed is None:
+        seed = random_seed()
+    workflow = template.render(prompt=positive_prompt, steps=1, seed=seed,
+                               width=int(resolution[0]), height=int(resolution[1]))
 
     # Run Txt2Img
-    images_output = get_images(ws, workflow, socket_id) # Need to handle socket_id inside get_images for intermediate previews if any
+    images_output = get_images(workflow, socket_id, template.returned_outputs, backend=backend) # Need to handle socket_id inside get_images for intermediate previews if any
     
     if not images_output:
         print(colored("Txt2Img failed.", "red"))
-        ws.close()
         return None, None
 
     # Extract the image from Txt2Img
     # Assuming the first output node has the image
     first_node = list(images_output.keys())[0]
-    current_image_data = images_output[first_node][0] # Binary data
+    current_image_data = read_image(images_output[first_node][0]) # Binary data
     
     # Send this intermediate result as a preview to frontend
     if socket_id:
-        try:
-             # Downscale for efficiency
-             img = Image.open(io.BytesIO(current_image_data))
-             img.thumbnail((256, 256))
-             buffered = io.BytesIO()
-             img.save(buffered, format="PNG") # Use PNG since it's likely a PNG from Comfy
-             b64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-             
-             requests.post("http://localhost:5001/relay", json={
-                "socketId": socket_id,
-                "event": "preview",
-                "data": {"image": f"data:image/png;base64,{b64_image}"}
-             })
-             print(colored(f"Sent downscaled Txt2Img result as preview for socket: {socket_id}", "magenta"))
-        except Exception as e:
-             print(colored(f"Error sending preview: {e}", "red"))
+        # Downscale for efficiency (PNG since it's likely a PNG from Comfy)
+        preview_relay.submit(socket_id, partial(thumbnail_data_url, current_image_data, "PNG"))
+        print(colored(f"Queued downscaled Txt2Img result as preview for socket: {socket_id}", "magenta"))
 
     # Only continue if we have more steps
     if total_steps > 1:
         # Load Edit Workflow for refinement
         try:
-            with open("edit_workflow.json", "r", encoding="utf-8") as f:
-                edit_workflow_template = json.load(f)
-        except FileNotFoundError:
-            print(colored("edit_workflow.json not found.", "red"))
-            ws.close()
+            edit_template = registry.get("edit")
+        except (FileNotFoundError, WorkflowError) as e:
+            print(colored(f"Failed to load edit_workflow.json: {e}", "red"))
             return images_output, seed
 
         # Loop for refinement
         # We did 1 step (Txt2Img). Remaining: total_steps - 1.
         
         remaining_steps = total_steps - 1
+        step_seeds = refinement_seeds(seed, remaining_steps)
         
         for i in range(remaining_steps):
             print(colored(f">>> Starting Refinement Step {i+1}/{remaining_steps}", "blue"))
             
-            # 1. Upload current image
-            # We need to save binary to a temp file or upload directly? 
-            # upload_image accepts bytes?
-            # My upload_image impl:
-            # files = {"image": (filename, image_data)}
-            # It expects 'image_data' as bytes.
-            
-            temp_filename = f"temp_refine_{client_id}_{i}.png"
-            upload_resp = upload_image(current_image_data, temp_filename)
-            if not upload_resp:
-                print(colored("Failed to upload intermediate image.", "red"))
-                break
-            
-            uploaded_filename = upload_resp.get("name") # ComfyUI might rename it
-            
-            # 2. Configure Edit Workflow
-            workflow = edit_workflow_template.copy()
-            
-            # Update Node 75:74 (Positive Prompt)
-            if "75:74" in workflow and "inputs" in workflow["75:74"]:
-                workflow["75:74"]["inputs"]["text"] = positive_prompt
-                
-            # Update Node 76 (Load Image)
-            if "76" in workflow and "inputs" in workflow["76"]:
-                workflow["76"]["inputs"]["image"] = uploaded_filename
-            
-            # Update Steps
-            if "75:62" in workflow:
-                workflow["75:62"]["inputs"]["steps"] = 1 # Keep it fast
-            
-            # Set Seed (noise_seed)
-            if "75:73" in workflow:
-                workflow["75:73"]["inputs"]["noise_seed"] = random.randint(1, 1000000000)
+            # 1. Upload current image (content-addressed, released for eviction once the step is done)
+            with uploaded(backend, current_image_data, "refine") as uploaded_filename:
+                if not uploaded_filename:
+                    print(colored("Failed to upload intermediate image.", "red"))
+                    break
+
+                # 2. Configure Edit Workflow (steps=1 to keep it fast)
+                workflow = edit_template.render(prompt=positive_prompt, image=uploaded_filename,
+                                                seed=step_seeds[i], steps=1)
 
-            print(colored(f"   Step {i+1} setup complete", "yellow"))
+                print(colored(f"   Step {i+1} setup complete", "yellow"))
 
-            # 3. Run Img2Img
-            images_output = get_images(ws, workflow, socket_id)
+                # 3. Run Img2Img
+                images_output = get_images(workflow, socket_id, edit_template.returned_outputs, backend=backend)
             if not images_output:
                 print(colored("Img2Img failed.", "red"))
                 break
                 
             # 4. Get Result
             first_node = list(images_output.keys())[0]
-            current_image_data = images_output[first_node][0]
+            current_image_data = read_image(images_output[first_node][0])
             
             # 5. Send Preview
             if socket_id:
-                try:
-                     # Downscale for efficiency
-                     img = Image.open(io.BytesIO(current_image_data))
-                     img.thumbnail((256, 256))
-                     buffered = io.BytesIO()
-                     img.save(buffered, format="PNG")
-                     b64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                     
-                     requests.post("http://localhost:5001/relay", json={
-                        "socketId": socket_id,
-                        "event": "preview",
-                        "data": {"image": f"data:image/png;base64,{b64_image}"}
-                     })
-                     print(colored(f"Sent downscaled Refinement {i+1} result as preview.", "magenta"))
-                except Exception as e:
-                     print(colored(f"Error sending preview: {e}", "red"))
-
-    ws.close()
-    
+                preview_relay.submit(socket_id, partial(thumbnail_data_url, current_image_data, "PNG"))
+                print(colored(f"Queued downscaled Refinement {i+1} result as preview.", "magenta"))
+
     # Return the final images structure (mimicking original return)
     # Refactor to return dict expected by caller
     # caller expects: images, seed
@@ -421,16 +607,55 @@ def generate_images_iterative(positive_prompt, negative_prompt="", total_steps=4
     
     return images_output, seed
 
+# Txt2Img plus (total_steps - 1) refinement passes queued as one graph: intermediate images
+# stay on the GPU server and only the final SaveImage output is downloaded
+def generate_refinement_chain(positive_prompt, total_steps, resolution, socket_id=None, seed=None):
+    try:
+        template = registry.get("generate")
+        edit_template = registry.get("edit")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load refinement workflows: {e}", "red"))
+        return None, None
+
+    # Only caller-supplied seeds are cached and deduplicated; a random seed never repeats
+    deterministic = seed is not None
+    if seed is None:
+        seed = random_seed()
+    try:
+        workflow, final_node, preview_nodes = build_refinement_graph(
+            template, edit_template, positive_prompt, resolution, seed, refinement_seeds(seed, total_steps - 1))
+    except (KeyError, WorkflowError) as e:
+        print(colored(f"Failed to build refinement graph: {e}", "red"))
+        return None, None
+
+    key = cache_key(workflow) if deterministic else None
+    if key is not None:
+        images_output = result_cache.get(key)
+        if images_output is not None:
+            print(colored(f"♻️ [AI Server] Result cache hit for refinement chain (seed: {seed})", "green"))
+            return images_output, seed
+
+    def run_chain():
+        print(colored(f">>> Starting Txt2Img + {total_steps - 1} refinement steps as a single graph", "blue"))
+        return get_images(workflow, socket_id, output_nodes={final_node}, preview_outputs=set(preview_nodes)), seed
+
+    images_output, seed = run_deduplicated(key, run_chain)
+    if not images_output:
+        print(colored("Refinement chain failed.", "red"))
+        return None, None
+    return images_output, seed
+
 # Legacy wrapper to keep signature if needed, or update caller to use generate_images_iterative
 # Actually, I should replace the original function content with this logic?
 # Or just call this from the route.
 
 # Upload image to ComfyUI server
-def upload_image(image_data, filename):
-    print(colored(f"Uploading image: {filename} to {server_address}", "cyan"))
+def upload_image(backend, image_data, filename):
+    print(colored(f"Uploading image: {filename} to {backend.address}", "cyan"))
     try:
         files = {"image": (filename, image_data)}
-        response = requests.post(f"http://{server_address}/upload/image", files=files)
+        with timed("upload"):
+            response = http.post(f"http://{backend.address}/upload/image", files=files, timeout=TIMEOUT)
         if response.status_code == 200:
             return response.json()
         else:
@@ -440,60 +665,49 @@ def upload_image(image_data, filename):
         print(colored(f"Error uploading image: {e}", "red"))
         return None
 
-# Generate inpaint images function
-def generate_inpaint_images(prompt, image_filename, mask_filename, steps=25):
-    # Establish WebSocket connection
-    ws = websocket.WebSocket()
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
-    print(colored(f"Step 3: Establishing WebSocket connection to {ws_url}", "cyan"))
+# Upload bytes to the job's ComfyUI server under a content-hash name, unless it already holds them.
+# Yields the ComfyUI file name (None if the upload failed); the file isn't evicted while in use.
+@contextmanager
+def uploaded(backend, image_data, prefix):
+    digest = content_digest(image_data)
+    name = upload_store.acquire(backend.address, digest)
+    if name is None:
+        upload_resp = upload_image(backend, image_data, upload_name(prefix, digest))
+        if not upload_resp:
+            yield None
+            return
+        name = upload_resp.get("name") # ComfyUI renames on a clash with different content
+        upload_store.add(backend.address, digest, name, len(image_data))
+    else:
+        print(colored(f"♻️ [AI Server] {backend.address} already has {name}; skipping upload", "green"))
     try:
-        ws.connect(ws_url)
-    except Exception as e:
-        print(colored(f"Failed to connect to WebSocket: {e}", "red"))
+        yield name
+    finally:
+        upload_store.release(backend.address, digest)
+
+# Generate inpaint images function
+def generate_inpaint_images(prompt, image_filename, mask_filename, steps=25, seed=None, backend=None):
+    # Make sure the shared WebSocket is connected (no-op after the first request)
+    if not ensure_ws_connected(backend):
         return None, None
 
-    # Load workflow from file
-    print(colored("Step 4: Loading the inpaint workflow from 'inpaint_workflow.json'.", "cyan"))
+    # Get the (cached) inpaint workflow template
     try:
-        with open("inpaint_workflow.json", "r", encoding="utf-8") as f:
-            workflow_data = f.read()
-    except FileNotFoundError:
-        print(colored("inpaint_workflow.json not found.", "red"))
+        template = registry.get("inpaint")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load inpaint_workflow.json: {e}", "red"))
         return None, None
 
-    workflow = json.loads(workflow_data)
-
     # Customize workflow
     print(colored("Step 5: Customizing the inpaint workflow with the provided inputs.", "cyan"))
-
-    # Update Node 45 (Positive Prompt)
-    if "45" in workflow and "inputs" in workflow["45"]:
-        workflow["45"]["inputs"]["text"] = prompt
-    
-    # Update Node 59 (Load Image)
-    if "59" in workflow and "inputs" in workflow["59"]:
-        workflow["59"]["inputs"]["image"] = image_filename
-    
-    # Update Node 97 (Load Mask)
-    if "97" in workflow and "inputs" in workflow["97"]:
-        workflow["97"]["inputs"]["image"] = mask_filename
-
-    # Update Node 83 (KSampler)
-    if "83" in workflow:
-        seed = random.randint(1, 1000000000)
-        print(colored(f"Setting random seed for generation: {seed}", "yellow"))
-        workflow["83"]["inputs"]["seed"] = seed
-        workflow["83"]["inputs"]["steps"] = steps
-    else:
-        seed = 0 # Default if KSampler missing? Should not happen if workflow is correct.
-        print(colored("Warning: KSampler node 83 not found.", "red"))
+    if seed is None:
+        seed = random_seed()
+    print(colored(f"Setting seed for generation: {seed}", "yellow"))
+    workflow = template.render(prompt=prompt, image=image_filename, mask=mask_filename, seed=seed, steps=steps)
 
     # Fetch generated images
-    images = get_images(ws, workflow)
+    images = get_images(workflow, output_nodes=template.returned_outputs, backend=backend)
 
-    # Close WebSocket connection
-    print(colored(f"Step 8: Closing WebSocket connection to {ws_url}", "cyan"))
-    ws.close()
 
     return images, seed
 
@@ -505,14 +719,19 @@ def generate_inpaint_route():
         
         image_data = None
         mask_data = None
-        image_filename = None
-        mask_filename = None
 
         if request.is_json:
             print(colored("📝 [AI Server] Processing JSON request", "cyan"))
             data = request.json
             prompt = data.get('prompt')
-            steps = int(data.get('steps', 25))
+            try:
+                steps = parse_steps(data.get('steps'), 25)
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid steps"}), 400
+            try:
+                seed = parse_seed(data.get('seed'))
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid seed"}), 400
             
             image_input = data.get('image')
             mask_input = data.get('mask')
@@ -525,58 +744,24 @@ def generate_inpaint_route():
             try:
                 if image_input.startswith("http"):
                     print(colored(f"⬇️ [AI Server] Downloading image from URL: {image_input}", "cyan"))
-                    img_resp = requests.get(image_input)
-                    if img_resp.status_code != 200:
-                         return jsonify({"error": "Failed to download image from URL"}), 400
-                    image_data = img_resp.content
+                    try:
+                        image_data = fetch(image_input)
+                    except FetchError as e:
+                        return jsonify({"error": str(e)}), 400
                 else:
-                    if "," in image_input:
-                        image_input = image_input.split(",")[1]
-                    image_data = base64.b64decode(image_input)
-                
-                image_filename = f"image_{uuid.uuid4()}.png"
+                    image_data = decode_base64_image(image_input)
                 
                 # Get Image Size for Mask Resizing
-                pil_img = Image.open(io.BytesIO(image_data))
-                img_width, img_height = pil_img.size
+                img_width, img_height = image_size(image_data)
                 print(colored(f"📸 [AI Server] Image Size: {img_width}x{img_height}", "blue"))
 
             except Exception as e:
                 print(colored(f"❌ [AI Server] Error processing image: {e}", "red"))
                 return jsonify({"error": "Invalid image input"}), 400
 
-            # 2. Process Mask (Base64) and Resize
+            # 2. Decode Mask (Base64)
             try:
-                if "," in mask_input:
-                    mask_input = mask_input.split(",")[1]
-                mask_data_raw = base64.b64decode(mask_input)
-                
-                # Convert transparent mask to white-on-black (grayscale)
-                try:
-                    pil_mask = Image.open(io.BytesIO(mask_data_raw))
-                    print(colored(f"🎭 [AI Server] Original Mask Mode: {pil_mask.mode}, Size: {pil_mask.size}", "blue"))
-                    
-                    if pil_mask.mode == 'RGBA':
-                        # Use alpha channel as the mask
-                        pil_mask = pil_mask.split()[-1] 
-                    elif pil_mask.mode == 'LA':
-                        pil_mask = pil_mask.split()[-1]
-                    else:
-                        pil_mask = pil_mask.convert("L")
-                    
-                    # RESIZE MASK TO MATCH IMAGE
-                    if pil_mask.size != (img_width, img_height):
-                        print(colored(f"📐 [AI Server] Resizing mask from {pil_mask.size} to {img_width}x{img_height}", "yellow"))
-                        pil_mask = pil_mask.resize((img_width, img_height), Image.Resampling.LANCZOS)
-                        
-                    output_buffer = io.BytesIO()
-                    pil_mask.save(output_buffer, format="PNG")
-                    mask_data = output_buffer.getvalue()
-                except Exception as img_err:
-                     print(colored(f"⚠️ [AI Server] Mask processing failed, using raw: {img_err}", "yellow"))
-                     mask_data = mask_data_raw
-
-                mask_filename = f"mask_{uuid.uuid4()}.png"
+                mask_data_raw = decode_base64_image(mask_input)
             except Exception as e:
                 print(colored(f"❌ [AI Server] Error decoding mask: {e}", "red"))
                 return jsonify({"error": "Invalid mask base64"}), 400
@@ -590,75 +775,31 @@ def generate_inpaint_route():
             image_file = request.files['image']
             mask_file = request.files['mask']
             prompt = request.form.get('prompt')
-            steps = int(request.form.get('steps', 25))
+            try:
+                steps = parse_steps(request.form.get('steps'), 25)
+            except ValueError:
+                return jsonify({"error": "Invalid steps"}), 400
+            try:
+                seed = parse_seed(request.form.get('seed'))
+            except ValueError:
+                return jsonify({"error": "Invalid seed"}), 400
             
             image_data = image_file.read()
             mask_data_raw = mask_file.read()
-            image_filename = image_file.filename
-            mask_filename = mask_file.filename
 
-            # Get image size
-            pil_img = Image.open(io.BytesIO(image_data))
-            img_width, img_height = pil_img.size
-            
-            # Process mask (reuse same logic as above)
-            try:
-                pil_mask = Image.open(io.BytesIO(mask_data_raw))
-                if pil_mask.mode == 'RGBA' or pil_mask.mode == 'LA':
-                    pil_mask = pil_mask.split()[-1]
-                else:
-                    pil_mask = pil_mask.convert("L")
-                
-                if pil_mask.size != (img_width, img_height):
-                    pil_mask = pil_mask.resize((img_width, img_height), Image.Resampling.LANCZOS)
-                
-                output_buffer = io.BytesIO()
-                pil_mask.save(output_buffer, format="PNG")
-                mask_data = output_buffer.getvalue()
-            except Exception as e:
-                mask_data = mask_data_raw
-        
-        #共通 debug saving
-        # Debug: Save input image & mask to disk
-        try:
-            with open("debug_image.png", "wb") as f:
-                f.write(image_data)
-            with open("debug_mask.png", "wb") as f:
-                f.write(mask_data)
-            print(colored("💾 [AI Server] Saved debug images (image.png & mask.png)", "magenta"))
-        except Exception as e:
-            print(colored(f"⚠️ [AI Server] Failed to save debug images: {e}", "yellow"))
-        
-        image_upload_resp = upload_image(image_data, image_filename)
-        mask_upload_resp = upload_image(mask_data, mask_filename)
-
-        if not image_upload_resp or not mask_upload_resp:
-             return jsonify({"error": "Failed to upload images to ComfyUI"}), 500
-             
-        comfy_image_name = image_upload_resp.get("name")
-        comfy_mask_name = mask_upload_resp.get("name")
-
-        print(colored(f"🎨 [AI Server] Inpainting: prompt='{prompt}', steps={steps}", "blue"))
-
-        images, seed = generate_inpaint_images(prompt, comfy_image_name, comfy_mask_name, steps)
-
-        if not images:
-            print(colored("❌ [AI Server] Error: Failed to generate images", "red"))
-            return jsonify({"error": "Failed to generate images"}), 500
+        if prompt is None:
+            print(colored("❌ [AI Server] Error: No prompt provided", "red"))
+            return jsonify({"error": "No prompt provided"}), 400
 
-        # Retrieve the first image found
-        for node_id in images:
-            for image_data in images[node_id]:
-                print(colored(f"✅ [AI Server] Sending generated image back (seed: {seed})", "green"))
-                return send_file(
-                    io.BytesIO(image_data),
-                    mimetype='image/png',
-                    as_attachment=False,
-                    download_name=f"inpainted-{seed}.png"
-                )
+        # Downscale an oversized image to the workflow's pixel budget before upload; the mask follows it
+        image_data, (img_width, img_height) = prescale_image(image_data, input_scale("inpaint"))
+        # Convert transparent mask to white-on-black (grayscale) at the image size
+        mask_data = prepare_mask(mask_data_raw, (img_width, img_height))
 
-        print(colored("❌ [AI Server] Error: No images found in output", "red"))
-        return jsonify({"error": "No images generated"}), 500
+        # Debug: a sample of inputs is saved in the background (DEBUG_CAPTURE_RATE)
+        debug_sink.capture({"debug_image.png": image_data, "debug_mask.png": mask_data})
+        
+        return run_or_submit("inpaint-image", inpaint_job, prompt, steps, seed, image_data, mask_data)
 
     except Exception as e:
         print(colored(f"🔥 [AI Server] UNEXPECTED CRITICAL ERROR: {str(e)}", "red", attrs=["bold"]))
@@ -666,59 +807,52 @@ def generate_inpaint_route():
         traceback.print_exc()
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+# Inpaint the parsed request; returns (png images, download name) or raises JobError
+def inpaint_job(prompt, steps, seed, image_data, mask_data):
+    # A cache hit skips the uploads and ComfyUI entirely; concurrent duplicates attach to the running job
+    key, images = cached_result("inpaint", seed, {"image": image_data, "mask": mask_data},
+                                prompt=prompt, steps=steps)
+    if images is None:
+        images, seed = run_deduplicated(key, run_inpaint, prompt, steps, seed, image_data, mask_data)
+
+    return output_images(images, seed), f"inpainted-{seed}.png"
+
+# Lease a ComfyUI server, upload the inputs there and inpaint; shared by duplicates, so the
+# lease and the uploads last exactly as long as the shared job
+def run_inpaint(prompt, steps, seed, image_data, mask_data):
+    # Uploads go to the same ComfyUI server that will run the job (skipped if it already has the bytes)
+    with comfy_pool.lease() as backend, uploaded(backend, image_data, "image") as comfy_image_name, \
+            uploaded(backend, mask_data, "mask") as comfy_mask_name:
+        if not comfy_image_name or not comfy_mask_name:
+            raise JobError("Failed to upload images to ComfyUI")
+
+        print(colored(f"🎨 [AI Server] Inpainting: prompt='{prompt}', steps={steps}", "blue"))
+
+        return generate_inpaint_images(prompt, comfy_image_name, comfy_mask_name, steps, seed, backend)
+
 # Edit image function
-def edit_image_logic(prompt, image_filename, steps=None):
-    # Establish WebSocket connection
-    ws = websocket.WebSocket()
-    ws_url = f"ws://{server_address}/ws?clientId={client_id}"
-    print(colored(f"Step 3: Establishing WebSocket connection to {ws_url}", "cyan"))
-    try:
-        ws.connect(ws_url)
-    except Exception as e:
-        print(colored(f"Failed to connect to WebSocket: {e}", "red"))
+def edit_image_logic(prompt, image_filename, steps=None, seed=None, backend=None):
+    # Make sure the shared WebSocket is connected (no-op after the first request)
+    if not ensure_ws_connected(backend):
         return None, None
 
-    # Load workflow from file
-    print(colored("Step 4: Loading the image editing workflow from 'edit_workflow.json'.", "cyan"))
+    # Get the (cached) edit workflow template
     try:
-        with open("edit_workflow.json", "r", encoding="utf-8") as f:
-            workflow_data = f.read()
-    except FileNotFoundError:
-        print(colored("edit_workflow.json not found.", "red"))
+        template = registry.get("edit")
+    except (FileNotFoundError, WorkflowError) as e:
+        print(colored(f"Failed to load edit_workflow.json: {e}", "red"))
         return None, None
 
-    workflow = json.loads(workflow_data)
-
-    # Customize workflow
+    # Customize workflow (steps=None keeps the workflow's own step count)
     print(colored("Step 5: Customizing the edit workflow with the provided inputs.", "cyan"))
-
-    # Update Node 75:74 (Positive Prompt)
-    if "75:74" in workflow and "inputs" in workflow["75:74"]:
-        workflow["75:74"]["inputs"]["text"] = prompt
-    
-    # Update Node 76 (Load Image)
-    if "76" in workflow and "inputs" in workflow["76"]:
-        workflow["76"]["inputs"]["image"] = image_filename
-    
-    # Update Node 75:73 (RandomNoise)
-    if "75:73" in workflow:
-        seed = random.randint(1, 1000000000)
-        print(colored(f"Setting random seed for generation: {seed}", "yellow"))
-        workflow["75:73"]["inputs"]["noise_seed"] = seed
-    else:
-        seed = 0
-        print(colored("Warning: RandomNoise node 75:73 not found.", "red"))
-
-    # Update Node 75:62 (Flux2Scheduler - Steps)
-    if steps is not None and "75:62" in workflow:
-        workflow["75:62"]["inputs"]["steps"] = steps
+    if seed is None:
+        seed = random_seed()
+    print(colored(f"Setting seed for generation: {seed}", "yellow"))
+    workflow = template.render(prompt=prompt, image=image_filename, seed=seed, steps=steps)
 
     # Fetch generated images
-    images = get_images(ws, workflow)
+    images = get_images(workflow, output_nodes=template.returned_outputs, backend=backend)
 
-    # Close WebSocket connection
-    print(colored(f"Step 8: Closing WebSocket connection to {ws_url}", "cyan"))
-    ws.close()
 
     return images, seed
 
@@ -729,13 +863,35 @@ def edit_image_route():
         print(colored("🚀 [AI Server] Received request on /edit-image", "green", attrs=["bold"]))
         
         image_data = None
-        image_filename = None
 
-        if request.is_json:
+        if is_raw_image(request.mimetype):
+            # Bare image body: no base64 or multipart decoding; parameters are in the query string
+            print(colored("📝 [AI Server] Processing raw image request", "cyan"))
+            prompt = request.args.get('prompt')
+            try:
+                steps = parse_steps(request.args.get('steps'))
+            except ValueError:
+                return jsonify({"error": "Invalid steps"}), 400
+            try:
+                seed = parse_seed(request.args.get('seed'))
+            except ValueError:
+                return jsonify({"error": "Invalid seed"}), 400
+            image_data = request.get_data(cache=False)
+            if not image_data:
+                return jsonify({"error": "Image is required"}), 400
+
+        elif request.is_json:
             print(colored("📝 [AI Server] Processing JSON request", "cyan"))
             data = request.json
             prompt = data.get('prompt')
-            steps = data.get('steps')
+            try:
+                steps = parse_steps(data.get('steps'))
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid steps"}), 400
+            try:
+                seed = parse_seed(data.get('seed'))
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid seed"}), 400
             
             image_input = data.get('image')
 
@@ -747,16 +903,12 @@ def edit_image_route():
             try:
                 if image_input.startswith("http"):
                     print(colored(f"⬇️ [AI Server] Downloading image from URL: {image_input}", "cyan"))
-                    img_resp = requests.get(image_input)
-                    if img_resp.status_code != 200:
-                         return jsonify({"error": "Failed to download image from URL"}), 400
-                    image_data = img_resp.content
+                    try:
+                        image_data = fetch(image_input)
+                    except FetchError as e:
+                        return jsonify({"error": str(e)}), 400
                 else:
-                    if "," in image_input:
-                        image_input = image_input.split(",")[1]
-                    image_data = base64.b64decode(image_input)
-                
-                image_filename = f"image_{uuid.uuid4()}.png"
+                    image_data = decode_base64_image(image_input)
                 
             except Exception as e:
                 print(colored(f"❌ [AI Server] Error processing image: {e}", "red"))
@@ -770,48 +922,28 @@ def edit_image_route():
                  
             image_file = request.files['image']
             prompt = request.form.get('prompt')
-            steps = request.form.get('steps')
-            if steps:
-                steps = int(steps)
+            try:
+                steps = parse_steps(request.form.get('steps'))
+            except ValueError:
+                return jsonify({"error": "Invalid steps"}), 400
+            try:
+                seed = parse_seed(request.form.get('seed'))
+            except ValueError:
+                return jsonify({"error": "Invalid seed"}), 400
             
             image_data = image_file.read()
-            image_filename = image_file.filename
-
-        # Debug save
-        try:
-            with open("debug_img2img_input.png", "wb") as f:
-                f.write(image_data)
-        except:
-            pass
-        
-        image_upload_resp = upload_image(image_data, image_filename)
-
-        if not image_upload_resp:
-             return jsonify({"error": "Failed to upload image to ComfyUI"}), 500
-             
-        comfy_image_name = image_upload_resp.get("name")
-
-        print(colored(f"🎨 [AI Server] Edit Image: prompt='{prompt}', steps={steps}", "blue"))
-
-        images, seed = edit_image_logic(prompt, comfy_image_name, steps)
 
-        if not images:
-            print(colored("❌ [AI Server] Error: Failed to generate images", "red"))
-            return jsonify({"error": "Failed to generate images"}), 500
+        if prompt is None:
+            print(colored("❌ [AI Server] Error: No prompt provided", "red"))
+            return jsonify({"error": "No prompt provided"}), 400
 
-        # Retrieve the first image found
-        for node_id in images:
-            for image_data in images[node_id]:
-                print(colored(f"✅ [AI Server] Sending generated image back (seed: {seed})", "green"))
-                return send_file(
-                    io.BytesIO(image_data),
-                    mimetype='image/png',
-                    as_attachment=False,
-                    download_name=f"img2img-{seed}.png"
-                )
+        # Downscale an oversized image to the workflow's pixel budget before upload
+        image_data, _ = prescale_image(image_data, input_scale("edit"))
 
-        print(colored("❌ [AI Server] Error: No images found in output", "red"))
-        return jsonify({"error": "No images generated"}), 500
+        # Debug: a sample of inputs is saved in the background (DEBUG_CAPTURE_RATE)
+        debug_sink.capture({"debug_img2img_input.png": image_data})
+        
+        return run_or_submit("edit-image", edit_job, prompt, steps, seed, image_data)
 
     except Exception as e:
         print(colored(f"🔥 [AI Server] UNEXPECTED CRITICAL ERROR: {str(e)}", "red", attrs=["bold"]))
@@ -819,6 +951,26 @@ def edit_image_route():
         traceback.print_exc()
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+# Edit the parsed request's image; returns (png images, download name) or raises JobError
+def edit_job(prompt, steps, seed, image_data):
+    # A cache hit skips the upload and ComfyUI entirely; concurrent duplicates attach to the running job
+    key, images = cached_result("edit", seed, {"image": image_data}, prompt=prompt, steps=steps)
+    if images is None:
+        images, seed = run_deduplicated(key, run_edit, prompt, steps, seed, image_data)
+
+    return output_images(images, seed), f"img2img-{seed}.png"
+
+# Lease a ComfyUI server, upload the image there and edit it; shared by duplicates like run_inpaint
+def run_edit(prompt, steps, seed, image_data):
+    # The upload goes to the same ComfyUI server that will run the job (skipped if it already has the bytes)
+    with comfy_pool.lease() as backend, uploaded(backend, image_data, "image") as comfy_image_name:
+        if not comfy_image_name:
+            raise JobError("Failed to upload image to ComfyUI")
+
+        print(colored(f"🎨 [AI Server] Edit Image: prompt='{prompt}', steps={steps}", "blue"))
+
+        return edit_image_logic(prompt, comfy_image_name, steps, seed, backend)
+
 @app.route('/generate-with-preview', methods=['POST'])
 def generate_with_preview_route():
     print("!!! [AI Server] RECEIVED REQUEST ON /generate-with-preview !!!")
@@ -841,36 +993,27 @@ def generate_with_preview_route():
         width, height = optimize_resolution(input_width, input_height)
         
         socket_id = data.get('socketId') # Optional socket ID for streaming
+        try:
+            seed = parse_seed(data.get('seed')) # Optional; makes the result cacheable
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid seed"}), 400
 
         print(colored(f"🎨 [AI Server] Generating image: prompt='{positive_prompt}', steps={steps}, res={width}x{height}, socket={socket_id}", "blue"))
 
-        # Use new iterative function
-        images, seed = generate_images_iterative(positive_prompt, negative_prompt, steps, (width, height), socket_id)
-
-        if not images:
-            print(colored("❌ [AI Server] Error: Failed to generate images (images object is empty or None)", "red"))
-            return jsonify({"error": "Failed to generate images"}), 500
-
-        # Retrieve the first image found
-        for node_id in images:
-            for image_data in images[node_id]:
-                print(colored(f"✅ [AI Server] Sending generated image back (seed: {seed})", "green"))
-                # Returns the first image found
-                return send_file(
-                    io.BytesIO(image_data),
-                    mimetype='image/png',
-                    as_attachment=False,
-                    download_name=f"generated-{seed}.png"
-                )
-
-        print(colored("❌ [AI Server] Error: No images found in the output collection", "red"))
-        return jsonify({"error": "No images generated"}), 500
+        return run_or_submit("generate-with-preview", preview_job, positive_prompt, negative_prompt, steps,
+                             (width, height), socket_id, seed)
     except Exception as e:
         print(colored(f"🔥 [AI Server] UNEXPECTED CRITICAL ERROR: {str(e)}", "red", attrs=["bold"]))
         import traceback
         traceback.print_exc()
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+# Iterative generation with previews; returns (png images, download name) or raises JobError
+def preview_job(positive_prompt, negative_prompt, steps, resolution, socket_id, seed):
+    # Use new iterative function
+    images, seed = generate_images_iterative(positive_prompt, negative_prompt, steps, resolution, socket_id, seed)
+    return output_images(images, seed), f"generated-{seed}.png"
+
 @app.route('/generate-image', methods=['POST'])
 def generate_image_route():
     print("!!! [AI Server] RECEIVED REQUEST ON /generate-image !!!")
@@ -893,36 +1036,146 @@ def generate_image_route():
         width, height = optimize_resolution(input_width, input_height)
         
         socket_id = data.get('socketId')
+        try:
+            seed = parse_seed(data.get('seed')) # Optional; makes the result cacheable
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid seed"}), 400
+        try:
+            count = parse_count(data.get('count')) # Variations produced in one sampler pass
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid count"}), 400
 
-        print(colored(f"🎨 [AI Server] Generating image: prompt='{positive_prompt}', steps={steps}, res={width}x{height}", "blue"))
-
-        # Use the original generate_images function (workflow.json only)
-        images, seed = generate_images(positive_prompt, negative_prompt, steps, (width, height), socket_id)
-
-        if not images:
-            print(colored("❌ [AI Server] Error: Failed to generate images", "red"))
-            return jsonify({"error": "Failed to generate images"}), 500
+        # With micro-batching on, sizes are snapped to a few buckets so concurrent requests can share a prompt
+        if generate_batcher.enabled and count == 1:
+            width, height = snap_to_bucket(width, height)
 
-        # Retrieve the first image found
-        for node_id in images:
-            for image_data in images[node_id]:
-                print(colored(f"✅ [AI Server] Sending generated image back (seed: {seed})", "green"))
-                return send_file(
-                    io.BytesIO(image_data),
-                    mimetype='image/png',
-                    as_attachment=False,
-                    download_name=f"generated-{seed}.png"
-                )
+        print(colored(f"🎨 [AI Server] Generating image: prompt='{positive_prompt}', steps={steps}, res={width}x{height}, count={count}", "blue"))
 
-        print(colored("❌ [AI Server] Error: No images found in the output collection", "red"))
-        return jsonify({"error": "No images generated"}), 500
+        return run_or_submit("generate-image", generate_job, positive_prompt, negative_prompt, steps,
+                             (width, height), socket_id, seed, count)
     except Exception as e:
         print(colored(f"🔥 [AI Server] UNEXPECTED CRITICAL ERROR: {str(e)}", "red", attrs=["bold"]))
         import traceback
         traceback.print_exc()
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+# Plain workflow.json generation; returns (png images, download name) or raises JobError
+def generate_job(positive_prompt, negative_prompt, steps, resolution, socket_id, seed, count=1):
+    width, height = resolution
+    key, images = cached_result("generate", seed, prompt=positive_prompt, steps=steps, width=width, height=height,
+                                batch_size=count)
+    if images is None:
+        # workflow.json only; concurrent duplicates share one job, compatible ones may be micro-batched
+        images, seed = run_deduplicated(key, generate_images_batched, positive_prompt, negative_prompt, steps,
+                                        resolution, socket_id, seed, count)
+    return output_images(images, seed), f"generated-{seed}.png"
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_links(job))
+
+# Server-sent events: one event (named after the job status) per change until the job finishes
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events_route(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def stream():
+        version = job.version
+        while True:
+            state = job.to_dict()
+            yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n"
+            if state['status'] in FINISHED:
+                return
+            while True:
+                latest = job.wait_for_change(version, timeout=15)
+                if latest != version:
+                    version = latest
+                    break
+                yield ": keep-alive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+# The finished image(s), or one image of a batch by index; 202 with the job status while it is still running
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+@app.route('/jobs/<job_id>/result/<int:index>', methods=['GET'])
+def job_result_route(job_id, index=None):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job.status == SUCCEEDED:
+        if index is None:
+            return images_response(job.result, job.download_name)
+        if index >= len(job.result):
+            return jsonify({"error": "No such image"}), 404
+        filename = batch_filenames(job.download_name, len(job.result))[index]
+        return send_file(io.BytesIO(job.result[index]), mimetype='image/png', as_attachment=False,
+                         download_name=filename)
+    if job.status in FINISHED:
+        return jsonify({"error": job.error}), 500
+    return jsonify(job_links(job)), 202
+
+# Result cache hit/miss counters and sizes
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats_route():
+    return jsonify(worker_stats("cache"))
+
+# Upload store hits/misses and what each ComfyUI server holds
+@app.route('/upload-stats', methods=['GET'])
+def upload_stats_route():
+    return jsonify(worker_stats("uploads"))
+
+# URL image cache hits, revalidations and size
+@app.route('/fetch-stats', methods=['GET'])
+def fetch_stats_route():
+    return jsonify(worker_stats("fetch"))
+
+# Prometheus scrape endpoint: per-stage latency histograms, error counters, in-flight gauges
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+# Health and load of each ComfyUI server
+@app.route('/backends', methods=['GET'])
+def backends_route():
+    return jsonify(comfy_pool.stats())
+
+@app.route('/traces', methods=['GET'])
+def traces_route():
+    # Newest finished traces; ?min_ms= keeps only the slow ones
+    limit = request.args.get('limit', 50, type=int)
+    min_ms = request.args.get('min_ms', 0, type=float)
+    return jsonify(trace_store.recent(limit, min_ms))
+
+@app.route('/traces/<trace_id>', methods=['GET'])
+def trace_route(trace_id):
+    # The span timeline of one request; ?format=otlp returns it as OTLP/JSON
+    trace = trace_store.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace.to_otlp() if request.args.get('format') == 'otlp' else trace.to_dict())
+
+# Connect to ComfyUI and parse workflows up front so the first request doesn't pay for it.
+# Called once per process: below for the development server, from gunicorn.conf.py per worker.
+def warm_up():
+    for backend in comfy_pool.backends:
+        backend.client.start(wait=False)
+    comfy_pool.start_health_checks()
+    registry.preload()
+
+# Let running background jobs finish (queued ones are dropped), then close the WebSockets
+def shut_down():
+    job_executor.shutdown(wait=True, cancel_futures=True)
+    for backend in comfy_pool.backends:
+        backend.client.close()
+
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 3000))
+    warm_up()
+    # Development server; see gunicorn.conf.py for the multi-process production mode
     print(colored(f"Starting Flask server on port {port}...", "green"))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
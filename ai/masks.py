@@ -0,0 +1,143 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import Image
+from termcolor import colored
+
+from image_utils import probe_image
+
+# Opt-in binarization: mask values at or above this become white, the rest black.
+# 0 (the default) keeps soft and feathered masks as they are
+MASK_THRESHOLD = int(os.getenv('MASK_THRESHOLD', 0))
+# Optional cleanup, in pixels: MASK_OPEN removes specks and thin strokes up to this radius,
+# MASK_GROW then dilates the mask so the inpainted area overlaps its surroundings
+MASK_OPEN = int(os.getenv('MASK_OPEN', 0))
+MASK_GROW = int(os.getenv('MASK_GROW', 0))
+# Masks larger than this (mask or target image, in pixels) are prepared in a worker process
+MASK_PROCESS_PIXELS = int(os.getenv('MASK_PROCESS_PIXELS', 4 * 1024 * 1024))
+# Worker processes for large masks; 0 prepares every mask on the calling thread
+MASK_PROCESSES = int(os.getenv('MASK_PROCESSES', 2))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _mask_array(mask_data_raw):
+    pil_mask = Image.open(io.BytesIO(mask_data_raw))
+    print(colored(f"🎭 [AI Server] Original Mask Mode: {pil_mask.mode}, Size: {pil_mask.size}", "blue"))
+    if pil_mask.mode in ('RGBA', 'LA'):
+        # Use alpha channel as the mask
+        return np.asarray(pil_mask)[..., -1]
+    return np.asarray(pil_mask.convert("L"))
+
+
+def _resize(mask, size, soft):
+    width, height = size
+    if soft:
+        return np.asarray(Image.fromarray(mask).resize((width, height), Image.Resampling.LANCZOS))
+    # Nearest neighbour by index: exact for binary masks and far cheaper than a filter
+    rows = np.arange(height) * mask.shape[0] // height
+    cols = np.arange(width) * mask.shape[1] // width
+    return mask[rows[:, None], cols]
+
+
+def _window(mask, radius, reduce, pad_value):
+    # Separable square min/max filter: one pass per axis, 2*radius+1 vectorised ops each
+    for axis in (0, 1):
+        n = mask.shape[axis]
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (radius, radius)
+        padded = np.pad(mask, pad, constant_values=pad_value)
+        shifted = (lambda k: padded[k:k + n]) if axis == 0 else (lambda k: padded[:, k:k + n])
+        out = shifted(0).copy()
+        for k in range(1, 2 * radius + 1):
+            reduce(out, shifted(k), out=out)
+        mask = out
+    return mask
+
+
+def erode(mask, radius):
+    return _window(mask, radius, np.minimum, 255) if radius > 0 else mask
+
+
+def dilate(mask, radius):
+    return _window(mask, radius, np.maximum, 0) if radius > 0 else mask
+
+
+def _prepare_mask(mask_data_raw, size, threshold=MASK_THRESHOLD, open_radius=MASK_OPEN, grow=MASK_GROW):
+    try:
+        mask = _mask_array(mask_data_raw)
+
+        # RESIZE MASK TO MATCH IMAGE
+        if (mask.shape[1], mask.shape[0]) != size:
+            print(colored(f"📐 [AI Server] Resizing mask from {mask.shape[1]}x{mask.shape[0]} to {size[0]}x{size[1]}", "yellow"))
+            mask = _resize(mask, size, soft=not threshold)
+
+        if threshold:
+            mask = np.multiply(mask >= threshold, 255, dtype=np.uint8)
+        mask = dilate(erode(mask, open_radius), open_radius)
+        mask = dilate(mask, grow)
+
+        output_buffer = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(mask)).save(output_buffer, format="PNG", compress_level=1)
+        return output_buffer.getvalue()
+    except Exception as img_err:
+        print(colored(f"⚠️ [AI Server] Mask processing failed, using raw: {img_err}", "yellow"))
+        return mask_data_raw
+
+
+def _watch_parent(parent_pid):
+    # Workers exit with the server even when it is killed without shutting the pool down
+    def watch():
+        while True:
+            time.sleep(1)
+            try:
+                os.kill(parent_pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+
+    threading.Thread(target=watch, name="mask-worker-watchdog", daemon=True).start()
+
+
+def _process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Workers are never forked from this (threaded) process: forkserver forks them from a
+            # single-threaded server with NumPy/Pillow already imported, spawn starts them fresh
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=MASK_PROCESSES, mp_context=context,
+                                        initializer=_watch_parent, initargs=(os.getpid(),))
+        return _pool
+
+
+# Convert a transparent mask to white-on-black (grayscale) PNG matching the image size.
+# Falls back to the raw bytes if the mask can't be decoded. Large masks are prepared in
+# a worker process so they don't hold the GIL while other requests are being served.
+def prepare_mask(mask_data_raw, size):
+    size = tuple(size)
+    pixels = size[0] * size[1]
+    info = probe_image(mask_data_raw)
+    if info is not None:
+        pixels = max(pixels, info[1] * info[2])
+    if MASK_PROCESSES <= 0 or pixels <= MASK_PROCESS_PIXELS:
+        return _prepare_mask(mask_data_raw, size)
+
+    global _pool
+    try:
+        return _process_pool().submit(_prepare_mask, mask_data_raw, size).result()
+    except BrokenProcessPool:
+        print(colored("⚠️ [AI Server] Mask worker process died, preparing mask in-process", "yellow"))
+        with _pool_lock:
+            _pool = None
+        return _prepare_mask(mask_data_raw, size)
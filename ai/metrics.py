@@ -0,0 +1,328 @@
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from termcolor import colored
+
+from process_utils import process_alive
+from tracing import record_span, span
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = tuple(
+    float(b) for b in os.getenv('METRICS_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300').split(',')
+    if b.strip()
+)
+
+# Directory shared by the worker processes of one host (set by gunicorn.conf.py). Every worker
+# writes its values there, so /metrics sums all workers whichever one answers the scrape.
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+# Seconds between those writes; other workers' values in /metrics are at most this old
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Every metric created in the process, in creation order
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, values=None):
+        """The metric in the text format, from ``values`` (e.g. summed over workers) or this process's own."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(self.values() if values is None else values))
+        return "\n".join(lines)
+
+    def values(self):
+        """{label values: value} as plain data, for the worker snapshot."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(totals, key, value):
+        totals[key] = totals.get(key, 0) + value
+
+    def _samples(self, values):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down; ``set_function`` makes it read a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Counts the enclosed block as in progress."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def values(self):
+        if self._function is not None:
+            return {(): self._function()}
+        return super().values()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = _HistogramValue(self.buckets)
+            histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+            histogram.sum += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the enclosed block takes, whether or not it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def values(self):
+        with self._lock:
+            return {key: (list(h.counts), h.sum) for key, h in self._values.items()}
+
+    @staticmethod
+    def add(totals, key, value):
+        counts, total = value
+        if key in totals:
+            counts = [a + b for a, b in zip(totals[key][0], counts)]
+            total += totals[key][1]
+        totals[key] = (list(counts), total)
+
+    def _samples(self, values):
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = (("le", _format_value(bound) if bound == math.inf else repr(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+# All metrics in the Prometheus text exposition format, summed over the workers sharing METRICS_DIR
+def render_metrics():
+    if not METRICS_DIR:
+        return "\n".join(metric.render() for metric in _metrics) + "\n"
+    flush()
+    totals = {metric.name: {} for metric in _metrics}
+    for snapshot in _snapshots():
+        alive = process_alive(snapshot["pid"])
+        for metric in _metrics:
+            # Counts of exited workers are kept so totals never go down; their gauges are stale
+            if isinstance(metric, Gauge) and not alive:
+                continue
+            for key, value in snapshot["metrics"].get(metric.name, []):
+                metric.add(totals[metric.name], tuple(key), value)
+    return "\n".join(metric.render(totals[metric.name]) for metric in _metrics) + "\n"
+
+
+# Callables whose dicts the *-stats endpoints report, written to METRICS_DIR with the metrics
+_stats_sources = {}
+
+
+def share_stats(name, function):
+    _stats_sources[name] = function
+
+
+def worker_stats(name):
+    """``function()`` of the source registered as ``name``, plus {"workers": {pid: stats}} of
+    every live worker sharing METRICS_DIR (this one up to date, the others as of their last write)."""
+    stats = _stats_sources[name]()
+    if METRICS_DIR:
+        flush()
+        stats["workers"] = {str(s["pid"]): s["stats"][name] for s in _snapshots()
+                            if name in s.get("stats", {}) and process_alive(s["pid"])}
+    return stats
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def flush():
+    """Writes this worker's metric values and stats to METRICS_DIR."""
+    snapshot = {
+        "pid": os.getpid(),
+        "time": time.time(),
+        "metrics": {metric.name: [[list(key), value] for key, value in metric.values().items()] for metric in _metrics},
+        "stats": {name: function() for name, function in _stats_sources.items()},
+    }
+    path = _snapshot_path(os.getpid())
+    # Readers in other processes only ever see a complete file
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _snapshots():
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            pass
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(colored(f"⚠️ [AI Server] Failed to write metrics to {METRICS_DIR}: {e}", "yellow"))
+
+
+if METRICS_DIR:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+# Stages: ingest (request parsing/decoding), upload, queue_prompt, queue_wait (queued until ComfyUI
+# starts it), sampling (sampler nodes, from progress events), history, download, preview_relay, response
+stage_seconds = Histogram("ai_stage_seconds", "Seconds spent in each stage of a job", ("stage",))
+request_errors = Counter("ai_request_errors_total", "Responses with an error status, per route", ("route", "status"))
+job_failures = Counter("ai_job_failures_total", "Background jobs that failed, per job kind", ("kind",))
+jobs_in_flight = Gauge("ai_jobs_in_flight", "Jobs being worked on, synchronous requests and background jobs alike")
+preview_queue_depth = Gauge("ai_preview_queue_depth", "Preview frames waiting to be relayed")
+
+
+@contextmanager
+def timed(stage, **attributes):
+    """Observes the enclosed block in ai_stage_seconds and traces it as a span of the current request."""
+    with span(stage, **attributes), stage_seconds.time(stage=stage):
+        yield
+
+
+# A stage that ended just now, e.g. one measured from a request's start time
+def observe_stage(stage, seconds, **attributes):
+    now = time.time()
+    stage_seconds.observe(seconds, stage=stage)
+    record_span(stage, now - seconds, now, **attributes)
+
+
+class PromptTimer:
+    """Splits a prompt's time in ComfyUI into queue wait and sampling, from its WebSocket events.
+
+    Created right after the prompt is queued. Sampling is the time from each
+    node starting to execute until its last ``progress`` event, summed over
+    the nodes that report progress (the samplers). Both are also traced, as
+    one ``queue_wait`` span and a ``sampling`` span per sampler node.
+    """
+
+    def __init__(self):
+        self.queued = time.monotonic()
+        # Converts the monotonic readings to wall-clock times for the spans
+        self._wall_offset = time.time() - self.queued
+        self.started = None
+        self._node_started = {}
+        self._sampling = {}
+
+    def event(self, message):
+        now = time.monotonic()
+        data = message.get('data') or {}
+        if self.started is None:
+            self.started = now
+            stage_seconds.observe(now - self.queued, stage="queue_wait")
+            record_span("queue_wait", self.queued + self._wall_offset, now + self._wall_offset)
+        if message.get('type') == 'executing' and data.get('node') is not None:
+            self._node_started[data['node']] = now
+        elif message.get('type') == 'progress':
+            node = data.get('node')
+            start = self._sampling[node][0] if node in self._sampling else self._node_started.get(node, now)
+            self._sampling[node] = (start, now)
+
+    def finished(self):
+        if self._sampling:
+            stage_seconds.observe(sum(end - start for start, end in self._sampling.values()), stage="sampling")
+        for node, (start, end) in self._sampling.items():
+            record_span("sampling", start + self._wall_offset, end + self._wall_offset, node=node)
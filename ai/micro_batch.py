@@ -0,0 +1,131 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+
+# Seconds to hold the first job of a batch while waiting for compatible ones; 0 disables batching
+MICRO_BATCH_WINDOW = float(os.getenv('MICRO_BATCH_WINDOW', 0))
+# A batch is run as soon as it has this many jobs
+MICRO_BATCH_MAX = int(os.getenv('MICRO_BATCH_MAX', 4))
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.timer = None
+
+
+class MicroBatcher:
+    """Collects jobs with the same key for up to ``window`` seconds and runs them together.
+
+    ``run_batch(key, items)`` must return one result per item, in order; if it
+    raises, every job in the batch fails with that error. For the threaded
+    (Flask) server: a full batch runs on the thread that filled it, a timed-out
+    one on its timer thread.
+    """
+
+    def __init__(self, run_batch, window=MICRO_BATCH_WINDOW, max_size=MICRO_BATCH_MAX):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    def submit(self, key, item):
+        future = Future()
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _Batch()
+                batch.timer = threading.Timer(self.window, self._flush, (key, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.items.append(item)
+            batch.futures.append(future)
+            full = len(batch.items) >= self.max_size
+            if full:
+                del self._pending[key]
+                batch.timer.cancel()
+
+        if full:
+            self._run(key, batch)
+        return future.result()
+
+    def _flush(self, key, batch):
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+            del self._pending[key]
+        self._run(key, batch)
+
+    def _run(self, key, batch):
+        try:
+            results = self.run_batch(key, batch.items)
+        except BaseException as e:
+            for future in batch.futures:
+                future.set_exception(e)
+        else:
+            for future, result in zip(batch.futures, results):
+                future.set_result(result)
+
+
+class AsyncMicroBatcher:
+    """asyncio variant of MicroBatcher; ``run_batch`` is a coroutine function.
+
+    Jobs whose caller was cancelled before the batch starts are dropped from
+    it, and a batch nobody is waiting for any more is not run at all.
+    """
+
+    def __init__(self, run_batch, window=MICRO_BATCH_WINDOW, max_size=MICRO_BATCH_MAX):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._tasks = set()
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch()
+            batch.timer = loop.call_later(self.window, self._flush, key, batch)
+        future = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        if len(batch.items) >= self.max_size:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        live = [(item, future) for item, future in zip(batch.items, batch.futures) if not future.done()]
+        if not live:
+            return
+        task = asyncio.ensure_future(self._run(key, live))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, live):
+        items, futures = [item for item, _ in live], [future for _, future in live]
+        try:
+            results = await self.run_batch(key, items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
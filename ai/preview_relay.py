@@ -0,0 +1,153 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+
+from termcolor import colored
+
+from http_client import RELAY_TIMEOUT, TIMEOUT, session as http
+from image_utils import thumbnail_data_url
+from metrics import timed
+from tracing import trace_headers
+
+# Preview relay endpoint of the Node backend's event server
+RELAY_URL = os.getenv('PREVIEW_RELAY_URL', 'http://localhost:5001/relay')
+
+# Frames kept per socket while the relay is busy; 1 means only the newest survives
+PREVIEW_QUEUE_SIZE = int(os.getenv('PREVIEW_QUEUE_SIZE', 1))
+# Upper bound on previews pushed per socket per second (0 disables the limit)
+PREVIEW_MAX_FPS = float(os.getenv('PREVIEW_MAX_FPS', 5))
+PREVIEW_RELAY_WORKERS = int(os.getenv('PREVIEW_RELAY_WORKERS', 2))
+
+
+# Push a preview image to the Node backend, which forwards it to the client's socket.
+# An error status raises, so the frame is counted as failed rather than sent
+def post_preview(socket_id, data_url):
+    response = http.post(RELAY_URL, json={
+        "socketId": socket_id,
+        "event": "preview",
+        "data": {"image": data_url}
+    }, headers=trace_headers(), timeout=RELAY_TIMEOUT)
+    response.raise_for_status()
+
+
+# Fetch a ComfyUI output image (e.g. an intermediate PreviewImage) and downscale it for the relay.
+# Meant to be submitted as a callable, so superseded outputs are never downloaded.
+def output_preview(server_address, image):
+    response = http.get(f"http://{server_address}/view", params={
+        "filename": image['filename'], "subfolder": image['subfolder'], "type": image['type']
+    }, timeout=TIMEOUT)
+    response.raise_for_status()
+    return thumbnail_data_url(response.content, "PNG")
+
+
+class PreviewRelay:
+    """Sends preview frames from background threads, latest-wins per socket.
+
+    ``submit`` never blocks: it appends to a bounded per-socket queue, so when
+    the relay falls behind the oldest frames are dropped. Frames may be passed
+    as a zero-argument callable that builds the data URL, in which case
+    dropped frames are never encoded at all. At most one frame per socket is
+    in flight, and sends to a socket are spaced by ``1 / max_fps`` seconds.
+    Frames are sent in a copy of the submitter's context, so they are traced
+    as part of its request.
+    """
+
+    def __init__(self, send=post_preview, queue_size=PREVIEW_QUEUE_SIZE, max_fps=PREVIEW_MAX_FPS,
+                 workers=PREVIEW_RELAY_WORKERS):
+        self.send = send
+        self.queue_size = max(1, queue_size)
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.workers = max(1, workers)
+
+        self.submitted = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        self._queues = {}
+        self._busy = set()
+        self._last_sent = {}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, socket_id, frame):
+        with self._cond:
+            self._ensure_started()
+            frames = self._queues.get(socket_id)
+            if frames is None:
+                frames = self._queues[socket_id] = deque(maxlen=self.queue_size)
+            if len(frames) == frames.maxlen:
+                self.dropped += 1
+            frames.append((frame, contextvars.copy_context()))
+            self.submitted += 1
+            self._cond.notify()
+
+    def depth(self):
+        """Frames waiting to be sent, across all sockets."""
+        with self._cond:
+            return sum(len(frames) for frames in self._queues.values())
+
+    def _ensure_started(self):
+        # Caller holds self._cond
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"preview-relay-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_ready(self):
+        # Caller holds self._cond. Returns (socket_id, None) or (None, seconds until one is due)
+        now = time.monotonic()
+        wait = None
+        for socket_id, frames in self._queues.items():
+            if not frames or socket_id in self._busy:
+                continue
+            due = self._last_sent.get(socket_id, 0) + self.min_interval
+            if due <= now:
+                return socket_id, None
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                socket_id, wait = self._next_ready()
+                while socket_id is None:
+                    self._cond.wait(wait)
+                    socket_id, wait = self._next_ready()
+                frame, context = self._queues[socket_id].popleft()
+                self._busy.add(socket_id)
+
+            ok = False
+            try:
+                context.run(self._send_frame, socket_id, frame)
+                ok = True
+            except Exception as e:
+                print(colored(f"Error streaming preview to {socket_id}: {e}", "red"))
+            finally:
+                with self._cond:
+                    if ok:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+                    self._busy.discard(socket_id)
+                    self._last_sent[socket_id] = time.monotonic()
+                    if not self._queues.get(socket_id):
+                        self._queues.pop(socket_id, None)
+                    self._forget_idle_sockets()
+                    self._cond.notify_all()
+
+    def _send_frame(self, socket_id, frame):
+        with timed("preview_relay", socket_id=socket_id):
+            data_url = frame() if callable(frame) else frame
+            if data_url:
+                self.send(socket_id, data_url)
+
+    def _forget_idle_sockets(self):
+        # Caller holds self._cond. Rate-limit state is only needed while it can still delay a send
+        cutoff = time.monotonic() - self.min_interval
+        for socket_id in [s for s, t in self._last_sent.items() if t < cutoff and s not in self._queues]:
+            del self._last_sent[socket_id]
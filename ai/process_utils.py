@@ -0,0 +1,12 @@
+import os
+
+
+# Whether a process (e.g. another gunicorn worker) is still running; signal 0 checks without signalling
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
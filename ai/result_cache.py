@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from termcolor import colored
+
+# In-memory tier, bounded by the total size of the cached images
+RESULT_CACHE_BYTES = int(os.getenv('RESULT_CACHE_BYTES', 256 * 1024 * 1024))
+# Optional on-disk tier; disabled unless a directory is configured
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_BYTES = int(os.getenv('RESULT_CACHE_DISK_BYTES', 2 * 1024 * 1024 * 1024))
+
+_DISK_SUFFIX = ".result"
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Hash a fully bound workflow (JSON text or graph dict)
+def cache_key(workflow):
+    if not isinstance(workflow, str):
+        workflow = json.dumps(workflow, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(workflow.encode('utf-8')).hexdigest()
+
+
+def result_key(template, inputs=None, **params):
+    """Cache key for ``template`` bound to ``params``.
+
+    Image inputs are bound to the digest of their content instead of their
+    upload name, so the key is known before anything is sent to ComfyUI.
+    """
+    digests = {name: "sha256:" + content_digest(data) for name, data in (inputs or {}).items()}
+    return cache_key(template.render(**params, **digests))
+
+
+def _images_size(images):
+    return sum(len(data) for outputs in images.values() for data in outputs)
+
+
+class ResultCache:
+    """Maps cache keys to ``{node_id: [image bytes]}`` results.
+
+    Entries live in an LRU bounded by ``max_bytes``. With a ``directory``,
+    every stored result is also written to disk, and the directory is kept
+    under ``max_disk_bytes`` by evicting the least recently used files.
+    Disk hits are promoted back into memory.
+
+    The directory may be shared by several worker processes. Files are
+    ordered by modification time (reads touch them), and the disk index is
+    rebuilt from a scan after every write, so the budget holds for the
+    directory as a whole rather than per process.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, directory=RESULT_CACHE_DIR,
+                 max_disk_bytes=RESULT_CACHE_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            self._scan_directory()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self.directory is not None
+
+    def get(self, key):
+        with self._lock:
+            images = self._memory.get(key)
+            if images is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return images
+            # Files missing from the index may have been written by another worker sharing the directory
+            on_disk = key in self._disk or (self.directory is not None and os.path.exists(self._path(key)))
+
+        images = self._read(key) if on_disk else None
+        with self._lock:
+            if images is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            else:
+                self._disk[key] = _images_size(images)
+                self._disk_bytes += self._disk[key]
+            self._remember(key, images)
+        return images
+
+    def put(self, key, images):
+        if not images:
+            return
+        with self._lock:
+            self._remember(key, images)
+            if self.directory is None or key in self._disk:
+                return
+        self._write(key, images)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key, images):
+        # Caller holds self._lock
+        size = _images_size(images)
+        if size > self.max_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= _images_size(previous)
+        self._memory[key] = images
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= _images_size(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _DISK_SUFFIX)
+
+    def _scan_directory(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._index(self._scan())
+        print(colored(f"Result cache: {len(self._disk)} entries ({self._disk_bytes} bytes) on disk in {self.directory}", "cyan"))
+
+    # Every .result file in the directory as (key, size), least recently used first
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_DISK_SUFFIX) and entry.is_file():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another worker during the scan
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-len(_DISK_SUFFIX)], stat.st_size))
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def _index(self, entries):
+        # Caller holds self._lock, or is __init__
+        self._disk = OrderedDict(entries)
+        self._disk_bytes = sum(self._disk.values())
+
+    # File layout: one JSON header line listing [node_id, [sizes...]], then the image bytes
+    def _write(self, key, images):
+        header = json.dumps([[node_id, [len(data) for data in outputs]] for node_id, outputs in images.items()])
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(header.encode('utf-8') + b"\n")
+                for outputs in images.values():
+                    for data in outputs:
+                        f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(colored(f"Result cache: failed to write {path}: {e}", "yellow"))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        # Other workers may have written to the directory since the last scan
+        entries = self._scan()
+        with self._lock:
+            self._index(entries)
+            evicted = []
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old_key, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                images = {node_id: [f.read(size) for size in sizes] for node_id, sizes in header}
+            os.utime(path)
+            return images
+        except (OSError, ValueError) as e:
+            print(colored(f"Result cache: dropping unreadable entry {path}: {e}", "yellow"))
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+
+# Shared by every request thread in the process
+result_cache = ResultCache()
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs one job per key at a time; concurrent callers with the same key share its result.
+
+    For the threaded (Flask) server. Unlike :class:`AsyncSingleFlight` there
+    is no reference-counted cancellation: WSGI gives no signal when a client
+    goes away, so a caller can't detach, every caller waits for the job to
+    finish, and the ComfyUI prompt is never interrupted on their behalf.
+    Abandoned jobs are only cancelled by the asyncio server.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = fn(*args)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """asyncio variant of SingleFlight with reference-counted cancellation.
+
+    The job runs in its own task. A caller that is cancelled (e.g. its
+    client disconnected) only detaches; the job itself is cancelled once
+    every caller attached to it has gone.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def run(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(factory()))
+            call.task.add_done_callback(lambda _, call=call: self._forget(key, call))
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody wants the result any more; new callers must start a fresh job
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from micro_batch import AsyncMicroBatcher, MicroBatcher
+from workflows import snap_to_bucket
+
+BUCKETS = [(1024, 1024), (1152, 896), (896, 1152), (1344, 768)]
+
+
+@pytest.mark.parametrize("size, bucket", [
+    ((1024, 1024), (1024, 1024)),
+    ((512, 512), (1024, 1024)),
+    ((1000, 1040), (1024, 1024)),
+    ((1200, 900), (1152, 896)),
+    ((900, 1200), (896, 1152)),
+    ((1920, 1080), (1344, 768)),
+])
+def test_snap_to_bucket(size, bucket):
+    assert snap_to_bucket(*size, buckets=BUCKETS) == bucket
+
+
+class Recorder:
+    """A run_batch that records the batches it was given and returns one result per item."""
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def __call__(self, key, items):
+        with self._lock:
+            self.batches.append((key, list(items)))
+        if self.fail:
+            raise RuntimeError("ComfyUI went away")
+        return [(key, item) for item in items]
+
+
+def submit_all(batcher, jobs):
+    with ThreadPoolExecutor(len(jobs)) as pool:
+        return list(pool.map(lambda job: batcher.submit(*job), jobs))
+
+
+def test_jobs_are_batched_per_bucket():
+    recorder = Recorder()
+    batcher = MicroBatcher(recorder, window=0.2, max_size=8)
+    jobs = [((1024, 1024), "a"), ((1152, 896), "b"), ((1024, 1024), "c")]
+    assert submit_all(batcher, jobs) == [((1024, 1024), "a"), ((1152, 896), "b"), ((1024, 1024), "c")]
+    batches = sorted((key, sorted(items)) for key, items in recorder.batches)
+    assert batches == [((1024, 1024), ["a", "c"]), ((1152, 896), ["b"])]
+
+
+def test_full_batch_runs_without_waiting_for_the_window():
+    recorder = Recorder()
+    batcher = MicroBatcher(recorder, window=30, max_size=2)
+    started = time.monotonic()
+    submit_all(batcher, [("key", "a"), ("key", "b")])
+    assert time.monotonic() - started < 5
+    assert len(recorder.batches) == 1
+
+
+def test_batch_error_reaches_every_job():
+    batcher = MicroBatcher(Recorder(fail=True), window=0.05, max_size=2)
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(batcher.submit, "key", item) for item in "ab"]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(5)
+
+
+def test_disabled_without_a_window():
+    assert not MicroBatcher(Recorder(), window=0).enabled
+    assert not MicroBatcher(Recorder(), window=1, max_size=1).enabled
+
+
+class AsyncRecorder(Recorder):
+    async def __call__(self, key, items):
+        return Recorder.__call__(self, key, items)
+
+
+def test_async_jobs_are_batched_per_bucket():
+    async def scenario():
+        recorder = AsyncRecorder()
+        batcher = AsyncMicroBatcher(recorder, window=0.05, max_size=8)
+        results = await asyncio.gather(batcher.submit((1024, 1024), "a"), batcher.submit((896, 1152), "b"),
+                                       batcher.submit((1024, 1024), "c"))
+        assert results == [((1024, 1024), "a"), ((896, 1152), "b"), ((1024, 1024), "c")]
+        assert sorted(recorder.batches) == [((896, 1152), ["b"]), ((1024, 1024), ["a", "c"])]
+
+    asyncio.run(scenario())
+
+
+def test_async_cancelled_job_is_dropped_from_its_batch():
+    async def scenario():
+        recorder = AsyncRecorder()
+        batcher = AsyncMicroBatcher(recorder, window=0.05, max_size=8)
+        kept = asyncio.ensure_future(batcher.submit("key", "kept"))
+        dropped = asyncio.ensure_future(batcher.submit("key", "dropped"))
+        await asyncio.sleep(0)
+        dropped.cancel()
+        assert await kept == ("key", "kept")
+        assert recorder.batches == [("key", ["kept"])]
+
+    asyncio.run(scenario())
+
+
+def test_async_batch_nobody_waits_for_is_not_run():
+    async def scenario():
+        recorder = AsyncRecorder()
+        batcher = AsyncMicroBatcher(recorder, window=0.05, max_size=8)
+        task = asyncio.ensure_future(batcher.submit("key", "a"))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.sleep(0.1)
+        assert recorder.batches == []
+
+    asyncio.run(scenario())
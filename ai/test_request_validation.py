@@ -0,0 +1,115 @@
+import asyncio
+import base64
+import io
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+import aio_server
+import main
+from workflows import parse_seed, parse_steps
+
+
+def png(mode="RGB", size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+IMAGE = png()
+MASK = png("RGBA")
+FILES = {"/edit-image": {"image": IMAGE}, "/inpaint-image": {"image": IMAGE, "mask": MASK}, "/generate-image": {}}
+
+# (route, body: json, form or raw image with the fields in the query string, fields, expected error).
+# Every one is rejected before anything is sent to ComfyUI.
+CASES = [
+    ("/edit-image", "json", {"prompt": "p", "steps": "abc"}, "Invalid steps"),
+    ("/edit-image", "json", {"prompt": "p", "steps": 0}, "Invalid steps"),
+    ("/edit-image", "form", {"prompt": "p", "steps": "abc"}, "Invalid steps"),
+    ("/edit-image", "raw", {"prompt": "p", "steps": "abc"}, "Invalid steps"),
+    ("/edit-image", "json", {"prompt": "p", "seed": -1}, "Invalid seed"),
+    ("/edit-image", "form", {"prompt": "p", "seed": "abc"}, "Invalid seed"),
+    ("/edit-image", "raw", {"prompt": "p", "seed": "abc"}, "Invalid seed"),
+    ("/edit-image", "json", {"steps": 2}, "No prompt provided"),
+    ("/inpaint-image", "json", {"prompt": "p", "steps": "abc"}, "Invalid steps"),
+    ("/inpaint-image", "form", {"prompt": "p", "steps": "abc"}, "Invalid steps"),
+    ("/inpaint-image", "json", {"prompt": "p", "seed": "abc"}, "Invalid seed"),
+    ("/inpaint-image", "form", {"prompt": "p", "seed": "-1"}, "Invalid seed"),
+    ("/generate-image", "json", {"prompt": "p", "seed": -5}, "Invalid seed"),
+    ("/generate-image", "json", {"prompt": "p", "count": 99}, "Invalid count"),
+]
+IDS = [f"{route[1:]}-{body}-{error.split()[-1]}" for route, body, fields, error in CASES]
+
+
+def data_url(data):
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+def flask_post(route, body, fields):
+    client = main.app.test_client()
+    files = FILES[route]
+    if body == "json":
+        response = client.post(route, json={**fields, **{name: data_url(data) for name, data in files.items()}})
+    elif body == "form":
+        form = {name: str(value) for name, value in fields.items()}
+        form.update({name: (io.BytesIO(data), f"{name}.png") for name, data in files.items()})
+        response = client.post(route, data=form, content_type="multipart/form-data")
+    else:
+        response = client.post(route, query_string=fields, data=files["image"], content_type="image/png")
+    return response.status_code, response.get_json()
+
+
+async def aio_post(route, body, fields):
+    files = FILES[route]
+    async with TestClient(TestServer(aio_server.create_app())) as client:
+        if body == "json":
+            kwargs = {"json": {**fields, **{name: data_url(data) for name, data in files.items()}}}
+        elif body == "form":
+            form = aiohttp.FormData()
+            for name, value in fields.items():
+                form.add_field(name, str(value))
+            for name, data in files.items():
+                form.add_field(name, data, filename=f"{name}.png", content_type="image/png")
+            kwargs = {"data": form}
+        else:
+            kwargs = {"params": {name: str(value) for name, value in fields.items()}, "data": files["image"],
+                      "headers": {"Content-Type": "image/png"}}
+        response = await client.post(route, **kwargs)
+        return response.status, await response.json()
+
+
+@pytest.mark.parametrize("route, body, fields, error", CASES, ids=IDS)
+def test_flask_rejects_bad_input(route, body, fields, error):
+    assert flask_post(route, body, fields) == (400, {"error": error})
+
+
+@pytest.mark.parametrize("route, body, fields, error", CASES, ids=IDS)
+def test_aio_rejects_bad_input(route, body, fields, error):
+    assert asyncio.run(aio_post(route, body, fields)) == (400, {"error": error})
+
+
+@pytest.mark.parametrize("value, expected", [(None, None), ("", None), ("7", 7), (7, 7)])
+def test_parse_steps(value, expected):
+    assert parse_steps(value) == expected
+
+
+def test_parse_steps_default():
+    assert parse_steps(None, 25) == 25
+    assert parse_steps("", 25) == 25
+
+
+@pytest.mark.parametrize("value", ["abc", "2.5", "0", -1])
+def test_parse_steps_rejects(value):
+    with pytest.raises(ValueError):
+        parse_steps(value)
+
+
+def test_parse_seed():
+    assert parse_seed(None) is None
+    assert parse_seed("0") == 0
+    with pytest.raises(ValueError):
+        parse_seed("-1")
+    with pytest.raises(ValueError):
+        parse_seed("abc")
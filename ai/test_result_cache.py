@@ -0,0 +1,82 @@
+import os
+
+from result_cache import ResultCache
+
+KB = 1024
+
+
+def image(size, fill=b"x"):
+    return {"9": [fill * size]}
+
+
+def disk_cache(directory, max_disk_bytes, max_bytes=0):
+    return ResultCache(max_bytes=max_bytes, directory=str(directory), max_disk_bytes=max_disk_bytes)
+
+
+def files(directory):
+    return sorted(name for name in os.listdir(directory))
+
+
+def age(directory, key, seconds_ago):
+    path = os.path.join(directory, key + ".result")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime - seconds_ago))
+
+
+def test_memory_lru_is_bounded_by_bytes():
+    cache = ResultCache(max_bytes=3 * KB, directory="")
+    for key in "abc":
+        cache.put(key, image(KB))
+    cache.get("a")
+    cache.put("d", image(KB))
+    assert cache.get("b") is None
+    assert [cache.get(key) is not None for key in "acd"] == [True, True, True]
+    assert cache.stats()["memory_bytes"] <= 3 * KB
+
+
+def test_disk_round_trip_keeps_every_output(tmp_path):
+    images = {"9": [b"first", b"second"], "12": [b"third"]}
+    disk_cache(tmp_path, 10 * KB).put("k", images)
+    assert disk_cache(tmp_path, 10 * KB).get("k") == images
+
+
+def test_disk_evicts_least_recently_used(tmp_path):
+    cache = disk_cache(tmp_path, 3 * KB + 200)
+    for i, key in enumerate(["old", "used", "new"]):
+        cache.put(key, image(KB))
+        age(tmp_path, key, 30 - 10 * i)
+    # Reading an entry makes it the most recently used
+    assert cache.get("used") is not None
+    cache.put("newest", image(KB))
+    assert files(tmp_path) == ["new.result", "newest.result", "used.result"]
+    assert cache.stats()["disk_bytes"] <= 3 * KB + 200
+
+
+def test_disk_budget_holds_for_workers_sharing_the_directory(tmp_path):
+    # Two processes' caches over one directory: the budget is for the directory, not per cache
+    budget = 4 * KB + 400
+    workers = [disk_cache(tmp_path, budget), disk_cache(tmp_path, budget)]
+    for i in range(12):
+        workers[i % 2].put(f"key{i:02d}", image(KB))
+    total = sum(os.path.getsize(os.path.join(tmp_path, name)) for name in files(tmp_path))
+    assert total <= budget
+    assert "key11.result" in files(tmp_path)
+    assert not [name for name in files(tmp_path) if name.endswith(".tmp")]
+
+
+def test_entry_written_by_another_worker_is_a_disk_hit(tmp_path):
+    reader = disk_cache(tmp_path, 10 * KB, max_bytes=10 * KB)
+    disk_cache(tmp_path, 10 * KB).put("k", image(100))
+    assert reader.get("k") == image(100)
+    assert reader.stats()["disk_hits"] == 1
+    # Promoted into memory: the next read doesn't touch the disk
+    os.remove(os.path.join(tmp_path, "k.result"))
+    assert reader.get("k") == image(100)
+
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    cache = disk_cache(tmp_path, 10 * KB)
+    with open(os.path.join(tmp_path, "broken.result"), "wb") as f:
+        f.write(b"not json\n")
+    assert cache.get("broken") is None
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import AsyncSingleFlight, SingleFlight
+
+
+class Job:
+    """A job that runs until released, counting how often it was started and whether it was cancelled."""
+
+    def __init__(self, result="images"):
+        self.result = result
+        self.started = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return self.result
+
+
+async def callers(flight, job, count):
+    tasks = [asyncio.ensure_future(flight.run("key", job)) for _ in range(count)]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_concurrent_callers_share_one_run():
+    async def scenario():
+        flight, job = AsyncSingleFlight(), Job()
+        tasks = await callers(flight, job, 3)
+        job.release.set()
+        assert await asyncio.gather(*tasks) == ["images"] * 3
+        assert job.started == 1
+        assert flight.in_flight() == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("cancelled", [0, 1], ids=["leader", "follower"])
+def test_cancelled_caller_only_detaches(cancelled):
+    async def scenario():
+        flight, job = AsyncSingleFlight(), Job()
+        tasks = await callers(flight, job, 2)
+        tasks[cancelled].cancel()
+        await asyncio.sleep(0)
+        assert flight.in_flight() == 1
+        job.release.set()
+        assert await tasks[1 - cancelled] == "images"
+        assert tasks[cancelled].cancelled()
+        assert not job.cancelled
+
+    asyncio.run(scenario())
+
+
+def test_job_is_cancelled_when_every_caller_has_gone():
+    async def scenario():
+        flight, job = AsyncSingleFlight(), Job()
+        tasks = await callers(flight, job, 2)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert job.cancelled
+        assert flight.in_flight() == 0
+
+        # A new caller starts a fresh run instead of attaching to the cancelled one
+        fresh = Job("fresh")
+        task = asyncio.ensure_future(flight.run("key", fresh))
+        await asyncio.sleep(0)
+        fresh.release.set()
+        assert await task == "fresh"
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_caller():
+    async def scenario():
+        flight = AsyncSingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise RuntimeError("ComfyUI went away")
+
+        results = await asyncio.gather(*(flight.run("key", failing) for _ in range(2)), return_exceptions=True)
+        assert [str(result) for result in results] == ["ComfyUI went away"] * 2
+        assert flight.in_flight() == 0
+
+    asyncio.run(scenario())
+
+
+def test_threaded_callers_share_one_run():
+    flight = SingleFlight()
+    started = []
+    release = threading.Event()
+    arrived = threading.Barrier(4)
+
+    def job():
+        started.append(1)
+        release.wait(5)
+        return "images"
+
+    def caller():
+        arrived.wait(5)
+        return flight.run("key", job)
+
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(caller) for _ in range(3)]
+        arrived.wait(5)
+        # Followers can't be observed, so give every caller time to attach before the job finishes
+        time.sleep(0.1)
+        release.set()
+        assert [future.result(5) for future in futures] == ["images"] * 3
+    assert len(started) == 1
+    assert flight.in_flight() == 0
+
+
+def test_threaded_error_reaches_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def job():
+        release.wait(5)
+        raise RuntimeError("ComfyUI went away")
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(flight.run, "key", job) for _ in range(2)]
+        while flight.in_flight() == 0:
+            pass
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(5)
@@ -0,0 +1,434 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+from termcolor import colored
+
+# Header carrying the caller's trace id (set by the Node backend); a W3C traceparent is accepted too
+TRACE_HEADER = os.getenv('TRACE_HEADER', 'X-Trace-Id')
+# Finished traces kept in memory for /traces
+TRACE_KEEP = int(os.getenv('TRACE_KEEP', 256))
+# Fraction of traces appended to TRACE_EXPORT_FILE as OTLP JSON (0 = none, 1 = every request)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+# Traces taking at least this many seconds are exported whatever the sample rate (0 = off)
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', 0))
+# One OTLP/JSON ExportTraceServiceRequest per line, as read by the collector's otlpjsonfile receiver
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE', 'traces.jsonl')
+# Traces waiting to be written; more than this and new ones are dropped
+TRACE_EXPORT_QUEUE = int(os.getenv('TRACE_EXPORT_QUEUE', 64))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'ai-server')
+# Directory shared by the worker processes of one host (set by gunicorn.conf.py). Finished traces
+# are written there too, so /traces and /traces/<id> cover every worker, not just the one asked.
+TRACE_DIR = os.getenv('TRACE_DIR', '')
+
+_TRACE_ID = re.compile(r"^[0-9a-f]{32}$")
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+
+# The span new spans in this thread/task are children of
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, trace, name, parent_id, attributes, kind=INTERNAL, start=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes)
+        self.start = time.time() if start is None else start
+        self.end_time = None
+        self.error = None
+        self._counted = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.error = str(error) or type(error).__name__
+
+    def end(self, end=None):
+        if self.end_time is None:
+            self.end_time = time.time() if end is None else end
+            self.trace._ended(self)
+
+    @property
+    def duration(self):
+        return None if self.end_time is None else self.end_time - self.start
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "start": self.start,
+            "offsetMs": round((self.start - self.trace.root.start) * 1000, 3),
+            "durationMs": None if self.end_time is None else round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int((self.end_time or self.start) * 1e9)),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Trace:
+    """The spans of one request (and of the background job it started).
+
+    The trace is finished once every span started before that point has
+    ended; spans started later (e.g. a preview relayed after the response)
+    are still kept, but the trace has already been exported by then.
+    """
+
+    def __init__(self, trace_id=None, sampled=False, store=None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.sampled = sampled
+        self.root = None
+        self.spans = []
+        self.finished = False
+        self._store = store
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def start_span(self, name, parent_id, attributes, kind=INTERNAL, start=None):
+        span = Span(self, name, parent_id, attributes, kind, start)
+        with self._lock:
+            if self.root is None:
+                self.root = span
+            self.spans.append(span)
+            if not self.finished:
+                span._counted = True
+                self._open += 1
+        return span
+
+    def _ended(self, span):
+        with self._lock:
+            if not span._counted:
+                return
+            self._open -= 1
+            if self._open or self.finished:
+                return
+            self.finished = True
+        if self._store is not None:
+            self._store.finish(self)
+
+    @property
+    def duration(self):
+        return max((s.end_time for s in self.spans if s.end_time is not None), default=self.root.start) - self.root.start
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return {
+            "traceId": self.trace_id,
+            "name": self.root.name,
+            "start": self.root.start,
+            "durationMs": round(self.duration * 1000, 3),
+            "spans": [span.to_dict() for span in spans],
+        }
+
+    def to_otlp(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": TRACE_SERVICE_NAME}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+
+
+class OtlpFileExporter:
+    """Appends sampled traces to a file as OTLP/JSON lines from a background thread.
+
+    Like the debug capture, requests never wait on the disk: traces are
+    queued and dropped when the writer falls behind.
+    """
+
+    def __init__(self, path=TRACE_EXPORT_FILE, sample_rate=TRACE_SAMPLE_RATE, slow_seconds=TRACE_SLOW_SECONDS,
+                 max_pending=TRACE_EXPORT_QUEUE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.exported = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wants(self, trace):
+        # Sampled callers, a random share of the rest, and every slow trace (the tail is what matters)
+        if trace.sampled or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return True
+        return self.slow_seconds > 0 and trace.duration >= self.slow_seconds
+
+    def export(self, trace):
+        if not self.wants(trace):
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(trace.to_otlp(), separators=(",", ":")) + "\n")
+                self.exported += 1
+            except Exception as e:
+                print(colored(f"⚠️ [AI Server] Failed to export trace {trace.trace_id}: {e}", "yellow"))
+
+
+def _summary(trace):
+    return {"traceId": trace.trace_id, "name": trace.root.name, "start": trace.root.start,
+            "durationMs": round(trace.duration * 1000, 3), "spans": len(trace.spans)}
+
+
+class StoredTrace:
+    """A finished trace read back from TRACE_DIR, e.g. one recorded by another worker."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data["trace"]
+
+    def to_otlp(self):
+        return self.data["otlp"]
+
+
+class TraceStore:
+    """The most recent finished traces, by id, for the /traces endpoints.
+
+    With a ``directory`` every finished trace is also written there from a
+    background thread, one file per trace, and the oldest files beyond
+    ``keep`` are removed; lookups then see the traces of every process
+    sharing the directory.
+    """
+
+    # Writes between prunes of the directory
+    PRUNE_EVERY = 32
+
+    def __init__(self, keep=TRACE_KEEP, exporter=None, directory=TRACE_DIR, max_pending=TRACE_EXPORT_QUEUE):
+        self.keep = keep
+        self.exporter = exporter
+        self.directory = directory
+        self.dropped = 0
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(max_pending)
+        self._writer = None
+        self._written = 0
+
+    def finish(self, trace):
+        with self._lock:
+            self._traces[trace.trace_id] = trace
+            self._traces.move_to_end(trace.trace_id)
+            while len(self._traces) > self.keep:
+                self._traces.popitem(last=False)
+            if self.directory and self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+                self._writer.start()
+        if self.directory:
+            try:
+                self._pending.put_nowait(trace)
+            except queue.Full:
+                self.dropped += 1
+        if self.exporter is not None:
+            self.exporter.export(trace)
+
+    def get(self, trace_id):
+        # Accepts the caller's UUID form as well
+        trace_id = trace_id.lower().replace("-", "")
+        with self._lock:
+            trace = self._traces.get(trace_id)
+        if trace is None and self.directory and _TRACE_ID.match(trace_id):
+            data = self._read(os.path.join(self.directory, f"{trace_id}.json"))
+            trace = StoredTrace(data) if data is not None else None
+        return trace
+
+    def recent(self, limit=50, min_ms=0):
+        """Summaries of the newest finished traces, newest first."""
+        if self.directory:
+            summaries = (data["summary"] for data in map(self._read, self._files_newest_first()) if data is not None)
+        else:
+            with self._lock:
+                summaries = [_summary(trace) for trace in reversed(self._traces.values())]
+        found = []
+        for summary in summaries:
+            if summary["durationMs"] >= min_ms:
+                found.append(summary)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def _write_loop(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            trace = self._pending.get()
+            try:
+                path = os.path.join(self.directory, f"{trace.trace_id}.json")
+                data = {"summary": _summary(trace), "trace": trace.to_dict(), "otlp": trace.to_otlp()}
+                # Readers in other processes only ever see a complete file
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp_path, path)
+                self._written += 1
+                if self._written % self.PRUNE_EVERY == 0:
+                    for old in self._files_newest_first()[self.keep:]:
+                        try:
+                            os.remove(old)
+                        except FileNotFoundError:
+                            pass  # Pruned by another worker at the same time
+            except Exception as e:
+                print(colored(f"⚠️ [AI Server] Failed to store trace {trace.trace_id}: {e}", "yellow"))
+
+    def _files_newest_first(self):
+        files = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return []
+        for entry in entries:
+            if entry.name.endswith(".json"):
+                try:
+                    files.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        return [path for _, path in sorted(files, reverse=True)]
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+# Shared by every request in the process
+trace_store = TraceStore(exporter=OtlpFileExporter())
+
+
+# (trace id, remote parent span id, sampled) from the caller's headers
+def _incoming(headers):
+    match = _TRACEPARENT.match((headers.get("traceparent") or "").strip().lower())
+    if match:
+        return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+    # The Node backend sends a UUID; with the dashes removed it is a valid 128-bit trace id
+    trace_id = (headers.get(TRACE_HEADER) or "").strip().lower().replace("-", "")
+    return (trace_id if _TRACE_ID.match(trace_id) else None), None, False
+
+
+def begin_trace(name, headers=None, **attributes):
+    """Starts the root span of a request and makes it current; returns (span, context token).
+
+    The trace continues the caller's trace id when its headers carry one.
+    """
+    trace_id, parent_id, sampled = _incoming(headers or {})
+    trace = Trace(trace_id, sampled, trace_store)
+    span = trace.start_span(name, parent_id, attributes, kind=SERVER)
+    return span, _current.set(span)
+
+
+def end_trace(token):
+    _current.reset(token)
+
+
+def current_span():
+    return _current.get()
+
+
+# Headers passing the current trace id on to another service (empty outside a trace)
+def trace_headers():
+    span = _current.get()
+    return {TRACE_HEADER: span.trace.trace_id} if span is not None else {}
+
+
+def start_span(name, **attributes):
+    """A child of the current span that is not made current (e.g. for work handed to a task); None outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        return None
+    return parent.trace.start_span(name, parent.span_id, attributes)
+
+
+@contextmanager
+def use_span(span):
+    """Makes ``span`` current for the enclosed block and ends it afterwards, recording any error."""
+    if span is None:
+        yield None
+        return
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        span.end()
+
+
+def span(name, **attributes):
+    """Traces the enclosed block as a child of the current span (a no-op outside a trace)."""
+    return use_span(start_span(name, **attributes))
+
+
+# A span that already happened, from wall-clock times (e.g. derived from ComfyUI events)
+def record_span(name, start, end, **attributes):
+    parent = _current.get()
+    if parent is not None:
+        parent.trace.start_span(name, parent.span_id, attributes, start=start).end(end)
+
+
+# fn(*args) as a callable that runs in a copy of the caller's context, so on another
+# thread its spans still belong to the caller's trace
+def in_context(fn, *args):
+    return partial(contextvars.copy_context().run, fn, *args)
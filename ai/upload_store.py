@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+
+from termcolor import colored
+
+# Bytes of uploaded inputs remembered per ComfyUI server before the least recently used are evicted
+UPLOAD_STORE_BYTES = int(os.getenv('UPLOAD_STORE_BYTES', 1024 * 1024 * 1024))
+# ComfyUI's input directory, when this host can reach it (same machine or shared volume).
+# Evicted uploads are deleted from it; without it eviction only forgets them.
+COMFYUI_INPUT_DIR = os.getenv('COMFYUI_INPUT_DIR', '')
+
+
+def upload_name(prefix, digest):
+    return f"{prefix}_{digest[:32]}.png"
+
+
+class _Upload:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.refs = 0
+
+
+class UploadStore:
+    """Index of the files each ComfyUI server already has, keyed by content hash.
+
+    Uploads are named after their SHA-256, so sending the same bytes twice is
+    skipped. A file is referenced while a job that uses it runs and is only
+    evicted (least recently used first, once a server holds more than
+    ``max_bytes``) when nothing references it.
+    """
+
+    def __init__(self, max_bytes=UPLOAD_STORE_BYTES, input_dir=COMFYUI_INPUT_DIR):
+        self.max_bytes = max_bytes
+        self.input_dir = input_dir
+        self._servers = {}
+        self._bytes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, address, digest):
+        """Returns the stored name and takes a reference, or None if it has to be uploaded."""
+        with self._lock:
+            uploads = self._servers.get(address)
+            upload = uploads.get(digest) if uploads else None
+            if upload is None:
+                self.misses += 1
+                return None
+            upload.refs += 1
+            uploads.move_to_end(digest)
+            self.hits += 1
+            return upload.name
+
+    def add(self, address, digest, name, size):
+        """Records a finished upload, referenced once by the caller."""
+        with self._lock:
+            uploads = self._servers.setdefault(address, OrderedDict())
+            upload = uploads.get(digest)
+            if upload is None:
+                upload = uploads[digest] = _Upload(name, size)
+                self._bytes[address] = self._bytes.get(address, 0) + size
+            upload.refs += 1
+            uploads.move_to_end(digest)
+            evicted = self._evict(address)
+        self._delete(evicted)
+
+    def release(self, address, digest):
+        with self._lock:
+            upload = self._servers.get(address, {}).get(digest)
+            if upload is not None:
+                upload.refs -= 1
+            evicted = self._evict(address)
+        self._delete(evicted)
+
+    def _evict(self, address):
+        # Caller holds self._lock; returns names no server references any more
+        uploads = self._servers.get(address, {})
+        evicted = []
+        for digest in list(uploads):
+            if self._bytes.get(address, 0) <= self.max_bytes:
+                break
+            upload = uploads[digest]
+            if upload.refs > 0:
+                continue
+            del uploads[digest]
+            self._bytes[address] -= upload.size
+            if not any(u.name == upload.name for s in self._servers.values() for u in s.values()):
+                evicted.append(upload.name)
+        return evicted
+
+    def _delete(self, names):
+        if not self.input_dir:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(self.input_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(colored(f"⚠️ Failed to delete evicted upload {name}: {e}", "yellow"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "servers": {
+                    address: {"files": len(uploads), "bytes": self._bytes.get(address, 0),
+                              "referenced": sum(1 for u in uploads.values() if u.refs > 0)}
+                    for address, uploads in self._servers.items()
+                },
+            }
+
+
+# Shared by every request in the process
+upload_store = UploadStore()
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import aiohttp
+from termcolor import colored
+
+from comfy_outputs import STREAM_CHUNK
+from http_client import CONNECT_TIMEOUT, session as http
+
+# Largest image accepted from an ``image`` URL
+FETCH_MAX_BYTES = int(os.getenv('FETCH_MAX_BYTES', 50 * 1024 * 1024))
+# Per-read timeout and overall deadline for one download, in seconds
+FETCH_READ_TIMEOUT = float(os.getenv('FETCH_READ_TIMEOUT', 15))
+FETCH_DEADLINE = float(os.getenv('FETCH_DEADLINE', 60))
+# Bytes of downloaded images kept for reuse; entries are revalidated with ETag/Last-Modified
+FETCH_CACHE_BYTES = int(os.getenv('FETCH_CACHE_BYTES', 256 * 1024 * 1024))
+
+
+class FetchError(Exception):
+    """An image URL could not be downloaded; the message is safe to show to the caller."""
+
+
+class _Entry:
+    def __init__(self, data, etag, last_modified, fresh_until):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+
+
+def _fresh_until(headers):
+    # Cache-Control max-age lets a repeat skip even the revalidation request
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age" and value.isdigit():
+            return time.monotonic() + int(value)
+    return 0
+
+
+class UrlCache:
+    """LRU of downloaded URL bodies, bounded in bytes.
+
+    Only responses that can be revalidated (ETag or Last-Modified) or that
+    carry a max-age are kept; anything else is downloaded every time.
+    """
+
+    def __init__(self, max_bytes=FETCH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def lookup(self, url):
+        """Returns ``(fresh data or None, conditional request headers)``."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                self.misses += 1
+                return None, {}
+            self._entries.move_to_end(url)
+            if entry.fresh_until > time.monotonic():
+                self.hits += 1
+                return entry.data, {}
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return None, headers
+
+    def not_modified(self, url, headers):
+        """Handles a 304: returns the cached bytes (None if they were evicted meanwhile)."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            entry.fresh_until = _fresh_until(headers)
+            self.revalidated += 1
+            return entry.data
+
+    def store(self, url, data, headers):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        fresh_until = _fresh_until(headers)
+        if not (etag or last_modified or fresh_until) or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._entries[url] = _Entry(data, etag, last_modified, fresh_until)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+# Shared by every request in the process
+url_cache = UrlCache()
+
+
+def _check_length(headers, max_bytes):
+    length = headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise FetchError(f"Image is larger than {max_bytes} bytes")
+
+
+def fetch(url, max_bytes=FETCH_MAX_BYTES, cache=url_cache):
+    """Downloads an image URL over the shared keep-alive session, or returns it from the cache.
+
+    Raises FetchError on HTTP errors, timeouts and bodies over ``max_bytes``.
+    """
+    data, conditional = cache.lookup(url)
+    if data is not None:
+        print(colored(f"♻️ [AI Server] URL cache hit: {url}", "green"))
+        return data
+
+    deadline = time.monotonic() + FETCH_DEADLINE
+    try:
+        with http.get(url, headers=conditional, timeout=(CONNECT_TIMEOUT, FETCH_READ_TIMEOUT), stream=True) as response:
+            if response.status_code == 304:
+                data = cache.not_modified(url, response.headers)
+                if data is not None:
+                    print(colored(f"♻️ [AI Server] URL not modified, reusing cached image: {url}", "green"))
+                    return data
+                return fetch(url, max_bytes, cache)
+            if response.status_code != 200:
+                raise FetchError(f"Image URL returned HTTP {response.status_code}")
+            _check_length(response.headers, max_bytes)
+            body = bytearray()
+            for chunk in response.iter_content(STREAM_CHUNK):
+                body += chunk
+                if len(body) > max_bytes:
+                    raise FetchError(f"Image is larger than {max_bytes} bytes")
+                if time.monotonic() > deadline:
+                    raise FetchError("Image download timed out")
+            data = bytes(body)
+            cache.store(url, data, response.headers)
+            return data
+    except FetchError:
+        raise
+    except Exception as e:
+        print(colored(f"❌ [AI Server] Error downloading {url}: {e}", "red"))
+        raise FetchError("Failed to download image from URL") from e
+
+
+async def fetch_async(session, url, max_bytes=FETCH_MAX_BYTES, cache=url_cache):
+    """asyncio counterpart of :func:`fetch` on an aiohttp session."""
+    data, conditional = cache.lookup(url)
+    if data is not None:
+        print(colored(f"♻️ [AI Server] URL cache hit: {url}", "green"))
+        return data
+
+    timeout = aiohttp.ClientTimeout(total=FETCH_DEADLINE, sock_connect=CONNECT_TIMEOUT, sock_read=FETCH_READ_TIMEOUT)
+    try:
+        async with session.get(url, headers=conditional, timeout=timeout) as response:
+            if response.status == 304:
+                data = cache.not_modified(url, response.headers)
+                if data is not None:
+                    print(colored(f"♻️ [AI Server] URL not modified, reusing cached image: {url}", "green"))
+                    return data
+                return await fetch_async(session, url, max_bytes, cache)
+            if response.status != 200:
+                raise FetchError(f"Image URL returned HTTP {response.status}")
+            _check_length(response.headers, max_bytes)
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+                body += chunk
+                if len(body) > max_bytes:
+                    raise FetchError(f"Image is larger than {max_bytes} bytes")
+            data = bytes(body)
+            cache.store(url, data, response.headers)
+            return data
+    except FetchError:
+        raise
+    except Exception as e:
+        print(colored(f"❌ [AI Server] Error downloading {url}: {e}", "red"))
+        raise FetchError("Failed to download image from URL") from e
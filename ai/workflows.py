@@ -0,0 +1,508 @@
+import copy
+import json
+import math
+import os
+import random
+import threading
+import time
+
+from termcolor import colored
+
+# Workflow files live next to this module unless WORKFLOW_DIR says otherwise
+WORKFLOW_DIR = os.getenv('WORKFLOW_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+# Request parameters and the (node id, input name) pairs they are written to.
+# A parameter may bind to several inputs; unbound parameters keep the value
+# stored in the workflow file.
+# NOTE: Adjust these IDs if the exported workflow files change.
+WORKFLOW_SPECS = {
+    "generate": ("workflow.json", {
+        "prompt": [("42", "text")],
+        "steps": [("41", "steps")],
+        "seed": [("41", "seed")],
+        "width": [("45", "width")],
+        "height": [("45", "height")],
+        "batch_size": [("45", "batch_size")],
+    }),
+    "edit": ("edit_workflow.json", {
+        "prompt": [("75:74", "text")],
+        "image": [("76", "image")],
+        "seed": [("75:73", "noise_seed")],
+        "steps": [("75:62", "steps")],
+    }),
+    "inpaint": ("inpaint_workflow.json", {
+        "prompt": [("45", "text")],
+        "image": [("59", "image")],
+        "mask": [("97", "image")],
+        "seed": [("83", "seed")],
+        "steps": [("83", "steps")],
+    }),
+}
+
+# Run iterative refinement as one chained graph instead of a queue/upload round trip per step
+REFINE_SINGLE_GRAPH = os.getenv('REFINE_SINGLE_GRAPH', '1') != '0'
+
+# Collect only the outputs a route returns (its SaveImage nodes), not previews or comparers
+RETURNED_OUTPUTS_ONLY = os.getenv('RETURNED_OUTPUTS_ONLY', '1') != '0'
+
+# "websocket" rewrites each SaveImage into a SaveImageWebsocket when a workflow is loaded: final
+# images then arrive as PNG frames on the open WebSocket instead of being written to ComfyUI's
+# output directory and downloaded from /view. "save" (default) runs the workflows as exported.
+OUTPUT_MODE = os.getenv('COMFYUI_OUTPUT_MODE', 'save').lower()
+# Sends its images over the WebSocket; ComfyUI ships it as custom_nodes/websocket_image_save.py
+WEBSOCKET_OUTPUT = "SaveImageWebsocket"
+SAVE_OUTPUTS = ("SaveImage", WEBSOCKET_OUTPUT)
+
+# Parameters that keep the workflow file's value when passed as None; the others (prompt,
+# image, mask) have no meaningful default, so a missing one is an error
+OPTIONAL_PARAMS = ("steps", "seed", "width", "height", "batch_size")
+
+# Marker written into bound inputs before serializing, then split out again
+_SLOT_MARKER = "\u0000slot:{}\u0000"
+
+
+class WorkflowError(ValueError):
+    """A workflow file doesn't contain the nodes/inputs its bindings expect."""
+
+
+class WorkflowTemplate:
+    """A workflow parsed and validated once, rendered cheaply per request.
+
+    The graph is serialized a single time with a marker in every bound input,
+    then split into literal JSON fragments and parameter slots. ``render``
+    only has to ``json.dumps`` the parameter values and join the pieces, and
+    every call returns an independent copy.
+    """
+
+    def __init__(self, name, path, bindings, graph, mtime):
+        self.name = name
+        self.path = path
+        self.bindings = bindings
+        self.graph = stream_outputs(graph) if OUTPUT_MODE == "websocket" else graph
+        self.mtime = mtime
+        self.defaults = {}
+        self._parts = self._compile()
+        self.input_scales = {param: InputScale.find(graph, targets) for param, targets in bindings.items()}
+        # output_nodes for get_images; None collects every output
+        save_nodes = {node_id for node_id, node in self.graph.items() if node.get("class_type") in SAVE_OUTPUTS}
+        self.returned_outputs = save_nodes if RETURNED_OUTPUTS_ONLY and save_nodes else None
+
+    @classmethod
+    def load(cls, name, path, bindings):
+        mtime = os.stat(path).st_mtime
+        print(colored(f"Loading workflow '{name}' from '{path}'.", "cyan"))
+        with open(path, "r", encoding="utf-8") as f:
+            graph = json.load(f)
+        return cls(name, path, bindings, graph, mtime)
+
+    def _compile(self):
+        marked = json.loads(json.dumps(self.graph))
+        for param, targets in self.bindings.items():
+            for node_id, input_name in targets:
+                inputs = marked.get(node_id, {}).get("inputs")
+                if inputs is None or input_name not in inputs:
+                    raise WorkflowError(f"{os.path.basename(self.path)}: node {node_id} has no input '{input_name}' for '{param}'")
+                self.defaults.setdefault(param, inputs[input_name])
+                inputs[input_name] = _SLOT_MARKER.format(param)
+
+        text = json.dumps(marked, separators=(",", ":"))
+        parts = []
+        markers = {json.dumps(_SLOT_MARKER.format(param)): param for param in self.bindings}
+        pos = 0
+        while True:
+            hits = [(text.find(m, pos), m) for m in markers]
+            hits = [(i, m) for i, m in hits if i != -1]
+            if not hits:
+                break
+            i, m = min(hits)
+            parts.append(text[pos:i])
+            parts.append((markers[m],))
+            pos = i + len(m)
+        parts.append(text[pos:])
+        return parts
+
+    def render(self, **params):
+        """Returns the bound workflow as compact JSON text.
+
+        Parameters that aren't passed keep the workflow file's value (graph
+        builders replace those inputs afterwards); passing None is only
+        allowed for OPTIONAL_PARAMS.
+        """
+        unknown = set(params) - set(self.bindings)
+        if unknown:
+            raise WorkflowError(f"Workflow '{self.name}' has no binding for {sorted(unknown)}")
+        missing = [name for name, value in params.items() if value is None and name not in OPTIONAL_PARAMS]
+        if missing:
+            raise WorkflowError(f"Workflow '{self.name}' needs a value for {sorted(missing)}")
+        out = []
+        for part in self._parts:
+            if isinstance(part, tuple):
+                value = params.get(part[0])
+                out.append(json.dumps(self.defaults[part[0]] if value is None else value))
+            else:
+                out.append(part)
+        return "".join(out)
+
+    def instantiate(self, **params):
+        """Returns the bound workflow as a fresh dict, for callers that edit the graph."""
+        return json.loads(self.render(**params))
+
+
+class InputScale:
+    """The ComfyUI node that resizes an uploaded input straight after its LoadImage.
+
+    Mirrors the node's size arithmetic so the input can be downscaled before
+    upload to a size the node maps to exactly the same output geometry.
+    """
+
+    SUPPORTED = ("ImageScaleToTotalPixels", "ImageScaleToMaxDimension")
+    # The node's rounding can map the exact target a pixel off; a nearby size usually maps back
+    _NUDGES = sorted(((dw, dh) for dw in range(-3, 4) for dh in range(-3, 4)), key=lambda d: (abs(d[0]) + abs(d[1]), d))
+
+    def __init__(self, class_type, inputs):
+        self.class_type = class_type
+        self.inputs = inputs
+
+    @property
+    def method(self):
+        return self.inputs["upscale_method"]
+
+    @classmethod
+    def find(cls, graph, targets):
+        """Returns the scaler a single bound LoadImage feeds into, if that is its only consumer."""
+        if len(targets) != 1:
+            return None
+        load_id = targets[0][0]
+        if graph.get(load_id, {}).get("class_type") != "LoadImage":
+            return None
+        consumers = [(node, name) for node in graph.values() for name, value in node.get("inputs", {}).items()
+                     if _is_link(value) and value[0] == load_id]
+        if len(consumers) != 1:
+            return None
+        node, name = consumers[0]
+        inputs = {k: v for k, v in node["inputs"].items() if k != name}
+        if node.get("class_type") not in cls.SUPPORTED or name != "image" or node["inputs"][name][1] != 0:
+            return None
+        if any(_is_link(v) for v in inputs.values()):
+            return None
+        return cls(node["class_type"], inputs)
+
+    def output_size(self, width, height):
+        """The size ComfyUI's node produces for a ``width`` x ``height`` input."""
+        if self.class_type == "ImageScaleToTotalPixels":
+            steps = self.inputs.get("resolution_steps", 1)
+            scale_by = math.sqrt(self.inputs["megapixels"] * 1024 * 1024 / (width * height))
+            return round(width * scale_by / steps) * steps, round(height * scale_by / steps) * steps
+        largest = self.inputs["largest_size"]
+        if height > width:
+            return round(width / height * largest), largest
+        if width > height:
+            return largest, round(height / width * largest)
+        return largest, largest
+
+    def prescale_size(self, width, height):
+        """A smaller size with the same node output as ``width`` x ``height``, or None."""
+        target = self.output_size(width, height)
+        if target[0] * target[1] >= width * height:
+            return None
+        for dw, dh in self._NUDGES:
+            size = (target[0] + dw, target[1] + dh)
+            if size[0] * size[1] < width * height and self.output_size(*size) == target:
+                return size
+        return None
+
+
+class WorkflowRegistry:
+    """Loads each workflow once and reloads it when the file's mtime changes."""
+
+    def __init__(self, directory, specs, check_interval=1.0):
+        self.directory = directory
+        self.specs = specs
+        self.check_interval = check_interval
+        self._templates = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, self.specs[name][0])
+
+    def get(self, name):
+        """Returns the current template; raises FileNotFoundError or WorkflowError."""
+        now = time.monotonic()
+        template = self._templates.get(name)
+        if template is not None and now - self._checked.get(name, 0) < self.check_interval:
+            return template
+
+        with self._lock:
+            template = self._templates.get(name)
+            path = self.path(name)
+            if template is None or os.stat(path).st_mtime != template.mtime:
+                if template is not None:
+                    print(colored(f"Workflow '{name}' changed on disk, reloading.", "yellow"))
+                template = WorkflowTemplate.load(name, path, self.specs[name][1])
+                self._templates[name] = template
+            self._checked[name] = now
+            return template
+
+    def preload(self):
+        for name in self.specs:
+            try:
+                self.get(name)
+            except (FileNotFoundError, WorkflowError) as e:
+                print(colored(f"Failed to load workflow '{name}': {e}", "red"))
+
+
+registry = WorkflowRegistry(WORKFLOW_DIR, WORKFLOW_SPECS)
+
+
+# The scaling node a workflow applies to an uploaded input, or None (also if the workflow can't be loaded)
+def input_scale(name, param="image"):
+    try:
+        return registry.get(name).input_scales.get(param)
+    except (FileNotFoundError, WorkflowError):
+        return None
+
+
+def _is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+# The graph with every SaveImage replaced by a SaveImageWebsocket fed from the same images
+def stream_outputs(graph):
+    graph = dict(graph)
+    for node_id, node in graph.items():
+        if node.get("class_type") == "SaveImage":
+            graph[node_id] = {"class_type": WEBSOCKET_OUTPUT, "inputs": {"images": node["inputs"]["images"]},
+                              "_meta": {"title": "Save Image (WebSocket)"}}
+    return graph
+
+
+# Ids of the nodes in a prompt (a dict or rendered JSON) that send their images over the WebSocket
+def websocket_outputs(prompt):
+    if isinstance(prompt, str):
+        if f'"{WEBSOCKET_OUTPUT}"' not in prompt:
+            return frozenset()
+        prompt = json.loads(prompt)
+    return frozenset(node_id for node_id, node in prompt.items() if node.get("class_type") == WEBSOCKET_OUTPUT)
+
+
+def _save_node(graph, name):
+    save_nodes = [node_id for node_id, node in graph.items() if node.get("class_type") in SAVE_OUTPUTS]
+    if len(save_nodes) != 1:
+        raise WorkflowError(f"Workflow '{name}' must have exactly one SaveImage node, found {len(save_nodes)}")
+    return save_nodes[0]
+
+
+def _downstream(graph, roots):
+    """Returns every node that (transitively) takes an input from one of ``roots``."""
+    found = set(roots)
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in graph.items():
+            if node_id in found:
+                continue
+            if any(_is_link(v) and v[0] in found for v in node.get("inputs", {}).values()):
+                found.add(node_id)
+                changed = True
+    return found
+
+
+def build_refinement_graph(generate_template, edit_template, prompt, resolution, seed, step_seeds):
+    """Chains txt2img and ``len(step_seeds)`` edit passes into a single ComfyUI graph.
+
+    The txt2img subgraph runs with 1 step. Each refinement step gets its own
+    copy of the edit nodes that depend on the input image or the noise seed,
+    fed directly from the previous step's decoded image instead of a
+    LoadImage of an uploaded file. Model loaders and the prompt encoding are
+    shared by all steps. Intermediate results become PreviewImage outputs so
+    they can be relayed while the graph is still running.
+
+    Returns ``(graph, final_node_id, preview_node_ids)``.
+    """
+    graph = generate_template.instantiate(prompt=prompt, steps=1, seed=seed,
+                                          width=int(resolution[0]), height=int(resolution[1]))
+    t2i_save = _save_node(graph, generate_template.name)
+    current = graph.pop(t2i_save)["inputs"]["images"]
+
+    edit = edit_template.instantiate(prompt=prompt, steps=1)
+    edit_save = _save_node(edit, edit_template.name)
+    image_nodes = {node_id for node_id, _ in edit_template.bindings["image"]}
+    seed_targets = edit_template.bindings["seed"]
+    per_step = _downstream(edit, image_nodes | {node_id for node_id, _ in seed_targets}) - image_nodes - {edit_save}
+    shared = set(edit) - per_step - image_nodes - {edit_save}
+
+    for node_id in shared:
+        if node_id in graph:
+            raise WorkflowError(f"Node id {node_id} exists in both '{generate_template.name}' and '{edit_template.name}'")
+        graph[node_id] = edit[node_id]
+
+    preview_nodes = []
+    for step, step_seed in enumerate(step_seeds, 1):
+        preview_id = f"refine{step - 1}:preview"
+        graph[preview_id] = {"class_type": "PreviewImage", "inputs": {"images": current},
+                             "_meta": {"title": f"Refinement {step - 1} preview"}}
+        preview_nodes.append(preview_id)
+
+        prefix = f"refine{step}:"
+        for node_id in per_step:
+            node = copy.deepcopy(edit[node_id])
+            for name, value in node["inputs"].items():
+                if _is_link(value) and value[0] in image_nodes:
+                    node["inputs"][name] = list(current)
+                elif _is_link(value) and value[0] in per_step:
+                    node["inputs"][name] = [prefix + value[0], value[1]]
+            graph[prefix + node_id] = node
+        for node_id, input_name in seed_targets:
+            graph[prefix + node_id]["inputs"][input_name] = step_seed
+
+        source, index = edit[edit_save]["inputs"]["images"]
+        current = [prefix + source, index]
+
+    final = copy.deepcopy(edit[edit_save])
+    final["inputs"]["images"] = current
+    graph[edit_save] = final
+    return graph, edit_save, preview_nodes
+
+
+def build_batch_graph(template, items):
+    """Merges renders of ``template`` for several parameter sets into one ComfyUI graph.
+
+    Nodes that depend on a bound parameter are copied per item under a
+    ``batch{i}:`` id prefix; the rest (model loaders and the like) is shared,
+    so it runs once for the whole batch.
+
+    Returns ``(graph, output_node_ids)`` with one SaveImage id per item.
+    """
+    renders = [template.instantiate(**params) for params in items]
+    save = _save_node(renders[0], template.name)
+    bound = {node_id for targets in template.bindings.values() for node_id, _ in targets}
+    per_item = _downstream(renders[0], bound)
+    if save not in per_item:
+        raise WorkflowError(f"Workflow '{template.name}': output does not depend on the request parameters")
+
+    graph = {node_id: node for node_id, node in renders[0].items() if node_id not in per_item}
+    outputs = []
+    for i, render in enumerate(renders):
+        prefix = f"batch{i}:"
+        for node_id in per_item:
+            node = render[node_id]
+            for name, value in node["inputs"].items():
+                if _is_link(value) and value[0] in per_item:
+                    node["inputs"][name] = [prefix + value[0], value[1]]
+            graph[prefix + node_id] = node
+        outputs.append(prefix + save)
+    return graph, outputs
+
+
+# Build the /prompt request body without re-serializing pre-rendered workflow JSON
+def prompt_request_body(prompt, client_id, prompt_id=None):
+    graph = prompt if isinstance(prompt, str) else json.dumps(prompt, separators=(",", ":"))
+    body = '{"prompt":' + graph + ',"client_id":' + json.dumps(client_id)
+    if prompt_id:
+        body += ',"prompt_id":' + json.dumps(prompt_id)
+    return (body + '}').encode('utf-8')
+
+
+def random_seed():
+    return random.randint(1, 1000000000)
+
+
+# Caller-supplied seed from a request field; None (or "") means pick a random one
+def parse_seed(value):
+    if value is None or value == "":
+        return None
+    seed = int(value)
+    if seed < 0:
+        raise ValueError("seed must be non-negative")
+    return seed
+
+
+# Sampler steps from a request; ``default`` when the request leaves them out
+def parse_steps(value, default=None):
+    if value is None or value == "":
+        return default
+    steps = int(value)
+    if steps < 1:
+        raise ValueError("steps must be positive")
+    return steps
+
+
+# Images per /generate-image request; all of them come out of one sampler pass
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 8))
+
+
+def parse_count(value):
+    if value is None or value == "":
+        return 1
+    count = int(value)
+    if not 1 <= count <= MAX_BATCH_SIZE:
+        raise ValueError(f"count must be between 1 and {MAX_BATCH_SIZE}")
+    return count
+
+
+# Per-step seeds for iterative refinement, derived from the job seed so a seed reproduces the whole chain
+def refinement_seeds(seed, count):
+    rng = random.Random(seed)
+    return [rng.randint(1, 1000000000) for _ in range(count)]
+
+
+# Latent sizes micro-batched txt2img requests are snapped to, so compatible requests share a shape
+RESOLUTION_BUCKETS = [
+    tuple(int(v) for v in bucket.lower().split("x"))
+    for bucket in os.getenv('RESOLUTION_BUCKETS', '1024x1024,1152x896,896x1152,1216x832,832x1216,1344x768,768x1344').split(",")
+    if bucket.strip()
+]
+
+
+def snap_to_bucket(width, height, buckets=RESOLUTION_BUCKETS):
+    """Closest bucket by aspect ratio, then by area."""
+    ratio = math.log(width / height)
+    area = width * height
+    return min(buckets, key=lambda b: (round(abs(math.log(b[0] / b[1]) - ratio), 6), abs(math.log(b[0] * b[1] / area))))
+
+
+def optimize_resolution(width, height, target=1024):
+    """
+    Optimizes resolution for Z-Image models:
+    1. Scales up to target while maintaining aspect ratio if smaller.
+    2. Ensures width and height are multiples of 64.
+    """
+    try:
+        if not width or not height:
+            return 1024, 1024
+
+        w = float(width)
+        h = float(height)
+
+        # 1. Scale up to target if smaller
+        aspect_ratio = w / h
+
+        if w >= h:
+            if w < target:
+                new_w = target
+                new_h = target / aspect_ratio
+            else:
+                new_w = w
+                new_h = h
+        else:
+            if h < target:
+                new_h = target
+                new_w = target * aspect_ratio
+            else:
+                new_w = w
+                new_h = h
+
+        # 2. Align to nearest multiple of 64
+        final_w = int(round(new_w / 64) * 64)
+        final_h = int(round(new_h / 64) * 64)
+
+        # Safety checks
+        if final_w < 64: final_w = 64
+        if final_h < 64: final_h = 64
+
+        print(colored(f"📏 [Resolution] Optimized {width}x{height} -> {final_w}x{final_h}", "yellow"))
+        return final_w, final_h
+    except Exception as e:
+        print(colored(f"⚠️ [Resolution] Optimization error: {e}. Using defaults.", "red"))
+        return 1024, 1024
@@ -15,6 +15,7 @@ import path from 'node:path';
 import { mediaServer } from "./services/mediaServer";
 import { EventServer } from "./services/eventServer";
 import { chunkUploadManager } from "./utils/chunkUploadManager";
+import { TRACE_HEADER } from "./utils/trace_utils";
 
 // Initialize event server for real-time notifications
 EventServer.init();
@@ -86,8 +87,14 @@ const authMiddleware = defineMiddleware(async (event) => {
   }
 });
 
+// ✅ Trace middleware — a caller's X-Trace-Id is passed on to the AI server (event.context.traceId)
+const traceMiddleware = defineMiddleware(async (event) => {
+  event.context.traceId = getHeader(event, TRACE_HEADER) || undefined;
+});
+
 // ✅ Register the middleware
 app.use(authMiddleware);
+app.use(traceMiddleware);
 
 // ✅ Media upload route
 app.route(
@@ -1,6 +1,7 @@
 import { defineRpc } from "@arrirpc/server";
 import { a } from "@arrirpc/schema";
 import { mediaServer } from "../../services/mediaServer";
+import { AiTrace } from "../../utils/trace_utils";
 import { AI_BASE_URL } from "@env";
 
 export default defineRpc({
@@ -14,7 +15,8 @@ export default defineRpc({
         message: a.string(),
         data: a.any(),
     }),
-    handler: async ({ params }) => {
+    handler: async ({ params, traceId }) => {
+        const trace = new AiTrace("edit_image", traceId);
         console.log("!!! [Backend RPC] edit-image HIT !!!");
         try {
             const aiServerUrl = AI_BASE_URL || "http://localhost:5000";
@@ -28,6 +30,7 @@ export default defineRpc({
                 method: "POST",
                 headers: {
                     "Content-Type": "application/json",
+                    ...trace.headers(),
                 },
                 body: JSON.stringify({
                     prompt: params.prompt,
@@ -38,6 +41,7 @@ export default defineRpc({
             });
 
             clearTimeout(timeoutId);
+            trace.received(response);
 
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({}) as any);
@@ -53,6 +57,7 @@ export default defineRpc({
                 directory: "generated",
             });
 
+            trace.log("succeeded");
             return {
                 success: true,
                 message: "Image edited and uploaded successfully",
@@ -62,7 +67,7 @@ export default defineRpc({
             console.error("❌ Edit Image failed:", error);
             return {
                 success: false,
-                message: error.message || "Unknown error occurred during image editing",
+                message: trace.failure(error, "Unknown error occurred during image editing"),
                 data: null,
             };
         }
@@ -1,6 +1,7 @@
 import { defineRpc } from "@arrirpc/server";
 import { a } from "@arrirpc/schema";
 import { mediaServer } from "../../services/mediaServer";
+import { AiTrace } from "../../utils/trace_utils";
 import { AI_BASE_URL } from "@env";
 
 export default defineRpc({
@@ -17,7 +18,8 @@ export default defineRpc({
         message: a.string(),
         url: a.optional(a.string()),
     }),
-    handler: async ({ params }) => {
+    handler: async ({ params, traceId }) => {
+        const trace = new AiTrace("generate_image", traceId);
         console.log("!!! [Backend RPC] generate_image HIT !!!");
         console.log("Params:", JSON.stringify(params));
         try {
@@ -34,6 +36,7 @@ export default defineRpc({
                 method: "POST",
                 headers: {
                     "Content-Type": "application/json",
+                    ...trace.headers(),
                 },
                 body: JSON.stringify({
                     prompt: params.prompt,
@@ -47,6 +50,7 @@ export default defineRpc({
             });
 
             clearTimeout(timeoutId);
+            trace.received(response);
 
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({}) as any);
@@ -63,6 +67,7 @@ export default defineRpc({
                 directory: "generated",
             });
 
+            trace.log("succeeded");
             return {
                 success: true,
                 message: "Image generated and uploaded successfully",
@@ -72,7 +77,7 @@ export default defineRpc({
             console.error("❌ Image generation failed:", error);
             return {
                 success: false,
-                message: error.message || "Unknown error occurred during image generation",
+                message: trace.failure(error, "Unknown error occurred during image generation"),
             };
         }
     },
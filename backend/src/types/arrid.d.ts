@@ -10,11 +10,13 @@ declare module '@arrirpc/server' {
         logger?: Logger<never, boolean>;
         user?: AuthUser;
         reqStart?: Date;
+        traceId?: string;
     }
     interface ArriEventContext {
         logger?: Logger<never, boolean>;
         user?: AuthUser;
         reqStart?: Date;
+        traceId?: string;
         foo?: string;
     }
 }
@@ -0,0 +1,36 @@
+import { randomUUID } from "node:crypto";
+
+// Header the AI server reads the trace id from, and answers with
+export const TRACE_HEADER = "X-Trace-Id";
+
+// One call to the AI server, identified by the trace id it is recorded under at /traces/<id>
+export class AiTrace {
+    readonly procedure: string;
+    readonly started = Date.now();
+    id: string;
+
+    // Continues the caller's trace when the RPC request carried an X-Trace-Id
+    constructor(procedure: string, incomingId?: string) {
+        this.procedure = procedure;
+        this.id = incomingId || randomUUID();
+    }
+
+    headers(): Record<string, string> {
+        return { [TRACE_HEADER]: this.id };
+    }
+
+    // The AI server echoes the id it stored the trace under (it normalises ids it can't use)
+    received(response: Response) {
+        this.id = response.headers.get(TRACE_HEADER) || this.id;
+    }
+
+    log(outcome: string) {
+        console.log(`🧵 [Backend RPC] ${this.procedure} ${outcome} in ${Date.now() - this.started}ms (trace ${this.id})`);
+    }
+
+    // Error message returned to the client, with the trace id to look the call up by
+    failure(error: any, fallback: string): string {
+        this.log("failed");
+        return `${error?.message || fallback} (trace ${this.id})`;
+    }
+}